@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+"""
+离线基准测试：在本地启动模拟Swap页面和模拟OpenRouter接口，
+运行真实的 defi.main() 交易循环，统计每分钟交易数和各阶段耗时，并与 bench/baselines.json 中的基线比较
+
+用法:
+    python benchmark.py                       # 运行默认场景并与基线比较
+    python benchmark.py --update-baseline     # 运行并把结果保存为基线
+    python benchmark.py --scenario slow --quote-delay-ms 800 --confirm-delay-ms 2000
+    python benchmark.py --replay sessions/latest --scenario replay   # 用录制的真实会话离线回放
+    python benchmark.py --profile-selectors sessions/latest         # 统计DOM快照上各选择器策略的命中率和耗时
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+BENCH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench")
+MOCK_PAGE = os.path.join(BENCH_DIR, "mock_swap.html")
+BASELINES_FILE = os.path.join(BENCH_DIR, "baselines.json")
+
+# 与基线比较的阶段耗时（p95）；组合动作开启时方向切换和报价等待记在 in_page_* 阶段
+# cost阶段只读取组合动作已经返回的状态，总是0ms，不参与比较
+COMPARED_PHASES = ("direction", "in_page_reverse", "all_click", "in_page_quote", "swap_click",
+                   "confirm", "settle", "reverse", "trade_total")
+
+class MockHandler(BaseHTTPRequestHandler):
+    """模拟DeFi应用和OpenRouter的HTTP接口"""
+    config = {}
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length", "0"))
+        return self.rfile.read(length) if length else b""
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/api/quote":
+            time.sleep(self.config["quote_delay_ms"] / 1000)
+            self._send_json({"route": {"totalCostUsd": self.config["cost"]}})
+            return
+        if path == "/trade" or path.startswith("/join/"):
+            with open(MOCK_PAGE, "r", encoding="utf-8") as f:
+                html = f.read().replace("/*MOCK_CONFIG*/{}", json.dumps(self.config))
+            body = html.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        self.send_error(404)
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        self._read_body()
+        if path == "/api/transaction":
+            time.sleep(self.config["confirm_delay_ms"] / 1000)
+            self._send_json({"txHash": "0x" + uuid.uuid4().hex, "status": "confirmed"})
+            return
+        if path == "/api/v1/chat/completions":
+            time.sleep(self.config["llm_delay_ms"] / 1000)
+            content = json.dumps({
+                "balances": {"USDC": self.config["balance_usdc"], "USDT": self.config["balance_usdt"]},
+                "cost": self.config["cost"],
+                "xp": 1,
+                "recommendation": "trade",
+                "reason": "mock"
+            })
+            self._send_json({"choices": [{"message": {"content": content}}]})
+            return
+        self.send_error(404)
+
+def start_mock_server(config):
+    """在后台线程中启动模拟服务器，返回 (服务器, 基础URL)"""
+    MockHandler.config = config
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+def configure_environment(base_url, args, work_dir):
+    """在导入defi之前设置环境变量，让交易循环指向本地模拟服务（或录制的会话）"""
+    if args.replay:
+        with open(os.path.join(args.replay, "session.json"), "r", encoding="utf-8") as f:
+            base_url = json.load(f)["app_url"]
+        os.environ.update({
+            "SESSION_MODE": "replay",
+            "SESSION_DIR": args.replay,
+            "LLM_ANALYSIS_MODE": "off",
+        })
+    os.environ.update({
+        "CONFIG_FILE": os.path.join(work_dir, ".env"),
+        "DEFI_APP_URL": base_url,
+        "OPENROUTER_API_URL": f"{base_url}/api/v1/chat/completions",
+        "OPENROUTER_API_KEY": "benchmark",
+        "WALLET_CONNECT_WAIT": "5",
+        "BROWSER_HEADLESS": "1",
+        "MAX_TRADES": str(args.trades),
+        "MAX_TOTAL_COST": "1000000",
+        "MAX_COST_PER_TRADE": "0.3",
+        "WAIT_BETWEEN_TRADES": "0",
+        "TRADE_JOURNAL_FILE": os.path.join(work_dir, "trade_journal.jsonl"),
+        "SELECTOR_STATS_FILE": os.path.join(work_dir, "selector_stats.json"),
+        "SCREENSHOT_DEBUG_DIR": os.path.join(work_dir, "debug_frames"),
+        "HTTP_CACHE_DIR": os.path.join(work_dir, "http_cache"),
+        "METRICS_PORT": "0",
+        "METRICS_FILE": "",
+        "LEAN_MODE": "1" if args.lean else "0",
+        "NETWORK_QUOTE_PATTERN": r"/api/quote",
+    })
+
+def compare_with_baseline(result, baseline, tolerance, min_delta_ms):
+    """返回超出容差的回归项列表（比基线慢不到min_delta_ms的阶段不算，避免几毫秒的阶段因抖动误报）"""
+    regressions = []
+    expected_tpm = baseline.get("trades_per_minute")
+    if expected_tpm and result["trades_per_minute"] < expected_tpm * (1 - tolerance):
+        regressions.append(f"每分钟交易数 {result['trades_per_minute']} < 基线 {expected_tpm}")
+    for name, expected in baseline.get("phases", {}).items():
+        if name not in COMPARED_PHASES:
+            continue
+        actual = result["phases"].get(name)
+        if actual is None:
+            continue
+        limit = max(expected["p95_ms"] * (1 + tolerance), expected["p95_ms"] + min_delta_ms)
+        if actual["p95_ms"] > limit:
+            regressions.append(f"阶段 {name} p95 {actual['p95_ms']}ms > 基线 {expected['p95_ms']}ms")
+    return regressions
+
+def load_baselines():
+    if not os.path.exists(BASELINES_FILE):
+        return {}
+    with open(BASELINES_FILE, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+async def browser_version():
+    from playwright.async_api import async_playwright
+    async with async_playwright() as p:
+        browser = await p.chromium.launch(headless=True)
+        version = browser.version
+        await browser.close()
+    return version
+
+def describe_environment(args):
+    """基线的录制环境：浏览器、Playwright、Python版本、CPU数和场景参数"""
+    from importlib.metadata import version
+    return {
+        "browser": f"chromium {asyncio.run(browser_version())}",
+        "playwright": version("playwright"),
+        "python": platform.python_version(),
+        "platform": f"{platform.system()} {platform.machine()}",
+        "cpus": os.cpu_count(),
+        "docker": os.path.exists("/.dockerenv"),
+        "args": {name: getattr(args, name) for name in ("trades", "quote_delay_ms", "confirm_delay_ms",
+                                                        "dialog_delay_ms", "llm_delay_ms", "toast_ms", "cost", "lean")}
+    }
+
+def save_baseline(scenario, result, environment):
+    baselines = load_baselines()
+    baselines[scenario] = {
+        "trades_per_minute": result["trades_per_minute"],
+        # 没有测到耗时（p95为0）的阶段不保存，比较时没有意义
+        "phases": {name: {"p95_ms": phase["p95_ms"]} for name, phase in result["phases"].items()
+                   if name in COMPARED_PHASES and phase["p95_ms"] > 0},
+        "environment": environment
+    }
+    with open(BASELINES_FILE, "w", encoding="utf-8") as f:
+        json.dump(baselines, f, ensure_ascii=False, indent=2)
+    print(f"已保存基线: {scenario} -> {BASELINES_FILE}")
+
+def run_benchmark(args):
+    config = {
+        "quote_delay_ms": args.quote_delay_ms,
+        "confirm_delay_ms": args.confirm_delay_ms,
+        "dialog_delay_ms": args.dialog_delay_ms,
+        "llm_delay_ms": args.llm_delay_ms,
+        "toast_ms": args.toast_ms,
+        "cost": args.cost,
+        "balance_usdc": 100.0,
+        "balance_usdt": 0.0,
+        "wallet_connected": True,
+    }
+    # 回放时页面请求全部由HAR响应，不需要模拟服务
+    server, base_url = (None, None) if args.replay else start_mock_server(config)
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            configure_environment(base_url, args, work_dir)
+            import defi
+
+            started = time.monotonic()
+            asyncio.run(defi.main())
+            elapsed = time.monotonic() - started
+            snapshot = defi.metrics.snapshot()
+    finally:
+        if server is not None:
+            server.shutdown()
+
+    return {
+        "trades": snapshot["trades"],
+        "elapsed_s": round(elapsed, 1),
+        "trades_per_minute": snapshot["trades_per_minute_overall"],
+        "phases": snapshot["phases"],
+        "selector_hits": snapshot["selector_hits"],
+    }
+
+async def profile_selectors(session_dir, timeout_ms):
+    """
+    在录制的每个DOM快照上依次尝试所有按钮选择器策略，统计命中率和找到元素的耗时
+    快照以禁用JavaScript的方式加载，结果只取决于DOM本身，可以重复比较
+    """
+    import defi
+    from playwright.async_api import async_playwright
+    
+    dom_dir = os.path.join(session_dir, "dom")
+    snapshots = sorted(name for name in os.listdir(dom_dir) if name.endswith(".html"))
+    actions = {
+        "all": defi.ALL_BUTTON_STRATEGIES,
+        "swap": defi.SWAP_BUTTON_STRATEGIES,
+        "reverse": defi.REVERSE_BUTTON_STRATEGIES,
+    }
+    results = {}  # (动作, 策略) -> [耗时毫秒或None]
+    state_ms = []
+    async with async_playwright() as p:
+        browser = await p.chromium.launch(headless=True)
+        context = await browser.new_context(java_script_enabled=False, viewport={"width": 1280, "height": 800})
+        # 快照中引用的外部资源全部拦截，只测DOM
+        await context.route("**/*", lambda route: route.abort())
+        page = await context.new_page()
+        for name in snapshots:
+            with open(os.path.join(dom_dir, name), "r", encoding="utf-8") as f:
+                await page.set_content(f.read(), wait_until="domcontentloaded")
+            started = time.perf_counter()
+            await defi.read_swap_page_state(page)
+            state_ms.append((time.perf_counter() - started) * 1000)
+            for action, strategies in actions.items():
+                for strategy in strategies:
+                    if strategy.selector is None:
+                        continue
+                    started = time.perf_counter()
+                    try:
+                        await defi._wait_actionable(page, strategy, timeout_ms)
+                        elapsed = (time.perf_counter() - started) * 1000
+                    except Exception:
+                        elapsed = None
+                    results.setdefault((action, strategy.name), []).append(elapsed)
+        await browser.close()
+    
+    print(f"\n--- 选择器分析: {len(snapshots)} 个DOM快照 ---")
+    if state_ms:
+        print(f"读取页面状态: p50 {sorted(state_ms)[len(state_ms) // 2]:.1f}ms")
+    for (action, strategy), samples in results.items():
+        hits = sorted(sample for sample in samples if sample is not None)
+        p50 = f"{hits[len(hits) // 2]:.1f}ms" if hits else "-"
+        print(f"{action}/{strategy}: 命中 {len(hits)}/{len(samples)}, p50 {p50}")
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description="DeFi交易机器人离线基准测试")
+    parser.add_argument("--scenario", default="default", help="基线场景名称")
+    parser.add_argument("--trades", type=int, default=20, help="运行的交易次数")
+    parser.add_argument("--quote-delay-ms", type=int, default=150, help="模拟报价接口延迟")
+    parser.add_argument("--confirm-delay-ms", type=int, default=500, help="模拟交易确认延迟")
+    parser.add_argument("--dialog-delay-ms", type=int, default=100, help="点击Swap后确认框出现的延迟")
+    parser.add_argument("--llm-delay-ms", type=int, default=1500, help="模拟OpenRouter响应延迟")
+    parser.add_argument("--toast-ms", type=int, default=1500, help="交易通知显示时长")
+    parser.add_argument("--cost", type=float, default=0.12, help="模拟报价成本（USDT）")
+    parser.add_argument("--lean", action="store_true", help="使用精简浏览器模式运行")
+    parser.add_argument("--replay", help="用录制的会话目录（SESSION_MODE=record生成）代替模拟页面")
+    parser.add_argument("--profile-selectors", metavar="SESSION_DIR", help="只分析录制的DOM快照上的选择器耗时")
+    parser.add_argument("--selector-timeout-ms", type=int, default=200, help="分析选择器时每个策略的超时")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="允许相对基线变差的比例")
+    parser.add_argument("--min-delta-ms", type=float, default=100, help="阶段p95比基线慢不超过这个毫秒数时不算回归")
+    parser.add_argument("--update-baseline", action="store_true", help="把本次结果保存为基线")
+    args = parser.parse_args()
+    
+    if args.profile_selectors:
+        return asyncio.run(profile_selectors(args.profile_selectors, args.selector_timeout_ms))
+
+    result = run_benchmark(args)
+
+    print("\n--- 基准测试结果 ---")
+    print(f"场景: {args.scenario}, 交易次数: {result['trades']}, 总耗时: {result['elapsed_s']}秒")
+    print(f"每分钟交易数: {result['trades_per_minute']}")
+    for name, phase in result["phases"].items():
+        print(f"阶段 {name}: p50 {phase['p50_ms']}ms, p95 {phase['p95_ms']}ms, p99 {phase['p99_ms']}ms")
+
+    if result["trades"] < args.trades:
+        print(f"失败: 只完成了 {result['trades']}/{args.trades} 次交易")
+        return 1
+
+    if args.update_baseline:
+        save_baseline(args.scenario, result, describe_environment(args))
+        return 0
+
+    baseline = load_baselines().get(args.scenario)
+    if baseline is None:
+        # 没有基线时无法判断是否回归，不能当作通过
+        print(f"没有场景 {args.scenario} 的基线，使用 --update-baseline 生成")
+        return 1
+    environment = baseline.get("environment")
+    if environment:
+        print(f"基线录制环境: {environment['browser']}, Playwright {environment['playwright']}, "
+              f"Python {environment['python']}, {environment['cpus']} CPU")
+    regressions = compare_with_baseline(result, baseline, args.tolerance, args.min_delta_ms)
+    if regressions:
+        print("性能回归:")
+        for regression in regressions:
+            print(f"  {regression}")
+        return 1
+    print("未发现性能回归")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,436 +3,3672 @@ import time
 import re
 import os
 import json
-import requests
-from datetime import datetime
+import io
+import hashlib
+import signal
+import aiohttp
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+from typing import Dict, Optional
 from playwright.async_api import async_playwright
-from dotenv import load_dotenv
+from dotenv import load_dotenv, dotenv_values
 import base64
 
-# 加载环境变量
-load_dotenv()
+try:
+    from PIL import Image  # 可选：用于缩放截图和WebP编码
+except ImportError:
+    Image = None
+
+# 加载环境变量（运行中修改该文件会重新加载交易参数）
+CONFIG_FILE = os.getenv("CONFIG_FILE", ".env")
+load_dotenv(CONFIG_FILE)
 
 # OpenRouter API配置
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
-LLAMA4_MODEL = "meta-llama/llama-4-maverick:free"  # 可以根据OpenRouter支持的模型替换
+LLAMA4_MODEL = "meta-llama/llama-4-maverick:free"
+LLM_MODEL = os.getenv("LLM_MODEL", LLAMA4_MODEL)  # 可以根据OpenRouter支持的模型替换
+OPENROUTER_API_URL = os.getenv("OPENROUTER_API_URL", "https://openrouter.ai/api/v1/chat/completions")
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))  # 建立连接超时（秒）
+LLM_READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", "30"))  # 读取响应超时（秒）
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "2"))  # 同时进行的LLM请求上限
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "64"))  # 分析结果缓存条数，0表示关闭缓存
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", "120"))  # 缓存有效期（秒）
+LLM_CACHE_MAX_DISTANCE = int(os.getenv("LLM_CACHE_MAX_DISTANCE", "4"))  # 感知哈希最大汉明距离（0-64）
+LLM_ANALYSIS_MODE = os.getenv("LLM_ANALYSIS_MODE", "background").lower()  # background / inline / off
+LLM_ANALYSIS_EVERY = max(int(os.getenv("LLM_ANALYSIS_EVERY", "1")), 1)  # 每N次交易分析一次
+LLM_ANALYSIS_MAX_AGE = float(os.getenv("LLM_ANALYSIS_MAX_AGE", "60"))  # 分析结果可被复用的最长时间（秒）
+LLM_FALLBACK_MODELS = [
+    item.strip() for item in os.getenv("LLM_FALLBACK_MODELS", "").split(",") if item.strip()
+]  # 主模型失败或熔断时按顺序尝试的备用模型
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "3"))  # 模型连续失败几次后熔断，0表示只在服务端返回Retry-After时熔断
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "60"))  # 熔断后多久放行一次试探请求（秒），试探失败时冷却时间加倍
+
+# 应用和浏览器设置
+DEFI_APP_URL = os.getenv("DEFI_APP_URL", "https://app.defi.app").rstrip("/")  # DeFi应用地址
+DEFI_JOIN_PATH = os.getenv("DEFI_JOIN_PATH", "/join/v5FvMr")  # 首次打开的邀请页面
+WALLET_CONNECT_WAIT = float(os.getenv("WALLET_CONNECT_WAIT", "30"))  # 等待钱包连接的最长时间（秒），检测到已连接立即继续
+BROWSER_PROFILE_DIR = os.getenv("BROWSER_PROFILE_DIR", "")  # 持久化浏览器配置目录，留空表示每次使用全新上下文
+BROWSER_STORAGE_STATE = os.getenv("BROWSER_STORAGE_STATE", "")  # 保存/恢复Cookie和localStorage的文件，留空表示关闭
+BROWSER_HEADLESS = os.getenv("BROWSER_HEADLESS", "0").lower() in ("1", "true", "yes")  # 是否使用无头浏览器
+PAGE_READY_TIMEOUT = float(os.getenv("PAGE_READY_TIMEOUT", "15"))  # 等待Swap卡片出现的最长时间（秒）
+READINESS_THROTTLE_MS = int(os.getenv("READINESS_THROTTLE_MS", "100"))  # 页面状态推送的最小间隔（毫秒）
+MEMORY_CHECK_EVERY = int(os.getenv("MEMORY_CHECK_EVERY", "10"))  # 每N笔交易检查一次浏览器内存，0表示关闭
+MEMORY_MAX_HEAP_MB = float(os.getenv("MEMORY_MAX_HEAP_MB", "512"))  # JS堆上限（MB）
+MEMORY_MAX_DOM_NODES = int(os.getenv("MEMORY_MAX_DOM_NODES", "50000"))  # DOM节点数上限
+MEMORY_MAX_LISTENERS = int(os.getenv("MEMORY_MAX_LISTENERS", "50000"))  # 事件监听器数上限
+MEMORY_RECYCLE_MODE = os.getenv("MEMORY_RECYCLE_MODE", "reload").lower()  # 超限时 reload: 重新加载页面；new_page: 换一个新页面
+# 前端静态资源的磁盘缓存目录，默认关闭：开启后请求拦截会让Chromium对所有请求停用自带的HTTP缓存，
+# 只适合没有持久化配置目录（BROWSER_PROFILE_DIR）、每次启动都要重新下载前端包的场景
+HTTP_CACHE_DIR = os.getenv("HTTP_CACHE_DIR", "")
+HTTP_CACHE_MAX_AGE = int(os.getenv("HTTP_CACHE_MAX_AGE", "604800"))  # 静态资源缓存的最长有效期（秒）
+SESSION_MODE = os.getenv("SESSION_MODE", "").lower()  # record: 录制HAR和DOM快照；replay: 用录制的HAR离线回放
+SESSION_DIR = os.getenv("SESSION_DIR", "sessions/latest")  # 录制/回放的会话目录
+SESSION_MAX_SNAPSHOTS = int(os.getenv("SESSION_MAX_SNAPSHOTS", "500"))  # 录制时最多保存的DOM快照数
+LEAN_MODE = os.getenv("LEAN_MODE", "0").lower() in ("1", "true", "yes")  # 精简模式：拦截无用资源、关闭动画
+LEAN_BLOCK_RESOURCE_TYPES = {
+    item.strip() for item in os.getenv("LEAN_BLOCK_RESOURCE_TYPES", "image,font,media").split(",") if item.strip()
+}
+LEAN_BLOCK_HOSTS = [
+    item.strip() for item in os.getenv(
+        "LEAN_BLOCK_HOSTS",
+        "google-analytics.com,googletagmanager.com,doubleclick.net,segment.io,segment.com,hotjar.com,"
+        "mixpanel.com,amplitude.com,sentry.io,intercom.io,fullstory.com,clarity.ms"
+    ).split(",") if item.strip()
+]
 
 # 交易参数设置
 MAX_COST_PER_TRADE = float(os.getenv("MAX_COST_PER_TRADE", "0.3"))  # 最大接受的交易成本（USDT）
 MAX_TOTAL_COST = float(os.getenv("MAX_TOTAL_COST", "100"))      # 最大总交易成本（USDT）
-WAIT_BETWEEN_TRADES = int(os.getenv("WAIT_BETWEEN_TRADES", "4"))   # 交易间隔（秒）
+WAIT_BETWEEN_TRADES = float(os.getenv("WAIT_BETWEEN_TRADES", "4"))   # 交易间隔（秒）
 MAX_TRADES = int(os.getenv("MAX_TRADES", "100"))  # 最大交易次数
+PACING_MODE = os.getenv("PACING_MODE", "adaptive").lower()  # adaptive: 结算完成即开始下一笔，出错才退避；fixed: 固定间隔
+PACING_MIN_WAIT = float(os.getenv("PACING_MIN_WAIT", "0"))  # adaptive模式下两笔交易之间的最短间隔（秒）
+PACING_MAX_BACKOFF = float(os.getenv("PACING_MAX_BACKOFF", "60"))  # 出错或限流时的最长退避时间（秒）
+QUOTE_WATCH_TIMEOUT = float(os.getenv("QUOTE_WATCH_TIMEOUT", "10"))  # 成本超过上限时监视报价回落的最长时间（秒），0表示不监视
+QUOTE_WATCH_REFRESH_MS = int(os.getenv("QUOTE_WATCH_REFRESH_MS", "1000"))  # 监视期间多久没有新报价就重新点击ALL请求报价（毫秒）
+QUOTE_WATCH_WINDOW = int(os.getenv("QUOTE_WATCH_WINDOW", "100"))  # 保留的最近报价数
+TRADE_STATE_DEADLINES = os.getenv("TRADE_STATE_DEADLINES", "")  # 覆盖各交易状态的时限（秒），如 "confirm=30,settle=20"
+SUPERVISOR_STALL_SECONDS = float(os.getenv("SUPERVISOR_STALL_SECONDS", "120"))  # 多久没有状态转换视为卡死（秒），0表示关闭看门狗
+SUPERVISOR_MAX_FAILURES = int(os.getenv("SUPERVISOR_MAX_FAILURES", "6"))  # 连续多少次状态失败且没有完成交易时开始恢复
+SUPERVISOR_STEP_TIMEOUT = float(os.getenv("SUPERVISOR_STEP_TIMEOUT", "45"))  # 每个恢复步骤的时限（秒）
+PACING_WINDOW = int(os.getenv("PACING_WINDOW", "50"))  # 确认/就绪耗时的滚动统计样本数
+
+# 网络监听设置（从应用自身的请求和WebSocket消息中读取报价和交易状态）
+NETWORK_QUOTE_PATTERN = os.getenv("NETWORK_QUOTE_PATTERN", "")  # 报价接口URL匹配，留空表示不使用网络报价
+NETWORK_BALANCE_PATTERN = os.getenv("NETWORK_BALANCE_PATTERN", r"balance|portfolio")  # 余额接口URL匹配
+NETWORK_TX_PATTERN = os.getenv("NETWORK_TX_PATTERN", r"transaction|receipt|/tx\b")  # 交易状态接口URL匹配
+NETWORK_QUOTE_MAX_AGE = float(os.getenv("NETWORK_QUOTE_MAX_AGE", "3"))  # 网络报价的有效期（秒）
+# 网络和页面都读不到成本时使用的默认成本，留空表示视为不可交易
+COST_FALLBACK = float(os.getenv("COST_FALLBACK", "0.2")) if os.getenv("COST_FALLBACK", "0.2") else None
+
+# 截图设置（截图只保存在内存中，不再写入trade_status_N.png）
+SCREENSHOT_FORMAT = os.getenv("SCREENSHOT_FORMAT", "jpeg").lower()  # jpeg / webp / png
+SCREENSHOT_QUALITY = int(os.getenv("SCREENSHOT_QUALITY", "70"))  # JPEG/WebP初始质量
+SCREENSHOT_MAX_BYTES = int(os.getenv("SCREENSHOT_MAX_BYTES", "100000"))  # 单张截图大小上限（字节）
+SCREENSHOT_MAX_WIDTH = int(os.getenv("SCREENSHOT_MAX_WIDTH", "640"))  # 缩放后的最大宽度（像素）
+SCREENSHOT_RING_SIZE = int(os.getenv("SCREENSHOT_RING_SIZE", "5"))  # 保留最近几张截图用于调试
+SCREENSHOT_DEBUG_DIR = os.getenv("SCREENSHOT_DEBUG_DIR", "debug_frames")  # 出错时导出截图的目录
 
-# 交易日志
-transactions = []
+# 选择器策略设置（记录每个按钮各选择器的历史表现，下次优先使用最优策略）
+# 策略统计文件，留空则不保存；回放模式默认写在会话目录中，不影响真实运行的策略排序
+SELECTOR_STATS_FILE = os.getenv("SELECTOR_STATS_FILE", os.path.join(SESSION_DIR, "selector_stats.json") if SESSION_MODE == "replay" else "selector_stats.json")
+SELECTOR_FAST_TIMEOUT_MS = int(os.getenv("SELECTOR_FAST_TIMEOUT_MS", "500"))  # 历史最优策略的点击超时（毫秒）
+COMPOSITE_ACTIONS = os.getenv("COMPOSITE_ACTIONS", "1").lower() in ("1", "true", "yes")  # 在页面内一次完成切换方向、点击ALL和等待报价
+COMPOSITE_STEP_TIMEOUT_MS = int(os.getenv("COMPOSITE_STEP_TIMEOUT_MS", "2000"))  # 组合动作中每一步等待DOM变化的超时（毫秒）
+A11Y_EXTRACTION = os.getenv("A11Y_EXTRACTION", "1").lower() in ("1", "true", "yes")  # 页面状态读不到余额/成本/代币顺序时，先从无障碍树本地提取，再调用LLM
+ACTION_DEADLINE_MS = int(os.getenv("ACTION_DEADLINE_MS", "3000"))  # 单个UI动作（含所有备选策略）的总时限（毫秒）
+SELECTOR_DEMOTE_AFTER = int(os.getenv("SELECTOR_DEMOTE_AFTER", "3"))  # 连续失败几次后降级到末尾
+SELECTOR_STATS_SAVE_INTERVAL = float(os.getenv("SELECTOR_STATS_SAVE_INTERVAL", "10"))  # 统计写盘间隔（秒）
+
+# 交易日志（只追加的JSONL文件，重启后从中恢复累计成本和交易次数）
+# 回放模式默认写在会话目录中，回放的交易不计入真实运行的MAX_TRADES/MAX_TOTAL_COST
+TRADE_JOURNAL_FILE = os.getenv("TRADE_JOURNAL_FILE", os.path.join(SESSION_DIR, "trade_journal.jsonl") if SESSION_MODE == "replay" else "trade_journal.jsonl")
+JOURNAL_FSYNC_EVERY = int(os.getenv("JOURNAL_FSYNC_EVERY", "20"))  # 每写入N条记录fsync一次
+JOURNAL_FSYNC_INTERVAL = float(os.getenv("JOURNAL_FSYNC_INTERVAL", "5"))  # 最长fsync间隔（秒）
 total_cost = 0
 
-# 使用LLama4通过OpenRouter进行分析
-async def analyze_with_llm(screenshot_path, current_status):
-    try:
-        # 读取截图并编码为base64
-        with open(screenshot_path, "rb") as image_file:
-            encoded_image = base64.b64encode(image_file.read()).decode('utf-8')
-        
-        # 准备OpenRouter API请求
-        headers = {
-            "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-            "Content-Type": "application/json",
-            "HTTP-Referer": "http://localhost",  # OpenRouter要求的referer
-            "X-Title": "DeFi Trading Assistant"  # 应用名称
+# 性能指标设置
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 本地Prometheus文本指标端口，0表示不开启
+METRICS_FILE = os.getenv("METRICS_FILE", "")  # 定期写入统计的JSON文件，留空表示不写入
+METRICS_INTERVAL = float(os.getenv("METRICS_INTERVAL", "30"))  # 统计文件写入间隔（秒）
+METRICS_WINDOW = int(os.getenv("METRICS_WINDOW", "1024"))  # 每个阶段保留的耗时样本数
+
+class TradeMetrics:
+    """
+    交易循环各阶段的耗时统计
+    每个阶段只保留最近METRICS_WINDOW个样本，导出时才计算分位数，常驻开启的开销很小
+    """
+    QUANTILES = (0.5, 0.95, 0.99)
+    
+    def __init__(self, window):
+        self.window = window
+        self.samples = {}  # 阶段 -> 最近的耗时样本（毫秒）
+        self.counts = {}
+        self.sums = {}
+        self.selector_hits = {}  # (动作, 策略) -> 成功次数
+        self.transitions = {}  # (原状态, 新状态) -> 次数
+        self.trade_times = deque()
+        self.trades = 0
+        self.gauges = {}  # 名称 -> 最新值
+        self.started = time.monotonic()
+    
+    @contextmanager
+    def phase(self, name):
+        """统计一个阶段的耗时： with metrics.phase("confirm"): ..."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, (time.perf_counter() - started) * 1000)
+    
+    def observe(self, name, elapsed_ms):
+        samples = self.samples.get(name)
+        if samples is None:
+            samples = self.samples[name] = deque(maxlen=self.window)
+            self.counts[name] = 0
+            self.sums[name] = 0.0
+        samples.append(elapsed_ms)
+        self.counts[name] += 1
+        self.sums[name] += elapsed_ms
+    
+    def count_selector(self, action, strategy):
+        key = (action, strategy)
+        self.selector_hits[key] = self.selector_hits.get(key, 0) + 1
+    
+    def count_transition(self, from_state, to_state):
+        key = (from_state, to_state)
+        self.transitions[key] = self.transitions.get(key, 0) + 1
+    
+    def set_gauge(self, name, value):
+        self.gauges[name] = value
+    
+    def reset_clock(self):
+        """从开始交易的时刻起计算平均每分钟交易数"""
+        self.started = time.monotonic()
+    
+    def trade_completed(self):
+        now = time.monotonic()
+        self.trades += 1
+        self.trade_times.append(now)
+        while self.trade_times and now - self.trade_times[0] > 60:
+            self.trade_times.popleft()
+    
+    def trades_per_minute(self):
+        """最近60秒内完成的交易数"""
+        now = time.monotonic()
+        while self.trade_times and now - self.trade_times[0] > 60:
+            self.trade_times.popleft()
+        return len(self.trade_times)
+    
+    @staticmethod
+    def _quantile(sorted_values, q):
+        if not sorted_values:
+            return 0.0
+        index = min(int(q * len(sorted_values)), len(sorted_values) - 1)
+        return sorted_values[index]
+    
+    def snapshot(self):
+        phases = {}
+        for name, samples in self.samples.items():
+            values = sorted(samples)
+            phases[name] = {
+                "count": self.counts[name],
+                "avg_ms": round(self.sums[name] / self.counts[name], 1),
+                **{f"p{int(q * 100)}_ms": round(self._quantile(values, q), 1) for q in self.QUANTILES}
+            }
+        elapsed_minutes = (time.monotonic() - self.started) / 60
+        return {
+            "trades": self.trades,
+            "trades_per_minute": self.trades_per_minute(),
+            "trades_per_minute_overall": round(self.trades / elapsed_minutes, 2) if elapsed_minutes > 0 else 0.0,
+            "phases": phases,
+            "selector_hits": {f"{action}/{strategy}": count for (action, strategy), count in self.selector_hits.items()},
+            "transitions": {f"{from_state}->{to_state}": count for (from_state, to_state), count in self.transitions.items()},
+            "gauges": dict(self.gauges)
         }
-        
-        payload = {
-            "model": LLAMA4_MODEL,
-            "messages": [
-                {"role": "system", "content": "你是一个DeFi交易助手，帮助分析交易页面并提供决策建议。"},
-                {"role": "user", "content": [
-                    {"type": "text", "text": f"""
-                    分析这个DeFi交易页面截图，提取以下信息:
-                    1. 当前USDC和USDT余额
-                    2. 预计交易成本
-                    3. 预计获得的XP
-                    4. 是否建议执行交易（如果成本超过{MAX_COST_PER_TRADE} USDT，则不建议）
-                    
-                    当前状态: {current_status}
-                    """},
-                    {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{encoded_image}"}}
-                ]}
-            ]
+    
+    def prometheus_text(self):
+        """导出为Prometheus文本格式"""
+        lines = ["# TYPE defi_phase_latency_ms summary"]
+        for name, samples in self.samples.items():
+            values = sorted(samples)
+            for q in self.QUANTILES:
+                lines.append(f'defi_phase_latency_ms{{phase="{name}",quantile="{q}"}} {self._quantile(values, q):.1f}')
+            lines.append(f'defi_phase_latency_ms_sum{{phase="{name}"}} {self.sums[name]:.1f}')
+            lines.append(f'defi_phase_latency_ms_count{{phase="{name}"}} {self.counts[name]}')
+        lines.append("# TYPE defi_selector_hits_total counter")
+        for (action, strategy), count in self.selector_hits.items():
+            lines.append(f'defi_selector_hits_total{{action="{action}",strategy="{strategy}"}} {count}')
+        lines.append("# TYPE defi_state_transitions_total counter")
+        for (from_state, to_state), count in self.transitions.items():
+            lines.append(f'defi_state_transitions_total{{from="{from_state}",to="{to_state}"}} {count}')
+        lines.append("# TYPE defi_trades_total counter")
+        lines.append(f"defi_trades_total {self.trades}")
+        lines.append("# TYPE defi_trades_per_minute gauge")
+        lines.append(f"defi_trades_per_minute {self.trades_per_minute()}")
+        for name, value in self.gauges.items():
+            lines.append(f"# TYPE defi_{name} gauge")
+            lines.append(f"defi_{name} {value}")
+        return "\n".join(lines) + "\n"
+    
+    async def _handle_http(self, reader, writer):
+        try:
+            # 读取并忽略请求头，任何路径都返回指标
+            while True:
+                line = await reader.readline()
+                if not line or line in (b"\r\n", b"\n"):
+                    break
+            body = self.prometheus_text().encode("utf-8")
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/plain; version=0.0.4\r\n"
+                + f"Content-Length: {len(body)}\r\n".encode("ascii")
+                + b"Connection: close\r\n\r\n"
+                + body
+            )
+            await writer.drain()
+        except Exception:
+            pass
+        finally:
+            writer.close()
+    
+    async def start_exporters(self):
+        """按配置启动本地指标端口和定期统计文件，返回需要在退出时取消的对象"""
+        handles = []
+        if METRICS_PORT:
+            try:
+                server = await asyncio.start_server(self._handle_http, "127.0.0.1", METRICS_PORT)
+                handles.append(server)
+                print(f"指标已开放在 http://127.0.0.1:{METRICS_PORT}/metrics")
+            except OSError as e:
+                print(f"启动指标端口失败: {e}")
+        if METRICS_FILE:
+            handles.append(asyncio.ensure_future(self._write_file_periodically()))
+        return handles
+    
+    def write_file(self):
+        try:
+            tmp_path = f"{METRICS_FILE}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.snapshot(), f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, METRICS_FILE)
+        except Exception as e:
+            print(f"写入统计文件失败: {e}")
+    
+    async def _write_file_periodically(self):
+        while True:
+            await asyncio.sleep(METRICS_INTERVAL)
+            self.write_file()
+
+async def stop_metrics_exporters(handles):
+    for handle in handles:
+        if isinstance(handle, asyncio.Future):
+            handle.cancel()
+        else:
+            handle.close()
+    if METRICS_FILE:
+        metrics.write_file()
+
+metrics = TradeMetrics(METRICS_WINDOW)
+
+# OpenRouter连接池（复用keep-alive连接，避免每次分析都重新握手）
+_llm_session = None
+_llm_semaphore = None
+
+def get_llm_session():
+    """获取共享的OpenRouter会话，首次调用时创建连接池"""
+    global _llm_session, _llm_semaphore
+    if _llm_session is None or _llm_session.closed:
+        timeout = aiohttp.ClientTimeout(
+            total=None,
+            sock_connect=LLM_CONNECT_TIMEOUT,
+            sock_read=LLM_READ_TIMEOUT
+        )
+        connector = aiohttp.TCPConnector(limit=LLM_MAX_CONCURRENCY, keepalive_timeout=60)
+        _llm_session = aiohttp.ClientSession(
+            timeout=timeout,
+            connector=connector,
+            headers={
+                "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+                "Content-Type": "application/json",
+                "HTTP-Referer": "http://localhost",  # OpenRouter要求的referer
+                "X-Title": "DeFi Trading Assistant"  # 应用名称
+            }
+        )
+        _llm_semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+    return _llm_session
+
+async def close_llm_session():
+    """关闭共享的OpenRouter会话"""
+    global _llm_session
+    if _llm_session is not None and not _llm_session.closed:
+        await _llm_session.close()
+    _llm_session = None
+
+def perceptual_hash(image_bytes):
+    """
+    计算截图的感知哈希（dHash，64位）
+    返回 (哈希类型, 哈希值)；没有Pillow时退化为内容哈希，只能匹配完全相同的截图
+    """
+    if Image is None:
+        digest = hashlib.sha1(image_bytes).digest()
+        return "sha1", int.from_bytes(digest[:8], "big")
+    image = Image.open(io.BytesIO(image_bytes)).convert("L").resize((9, 8))
+    pixels = list(image.getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            value = (value << 1) | (1 if left > right else 0)
+    return "dhash", value
+
+class LLMAnalysisCache:
+    """
+    LLM分析结果缓存
+    按截图感知哈希 + 状态提示词匹配，支持相似度阈值、TTL过期和LRU淘汰
+    """
+    def __init__(self, max_entries, ttl, max_distance):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self.entries = OrderedDict()  # (提示词, 哈希类型, 哈希值) -> (结果, 写入时间)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+    
+    def get(self, image_hash, prompt):
+        """查找相似截图的分析结果，未命中返回None"""
+        if self.max_entries <= 0:
+            return None
+        now = time.monotonic()
+        kind, value = image_hash
+        for key in list(self.entries.keys()):
+            result, created_at = self.entries[key]
+            if now - created_at > self.ttl:
+                del self.entries[key]
+                self.expirations += 1
+                continue
+            key_prompt, key_kind, key_value = key
+            if key_prompt != prompt or key_kind != kind:
+                continue
+            # 内容哈希只接受完全相同的截图
+            max_distance = self.max_distance if kind == "dhash" else 0
+            if bin(key_value ^ value).count("1") <= max_distance:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return result
+        self.misses += 1
+        return None
+    
+    def put(self, image_hash, prompt, result):
+        if self.max_entries <= 0:
+            return
+        key = (prompt, image_hash[0], image_hash[1])
+        self.entries[key] = (result, time.monotonic())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+    
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "entries": len(self.entries)
+        }
+
+llm_cache = LLMAnalysisCache(LLM_CACHE_SIZE, LLM_CACHE_TTL, LLM_CACHE_MAX_DISTANCE)
+
+class LLMRequestError(Exception):
+    """OpenRouter请求失败（非200响应），retry_after是服务端要求的等待秒数"""
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+# 要求模型返回的严格JSON结构
+ANALYSIS_JSON_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "balances": {
+            "type": "object",
+            "properties": {
+                "USDC": {"type": ["number", "null"]},
+                "USDT": {"type": ["number", "null"]}
+            },
+            "required": ["USDC", "USDT"],
+            "additionalProperties": False
+        },
+        "cost": {"type": ["number", "null"]},
+        "xp": {"type": ["number", "null"]},
+        "recommendation": {"type": "string", "enum": ["trade", "skip"]},
+        "reason": {"type": "string"}
+    },
+    "required": ["balances", "cost", "xp", "recommendation", "reason"],
+    "additionalProperties": False
+}
+
+def _optional_number(value, field):
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError(f"字段 {field} 不是数字: {value!r}")
+    return float(value)
+
+def parse_llm_analysis(text):
+    """
+    解析并校验模型返回的JSON分析结果
+    返回 {"balances", "cost", "xp", "recommendation", "reason"}，格式不符时抛出ValueError
+    """
+    # 兼容模型把JSON包在```代码块或多余文字中的情况
+    start = text.find("{")
+    end = text.rfind("}")
+    if start == -1 or end <= start:
+        raise ValueError("回复中没有JSON对象")
+    data = json.loads(text[start:end + 1])
+    if not isinstance(data, dict):
+        raise ValueError("回复不是JSON对象")
+    
+    balances = data.get("balances")
+    if not isinstance(balances, dict):
+        raise ValueError("缺少balances字段")
+    recommendation = data.get("recommendation")
+    if recommendation not in ("trade", "skip"):
+        raise ValueError(f"recommendation取值无效: {recommendation!r}")
+    reason = data.get("reason", "")
+    if not isinstance(reason, str):
+        raise ValueError("reason不是字符串")
+    
+    return {
+        "balances": {
+            "USDC": _optional_number(balances.get("USDC"), "balances.USDC"),
+            "USDT": _optional_number(balances.get("USDT"), "balances.USDT")
+        },
+        "cost": _optional_number(data.get("cost"), "cost"),
+        "xp": _optional_number(data.get("xp"), "xp"),
+        "recommendation": recommendation,
+        "reason": reason
+    }
+
+async def _request_llm_analysis(model, encoded_image, current_status, mime_type):
+    """向OpenRouter的指定模型发送一次截图分析请求，返回校验后的结构化结果，失败时抛出异常"""
+    payload = {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": "你是一个DeFi交易助手，帮助分析交易页面并提供决策建议。只输出JSON，不要输出其他文字。"},
+            {"role": "user", "content": [
+                {"type": "text", "text": f"""
+                分析这个DeFi交易页面截图，提取以下信息:
+                1. 当前USDC和USDT余额 (balances)
+                2. 预计交易成本，单位USDT (cost)
+                3. 预计获得的XP (xp)
+                4. 是否建议执行交易 (recommendation: "trade" 或 "skip"，如果成本超过{runtime_config.current.max_cost_per_trade} USDT，则为"skip")
+                5. 简短理由 (reason)
+                无法识别的数字填null。
+                
+                按以下JSON Schema返回:
+                {json.dumps(ANALYSIS_JSON_SCHEMA, ensure_ascii=False)}
+                
+                当前状态: {current_status}
+                """},
+                {"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{encoded_image}"}}
+            ]}
+        ],
+        "response_format": {
+            "type": "json_schema",
+            "json_schema": {"name": "swap_analysis", "strict": True, "schema": ANALYSIS_JSON_SCHEMA}
         }
+    }
+    
+    # 发送请求到OpenRouter（连接池 + 并发上限，取消时立即释放连接）
+    session = get_llm_session()
+    async with _llm_semaphore:
+        async with session.post(OPENROUTER_API_URL, json=payload) as response:
+            if response.status != 200:
+                text = await response.text()
+                raise LLMRequestError(
+                    f"{response.status} - {text}",
+                    response.status,
+                    parse_retry_after(response.headers.get("Retry-After"))
+                )
+            result = await response.json()
+            content = result["choices"][0]["message"]["content"]
+    return parse_llm_analysis(content)
+
+class LLMUnavailableError(Exception):
+    """所有模型都处于熔断状态或都请求失败"""
+
+def parse_retry_after(value):
+    """解析Retry-After响应头（秒数或HTTP日期），返回需要等待的秒数，无法解析时返回None"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max((when - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+class CircuitBreaker:
+    """
+    单个模型的熔断器
+    closed: 正常放行；连续失败failure_threshold次或服务端返回Retry-After时进入open，冷却期内直接拒绝；
+    冷却结束后进入half_open，只放行一个试探请求，成功则回到closed，失败则重新熔断且冷却时间加倍（最多8倍）
+    """
+    def __init__(self, failure_threshold, cooldown):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0  # 连续失败次数
+        self.trips = 0  # 连续熔断次数
+        self.open_until = 0.0
+        self.probing = False
+    
+    def allow(self):
+        if self.state == "open":
+            if time.monotonic() < self.open_until:
+                return False
+            self.state = "half_open"
+        if self.state == "half_open":
+            if self.probing:
+                return False
+            self.probing = True
+        return True
+    
+    def is_open(self):
+        return self.state == "open" and time.monotonic() < self.open_until
+    
+    def retry_in(self):
+        return max(self.open_until - time.monotonic(), 0.0) if self.state == "open" else 0.0
+    
+    def release(self):
+        """请求被取消，没有结果：释放试探名额，不计入成功或失败"""
+        self.probing = False
+    
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+        self.trips = 0
+        self.probing = False
+    
+    def record_failure(self, retry_after=None):
+        self.failures += 1
+        self.probing = False
+        threshold_reached = self.failure_threshold > 0 and self.failures >= self.failure_threshold
+        if self.state == "half_open" or threshold_reached or retry_after is not None:
+            self.trips += 1
+            delay = self.cooldown * 2 ** min(self.trips - 1, 3)
+            self.state = "open"
+            self.open_until = time.monotonic() + max(delay, retry_after or 0.0)
+
+@dataclass
+class LLMModelStats:
+    """单个模型的请求统计（耗时记录在metrics的llm:<模型>阶段）"""
+    requests: int = 0
+    successes: int = 0
+    failures: int = 0
+    rejected: int = 0  # 熔断期间直接跳过的次数
+    last_error: Optional[str] = None
+
+class LLMGateway:
+    """
+    OpenRouter分析入口：按顺序尝试主模型（LLM_MODEL，可热加载）和LLM_FALLBACK_MODELS
+    每个模型有独立的熔断器和统计；整条链共用一个时限，熔断中的模型不发请求，
+    提供方故障时分析立即失败，不会拖慢交易循环
+    """
+    def __init__(self, fallback_models, failure_threshold, cooldown, budget):
+        self.fallback_models = fallback_models
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.budget = budget
+        self.breakers = {}
+        self.stats = {}
+    
+    def models(self):
+        return list(dict.fromkeys([runtime_config.current.llm_model, *self.fallback_models]))
+    
+    def _breaker(self, model):
+        breaker = self.breakers.get(model)
+        if breaker is None:
+            breaker = self.breakers[model] = CircuitBreaker(self.failure_threshold, self.cooldown)
+            self.stats[model] = LLMModelStats()
+        return breaker
+    
+    def available(self):
+        """至少有一个模型没有处于熔断冷却期"""
+        return any(not self._breaker(model).is_open() for model in self.models())
+    
+    def _update_gauge(self):
+        metrics.set_gauge("llm_open_breakers", sum(1 for breaker in self.breakers.values() if breaker.is_open()))
+    
+    async def analyze(self, encoded_image, current_status, mime_type):
+        """返回第一个成功模型的分析结果，全部不可用时抛出LLMUnavailableError"""
+        deadline = time.monotonic() + self.budget
+        errors = []
+        for model in self.models():
+            breaker = self._breaker(model)
+            stats = self.stats[model]
+            if not breaker.allow():
+                stats.rejected += 1
+                errors.append(f"{model} 熔断中，{breaker.retry_in():.0f}秒后重试")
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                breaker.release()
+                errors.append("超出分析时限")
+                break
+            stats.requests += 1
+            started = time.perf_counter()
+            try:
+                analysis = await asyncio.wait_for(
+                    _request_llm_analysis(model, encoded_image, current_status, mime_type), remaining
+                )
+            except asyncio.CancelledError:
+                breaker.release()
+                raise
+            except Exception as e:
+                reason = str(e) or type(e).__name__
+                stats.failures += 1
+                stats.last_error = reason[:200]
+                breaker.record_failure(getattr(e, "retry_after", None))
+                if breaker.is_open():
+                    print(f"LLM模型 {model} 熔断 {breaker.retry_in():.0f} 秒: {stats.last_error}")
+                    self._update_gauge()
+                errors.append(f"{model}: {stats.last_error}")
+                continue
+            finally:
+                metrics.observe(f"llm:{model}", (time.perf_counter() - started) * 1000)
+            if breaker.state == "half_open":
+                print(f"LLM模型 {model} 已恢复")
+            breaker.record_success()
+            stats.successes += 1
+            self._update_gauge()
+            return analysis
+        raise LLMUnavailableError("; ".join(errors))
+    
+    def summary(self):
+        """每个模型一行统计"""
+        lines = []
+        for model, stats in self.stats.items():
+            breaker = self.breakers[model]
+            latency = metrics.snapshot()["phases"].get(f"llm:{model}")
+            latency_text = f", p50 {latency['p50_ms']}ms / p95 {latency['p95_ms']}ms" if latency else ""
+            lines.append(
+                f"{model}: 请求 {stats.requests} 次, 成功 {stats.successes} 次, 失败 {stats.failures} 次, "
+                f"熔断跳过 {stats.rejected} 次, 状态 {breaker.state}{latency_text}"
+            )
+        return lines
+
+llm_gateway = LLMGateway(
+    LLM_FALLBACK_MODELS, LLM_BREAKER_FAILURES, LLM_BREAKER_COOLDOWN, LLM_CONNECT_TIMEOUT + LLM_READ_TIMEOUT
+)
+
+# 通过OpenRouter进行分析（主模型失败或熔断时使用备用模型）
+async def analyze_with_llm(image, current_status, mime_type="image/png"):
+    """
+    分析交易页面截图，返回结构化结果字典，失败时返回None
+    image 可以是内存中的图片字节，也可以是截图文件路径
+    与缓存中相似截图（相同提示词）的结果会直接复用，不再请求模型
+    """
+    try:
+        loop = asyncio.get_event_loop()
+        if isinstance(image, (bytes, bytearray)):
+            image_bytes = bytes(image)
+        else:
+            # 读取截图文件（放到线程池中，避免阻塞事件循环）
+            image_bytes = await loop.run_in_executor(None, _read_file_bytes, image)
         
-        # 发送请求到OpenRouter
-        response = requests.post(
-            "https://openrouter.ai/api/v1/chat/completions",
-            headers=headers,
-            json=payload
-        )
+        image_hash = await loop.run_in_executor(None, perceptual_hash, image_bytes)
+        cached = llm_cache.get(image_hash, current_status)
+        if cached is not None:
+            return cached
         
-        if response.status_code == 200:
-            result = response.json()
-            return result["choices"][0]["message"]["content"]
-        else:
-            print(f"API请求错误: {response.status_code} - {response.text}")
-            return "API请求失败，无法分析截图。"
+        encoded_image = base64.b64encode(image_bytes).decode('utf-8')
+        with metrics.phase("llm"):
+            analysis = await llm_gateway.analyze(encoded_image, current_status, mime_type)
+        llm_cache.put(image_hash, current_status, analysis)
+        return analysis
+    except asyncio.CancelledError:
+        raise
+    except LLMUnavailableError as e:
+        print(f"LLM分析不可用: {e}")
     except Exception as e:
         print(f"LLM分析错误: {e}")
-        return "无法分析，请手动检查。"
+    return None
+
+def format_llm_analysis(analysis):
+    """把结构化分析结果格式化为一行日志"""
+    balances = analysis["balances"]
+    return (f"USDC余额: {balances['USDC']}, USDT余额: {balances['USDT']}, "
+            f"成本: {analysis['cost']}, XP: {analysis['xp']}, "
+            f"建议: {analysis['recommendation']} ({analysis['reason']})")
+
+class AnalysisState:
+    """
+    最新的LLM分析结果
+    分析在后台任务中运行，交易循环随时读取latest而不需要等待模型
+    """
+    def __init__(self):
+        self.latest = None
+        self.updated_at = 0.0
+        self.trade_count = None
+        self.task = None
+        self.skipped = 0
+    
+    def is_busy(self):
+        return self.task is not None and not self.task.done()
+    
+    def age(self):
+        return time.monotonic() - self.updated_at if self.latest else float("inf")
+    
+    def fresh(self, max_age=LLM_ANALYSIS_MAX_AGE):
+        """返回未过期的最新结果，没有则返回None"""
+        return self.latest if self.age() <= max_age else None
+    
+    def publish(self, analysis, trade_count=None):
+        self.latest = analysis
+        self.updated_at = time.monotonic()
+        self.trade_count = trade_count
+    
+    def schedule(self, image, current_status, mime_type, trade_count):
+        """在后台启动一次分析；上一次分析仍在进行时跳过，避免请求堆积"""
+        if self.is_busy():
+            self.skipped += 1
+            return False
+        self.task = asyncio.ensure_future(self._run(image, current_status, mime_type, trade_count))
+        return True
+    
+    async def _run(self, image, current_status, mime_type, trade_count):
+        analysis = await analyze_with_llm(image, current_status, mime_type)
+        if analysis is not None:
+            self.publish(analysis, trade_count)
+            print(f"--- LLM分析 (第 {trade_count+1} 次交易) --- {format_llm_analysis(analysis)}")
+    
+    def cancel(self):
+        if self.is_busy():
+            self.task.cancel()
+
+analysis_state = AnalysisState()
+
+def _read_file_bytes(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+# 最近截图的环形缓冲区，只在出错时导出到磁盘
+_screenshot_ring = deque(maxlen=max(SCREENSHOT_RING_SIZE, 1))
+
+# 查找Swap卡片区域：从Swap按钮向上找到同时包含反转按钮的容器
+SWAP_CARD_CLIP_JS = """
+() => {
+    const swap = document.querySelector('button[data-testid="swap-swap-button"], #swap-swap-button');
+    const reverse = document.querySelector('.lucide-arrow-up-down');
+    let card = swap;
+    while (card && card.parentElement && !(reverse && card.contains(reverse))) {
+        card = card.parentElement;
+    }
+    if (!card || card === document.body || card === document.documentElement) {
+        return null;
+    }
+    const rect = card.getBoundingClientRect();
+    const pad = 8;
+    const x = Math.max(rect.left - pad, 0);
+    const y = Math.max(rect.top - pad, 0);
+    const width = Math.min(rect.width + pad * 2, window.innerWidth - x);
+    const height = Math.min(rect.height + pad * 2, window.innerHeight - y);
+    if (width <= 0 || height <= 0) {
+        return null;
+    }
+    return {x, y, width, height};
+}
+"""
+
+def _encode_screenshot(png_bytes, fmt, quality, max_width, max_bytes):
+    """使用Pillow缩放并压缩截图，逐步降低质量直到满足大小上限"""
+    image = Image.open(io.BytesIO(png_bytes))
+    if image.width > max_width:
+        height = int(image.height * max_width / image.width)
+        image = image.resize((max_width, max(height, 1)))
+    if fmt == "png":
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG", optimize=True)
+        return buffer.getvalue(), "image/png"
+    image = image.convert("RGB")
+    pil_format = "WEBP" if fmt == "webp" else "JPEG"
+    data = b""
+    while True:
+        buffer = io.BytesIO()
+        image.save(buffer, format=pil_format, quality=quality)
+        data = buffer.getvalue()
+        if len(data) <= max_bytes or quality <= 30:
+            break
+        quality -= 15
+    return data, f"image/{fmt}"
+
+async def capture_swap_screenshot(page, label="trade"):
+    """
+    截取Swap卡片区域到内存，返回 (图片字节, MIME类型)
+    截图不会写入磁盘，只保留在最近截图的环形缓冲区中
+    """
+    try:
+        clip = await page.evaluate(SWAP_CARD_CLIP_JS)
+    except Exception:
+        clip = None
+    options = {"scale": "css"}
+    if clip:
+        options["clip"] = clip
+    
+    fmt = SCREENSHOT_FORMAT if SCREENSHOT_FORMAT in ("jpeg", "webp", "png") else "jpeg"
+    if Image is not None:
+        # 截取无损PNG后在线程池中缩放和编码，避免阻塞事件循环
+        png_bytes = await page.screenshot(type="png", **options)
+        loop = asyncio.get_event_loop()
+        data, mime_type = await loop.run_in_executor(
+            None, _encode_screenshot, png_bytes, fmt, SCREENSHOT_QUALITY, SCREENSHOT_MAX_WIDTH, SCREENSHOT_MAX_BYTES
+        )
+    elif fmt == "png":
+        data = await page.screenshot(type="png", **options)
+        mime_type = "image/png"
+    else:
+        # 没有Pillow时由浏览器直接编码JPEG（不支持WebP）
+        quality = SCREENSHOT_QUALITY
+        while True:
+            data = await page.screenshot(type="jpeg", quality=quality, **options)
+            if len(data) <= SCREENSHOT_MAX_BYTES or quality <= 30:
+                break
+            quality -= 15
+        mime_type = "image/jpeg"
+    
+    _screenshot_ring.append({
+        "time": datetime.now().strftime("%Y%m%d_%H%M%S"),
+        "label": label,
+        "data": data,
+        "mime_type": mime_type
+    })
+    return data, mime_type
+
+def dump_screenshot_ring(reason=""):
+    """将环形缓冲区中的最近截图导出到调试目录（文件名固定，磁盘占用有上限）"""
+    if not _screenshot_ring:
+        return
+    try:
+        os.makedirs(SCREENSHOT_DEBUG_DIR, exist_ok=True)
+        for index, frame in enumerate(_screenshot_ring):
+            extension = frame["mime_type"].split("/")[-1]
+            path = os.path.join(SCREENSHOT_DEBUG_DIR, f"frame_{index}.{extension}")
+            with open(path, "wb") as f:
+                f.write(frame["data"])
+        print(f"已导出最近 {len(_screenshot_ring)} 张截图到 {SCREENSHOT_DEBUG_DIR} {reason}")
+    except Exception as e:
+        print(f"导出调试截图失败: {e}")
+
+@dataclass
+class ButtonState:
+    """按钮是否存在以及是否可点击"""
+    present: bool = False
+    enabled: bool = False
+
+@dataclass
+class SwapPageState:
+    """一次页面读取得到的Swap卡片完整状态"""
+    from_token: Optional[str] = None
+    to_token: Optional[str] = None
+    balances: Dict[str, float] = field(default_factory=dict)
+    cost: Optional[float] = None
+    all_button: ButtonState = field(default_factory=ButtonState)
+    swap_button: ButtonState = field(default_factory=ButtonState)
+    reverse_button: ButtonState = field(default_factory=ButtonState)
+    toast: Optional[str] = None
+    wallet_connected: bool = False
+    error: Optional[str] = None
+    
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            from_token=data.get("from_token"),
+            to_token=data.get("to_token"),
+            balances={token: float(amount) for token, amount in (data.get("balances") or {}).items()},
+            cost=data.get("cost"),
+            all_button=ButtonState(**data.get("all_button", {})),
+            swap_button=ButtonState(**data.get("swap_button", {})),
+            reverse_button=ButtonState(**data.get("reverse_button", {})),
+            toast=data.get("toast"),
+            wallet_connected=bool(data.get("wallet_connected")),
+            error=data.get("error")
+        )
+    
+    def has_direction(self):
+        return self.from_token is not None and self.to_token is not None
+    
+    def direction_is(self, from_token, to_token):
+        return self.from_token == from_token and self.to_token == to_token
+    
+    def swap_blocked(self):
+        """Swap按钮存在但不可点击（通常是余额不足或报价未就绪）"""
+        return self.swap_button.present and not self.swap_button.enabled
+
+# 在页面内一次性读取代币顺序、余额、成本和按钮状态
+# 只遍历Swap卡片（缓存在window.__defiSwapCard）和通知区域，用textContent读取文本，不触发页面布局
+NOTICE_SELECTOR = '[role="status"], [role="alert"], [aria-live], [data-sonner-toaster], .Toastify, [class*="toast"]'
+SWAP_STATE_JS = """
+() => {
+    const NOTICE_SELECTOR = '%s';
+    const buttonState = (button) => ({
+        present: !!button,
+        enabled: !!button && !button.disabled && button.getAttribute('aria-disabled') !== 'true'
+    });
+    const parseNumber = (text) => parseFloat(text.replace(/,/g, ''));
+    // 不读取样式和布局，只按属性和内联样式判断隐藏
+    const isHidden = (element) => !!element.closest(
+        '[hidden], [aria-hidden="true"], [style*="display: none"], [style*="display:none"]'
+    );
+    
+    const swapButton = document.querySelector('button[data-testid="swap-swap-button"], #swap-swap-button');
+    const reverseIcon = document.querySelector('.lucide-arrow-up-down');
+    const reverseButton = (reverseIcon && reverseIcon.closest('button'))
+        || document.querySelector('button[data-testid="swap-switch-tokens-button"]');
+    const allButton = Array.from(document.querySelectorAll('button'))
+        .find(button => /^(ALL|MAX)$/.test(button.textContent.trim()));
+    
+    // Swap卡片：包含Swap/反转/ALL按钮且同时出现两个代币名的最小祖先元素；找不到时遍历整个body
+    const anchors = [swapButton, reverseButton, allButton].filter(Boolean);
+    let card = window.__defiSwapCard;
+    if (!card || !card.isConnected || !anchors.every(anchor => card.contains(anchor))) {
+        card = null;
+        let candidate = anchors[0] || null;
+        while (candidate && candidate !== document.body) {
+            const text = candidate.textContent;
+            if (anchors.every(anchor => candidate.contains(anchor)) && text.includes('USDC') && text.includes('USDT')) {
+                card = candidate;
+                break;
+            }
+            candidate = candidate.parentElement;
+        }
+        window.__defiSwapCard = card;
+    }
+    
+    const exactTokens = [];
+    const looseTokens = [];
+    const balances = {};
+    const texts = [];
+    let cost = null;
+    
+    const walker = document.createTreeWalker(card || document.body, NodeFilter.SHOW_TEXT);
+    while (walker.nextNode()) {
+        const text = walker.currentNode.nodeValue.trim();
+        const element = walker.currentNode.parentElement;
+        if (!text || !element || ['SCRIPT', 'STYLE', 'NOSCRIPT'].includes(element.tagName)) {
+            continue;
+        }
+        if (!isHidden(element)) {
+            texts.push(text);
+        }
+        // 代币选择框里的文本只有代币名；其他包含代币名的文本作为备选
+        const tokenMatch = text.match(/USDC|USDT/);
+        if (tokenMatch) {
+            if (text === 'USDC' || text === 'USDT') {
+                exactTokens.push(text);
+            } else {
+                looseTokens.push(tokenMatch[0]);
+            }
+        }
+        // 余额文本可能被拆成多个节点，向上取两层拼接后的文本
+        if (text.includes('Balance')) {
+            let container = element;
+            for (let i = 0; i < 2 && container; i++) {
+                const balanceMatch = container.textContent.match(/Balance:\\s*([0-9][0-9.,]*)\\s*(USDC|USDT)/);
+                if (balanceMatch) {
+                    balances[balanceMatch[2]] = parseNumber(balanceMatch[1]);
+                    break;
+                }
+                container = container.parentElement;
+            }
+        }
+        // Cost标签的下一个兄弟元素是成本数值
+        if (cost === null && text === 'Cost' && element.nextElementSibling) {
+            const costMatch = element.nextElementSibling.textContent.match(/\\$?(\\d+\\.\\d+)/);
+            if (costMatch) {
+                cost = parseFloat(costMatch[1]);
+            }
+        }
+        if (cost === null && text.startsWith('Cost')) {
+            const costMatch = text.match(/Cost.+\\$(\\d+\\.\\d+)/);
+            if (costMatch) {
+                cost = parseFloat(costMatch[1]);
+            }
+        }
+    }
+    
+    // 通知和错误提示通常渲染在卡片外的通知区域
+    const noticeText = texts.join(' ') + ' ' + Array.from(document.querySelectorAll(NOTICE_SELECTOR))
+        .filter(element => !isHidden(element))
+        .map(element => element.textContent).join(' ');
+    const tokens = exactTokens.length >= 2 ? exactTokens : exactTokens.concat(looseTokens);
+    const toastMatch = noticeText.match(/Transaction (Submitted|Confirmed)/);
+    const errorMatch = noticeText.match(
+        /Too many requests|Rate limit(ed)?|Try again later|Transaction (Failed|Rejected|Reverted)|Something went wrong/i
+    );
+    // 钱包已连接：页面显示钱包地址，或者Swap按钮存在且没有Connect按钮
+    const walletAddress = Array.from(document.querySelectorAll('[data-testid*="wallet"], [data-testid*="account"], button'))
+        .some(element => /^0x[0-9a-fA-F]{2,}/.test(element.textContent.trim()));
+    const connectButton = Array.from(document.querySelectorAll('button'))
+        .some(button => /^Connect( Wallet)?$/i.test(button.textContent.trim()));
+    
+    return {
+        from_token: tokens.length >= 2 ? tokens[0] : null,
+        to_token: tokens.length >= 2 ? tokens[1] : null,
+        balances,
+        cost,
+        all_button: buttonState(allButton),
+        swap_button: buttonState(swapButton),
+        reverse_button: buttonState(reverseButton),
+        toast: toastMatch ? toastMatch[0] : null,
+        wallet_connected: walletAddress || (!!swapButton && !connectButton),
+        error: errorMatch ? errorMatch[0] : null
+    };
+}
+""" % NOTICE_SELECTOR
 
-async def extract_cost_from_page(page):
+async def read_swap_page_state(page):
+    """一次往返读取Swap卡片状态，读取失败时返回None"""
     try:
-        # 尝试找到Cost区域
-        cost_text = await page.locator("text=Cost").first.text_content()
-        cost_element = await page.locator("text=Cost").first.evaluate("el => el.nextElementSibling ? el.nextElementSibling.textContent : null")
-        if cost_element:
-            cost_match = re.search(r"\$?(\d+\.\d+)", cost_element)
-            if cost_match:
-                return float(cost_match.group(1))
+        return SwapPageState.from_dict(await page.evaluate(SWAP_STATE_JS))
     except Exception as e:
-        print(f"从Cost标签提取成本失败: {e}")
+        print(f"读取页面状态失败: {e}")
+        return None
+
+# 注入页面的MutationObserver：DOM变化后重新读取Swap卡片状态，有变化时推送给Python
+READINESS_INIT_JS = """
+(() => {
+    if (window.__defiReadinessInstalled) {
+        return;
+    }
+    window.__defiReadinessInstalled = true;
+    const NOTICE_SELECTOR = '%s';
+    const readState = (%s);
+    let scheduled = false;
+    let lastSerialized = null;
+    const publish = () => {
+        scheduled = false;
+        let state;
+        try {
+            state = readState();
+        } catch (e) {
+            return;
+        }
+        const serialized = JSON.stringify(state);
+        if (serialized === lastSerialized) {
+            return;
+        }
+        lastSerialized = serialized;
+        if (window.__defiPageChanged) {
+            window.__defiPageChanged(state);
+        }
+    };
+    // 合并短时间内的多次变化：第一次变化后30毫秒读取，之后每%d毫秒最多读取一次
+    let lastPublished = 0;
+    const schedule = () => {
+        if (!scheduled) {
+            scheduled = true;
+            setTimeout(() => {
+                lastPublished = performance.now();
+                publish();
+            }, Math.max(30, lastPublished + %d - performance.now()));
+        }
+    };
+    // 只关心Swap卡片和通知区域内的变化；还没找到卡片时任何变化都要读取
+    const isRelevant = (record) => {
+        const card = window.__defiSwapCard;
+        if (!card || !card.isConnected) {
+            return true;
+        }
+        const target = record.target.nodeType === Node.ELEMENT_NODE ? record.target : record.target.parentElement;
+        if (!target) {
+            return false;
+        }
+        if (card.contains(target) || target.closest(NOTICE_SELECTOR)) {
+            return true;
+        }
+        return Array.from(record.addedNodes).some(node => node.nodeType === Node.ELEMENT_NODE
+            && (node.matches(NOTICE_SELECTOR) || node.querySelector(NOTICE_SELECTOR)));
+    };
+    const start = () => {
+        new MutationObserver(records => {
+            if (!scheduled && records.some(isRelevant)) {
+                schedule();
+            }
+        }).observe(document, {
+            subtree: true,
+            childList: true,
+            characterData: true,
+            attributes: true
+        });
+        schedule();
+    };
+    if (document.readyState === 'loading') {
+        document.addEventListener('DOMContentLoaded', start);
+    } else {
+        start();
+    }
+})()
+""" % (NOTICE_SELECTOR, SWAP_STATE_JS.strip(), READINESS_THROTTLE_MS, READINESS_THROTTLE_MS)
+
+class PageReadiness:
+    """
+    页面就绪状态
+    页面内的MutationObserver通过expose_binding推送最新的SwapPageState，
+    交易循环可以等待具体条件（成本更新、方向切换、出现通知、按钮可用），条件满足立即继续
+    """
+    def __init__(self):
+        self.state = None
+        self.version = 0
+        self.quote_seq = 0  # 成本出现或变为新值的次数（旧成本仍显示时不算新报价）
+        self.toast_seq = 0  # 交易通知出现或变为新文本的次数
+        self.error_seq = 0  # 错误提示出现或变为新文本的次数（一直显示的同一条提示只算一次）
+        self.waiters = []
+        self.listeners = []
+    
+    def add_listener(self, listener):
+        """每次页面状态变化时调用listener(state)"""
+        self.listeners.append(listener)
+    
+    async def install(self, page):
+        """注册绑定并注入观察脚本，之后每次导航都会自动重新注入"""
+        await page.expose_binding("__defiPageChanged", self._on_change)
+        await page.add_init_script(READINESS_INIT_JS)
+        # 主框架导航后旧页面的状态失效，等待新页面重新推送
+        page.on("framenavigated", lambda frame: self._on_navigated(page, frame))
+        try:
+            await page.evaluate(READINESS_INIT_JS)
+        except Exception:
+            pass
+    
+    def _on_navigated(self, page, frame):
+        if frame == page.main_frame:
+            self.state = None
+    
+    def _on_change(self, source, data):
+        previous = self.state
+        try:
+            self.state = SwapPageState.from_dict(data)
+        except Exception:
+            return
+        self.version += 1
+        if self.state.cost is not None and (previous is None or previous.cost != self.state.cost):
+            self.quote_seq += 1
+        if self.state.toast is not None and (previous is None or previous.toast != self.state.toast):
+            self.toast_seq += 1
+        if self.state.error and (previous is None or previous.error != self.state.error):
+            self.error_seq += 1
+        for listener in self.listeners:
+            listener(self.state)
+        for waiter in list(self.waiters):
+            predicate, future = waiter
+            if not future.done() and predicate(self.state):
+                future.set_result(self.state)
+    
+    async def wait_for(self, predicate, timeout, description="页面更新"):
+        """等待条件满足并返回当时的页面状态，超时返回None"""
+        if self.state is not None and predicate(self.state):
+            return self.state
+        future = asyncio.get_event_loop().create_future()
+        waiter = (predicate, future)
+        self.waiters.append(waiter)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            print(f"等待{description}超时 ({timeout}秒)")
+            return None
+        finally:
+            self.waiters.remove(waiter)
+    
+    async def wait_for_direction(self, from_token, to_token, timeout):
+        return await self.wait_for(
+            lambda state: state.direction_is(from_token, to_token), timeout, f"方向切换为 {from_token}->{to_token}"
+        )
+    
+    async def wait_for_cost_update(self, timeout, since_seq=None):
+        """
+        等待since_seq（默认当前的quote_seq）之后的新报价：成本先消失再出现，或者变成不同的值；
+        点击前就显示的旧成本不算
+        """
+        start_seq = self.quote_seq if since_seq is None else since_seq
+        return await self.wait_for(
+            lambda state: self.quote_seq > start_seq and state.cost is not None, timeout, "成本更新"
+        )
+    
+    async def wait_for_toast(self, timeout, since_seq=None):
+        """等待since_seq（默认当前的toast_seq）之后出现的交易通知，上一笔交易留下的通知不算"""
+        start_seq = self.toast_seq if since_seq is None else since_seq
+        return await self.wait_for(
+            lambda state: self.toast_seq > start_seq and state.toast is not None, timeout, "交易通知"
+        )
+    
+    async def wait_for_wallet(self, timeout):
+        return await self.wait_for(lambda state: state.wallet_connected, timeout, "钱包连接")
+    
+    async def wait_for_swap_ready(self, timeout):
+        """等待Swap卡片重新可操作"""
+        return await self.wait_for(
+            lambda state: state.swap_button.present and state.all_button.present, timeout, "Swap卡片就绪"
+        )
+    
+    async def wait_for_transaction_settled(self, before, timeout):
+        """
+        等待交易结束后Swap卡片离开待处理状态：余额相对before发生变化，或者提交时显示的成本被清空
+        按钮一直都在页面上，只看按钮是否存在不能说明交易已完成；before没有余额和成本时只能等到超时
+        """
+        balances_before = before.balances if before is not None else {}
+        cost_before = before.cost if before is not None else None
+        
+        def settled(state):
+            if not (state.swap_button.present and state.all_button.present):
+                return False
+            if balances_before and state.balances and state.balances != balances_before:
+                return True
+            return cost_before is not None and state.cost is None
+        
+        return await self.wait_for(settled, timeout, "交易结束后Swap卡片就绪")
+
+page_readiness = PageReadiness()
+
+# 组合动作：在页面内一次完成"切换方向 -> 点击ALL -> 等待新报价"，每一步由MutationObserver等待DOM变化后继续
+COMPOSITE_ACTION_JS = """
+async ({fromToken, toToken, selectAll, timeoutMs}) => {
+    const readState = (%s);
+    const timings = {};
+    const findReverse = () => {
+        const icon = document.querySelector('.lucide-arrow-up-down');
+        return (icon && icon.closest('button'))
+            || document.querySelector('button[data-testid="swap-switch-tokens-button"]');
+    };
+    const findAll = () => Array.from(document.querySelectorAll('button'))
+        .find(button => /^(ALL|MAX)$/.test(button.textContent.trim()));
+    // 等待之后的DOM变化使条件成立，超时返回null；checkNow为false时忽略当前状态
+    const waitFor = (predicate, checkNow) => new Promise(resolve => {
+        if (checkNow) {
+            const state = readState();
+            if (predicate(state)) {
+                resolve(state);
+                return;
+            }
+        }
+        let finished = false;
+        let scheduled = false;
+        const finish = (result) => {
+            if (!finished) {
+                finished = true;
+                observer.disconnect();
+                clearTimeout(timer);
+                resolve(result);
+            }
+        };
+        const observer = new MutationObserver(() => {
+            if (!scheduled) {
+                scheduled = true;
+                queueMicrotask(() => {
+                    scheduled = false;
+                    const state = readState();
+                    if (predicate(state)) {
+                        finish(state);
+                    }
+                });
+            }
+        });
+        observer.observe(document.body, {subtree: true, childList: true, characterData: true, attributes: true});
+        const timer = setTimeout(() => finish(null), timeoutMs);
+    });
     
+    let state = readState();
+    if (fromToken && !(state.from_token === fromToken && state.to_token === toToken)) {
+        const reverseButton = findReverse();
+        if (!reverseButton) {
+            return {ok: false, step: 'reverse', reason: '找不到反转按钮', state, timings};
+        }
+        const started = performance.now();
+        reverseButton.click();
+        const flipped = await waitFor(s => s.from_token === fromToken && s.to_token === toToken, true);
+        timings.reverse_ms = performance.now() - started;
+        if (!flipped) {
+            return {ok: false, step: 'reverse', reason: '方向没有切换', state: readState(), timings};
+        }
+        state = flipped;
+    }
+    if (selectAll) {
+        const allButton = findAll();
+        if (!allButton) {
+            return {ok: false, step: 'all', reason: '找不到ALL按钮', state, timings};
+        }
+        const costBefore = readState().cost;
+        const started = performance.now();
+        allButton.click();
+        // 余额为0时不会有报价，不必等待
+        if (state.balances[state.from_token] === 0) {
+            return {ok: true, step: 'done', reason: null, state: readState(), timings};
+        }
+        // 新报价：点击后成本先消失再出现，或者变成与点击前不同的值；仍显示的旧成本不算
+        // 页面可能在click()里同步清空成本，所以先检查一次当前状态
+        let cleared = costBefore === null;
+        const quoted = await waitFor(s => {
+            if (s.cost === null) {
+                cleared = true;
+                return false;
+            }
+            return cleared || s.cost !== costBefore;
+        }, true);
+        timings.quote_ms = performance.now() - started;
+        if (!quoted) {
+            return {ok: false, step: 'quote', reason: '没有等到新报价', state: readState(), timings};
+        }
+        state = quoted;
+    }
+    return {ok: true, step: 'done', reason: null, state, timings};
+}
+""" % SWAP_STATE_JS.strip()
+
+@dataclass
+class CompositeResult:
+    """组合动作的结果：失败时step是失败的步骤，state是页面内最后读取的状态"""
+    ok: bool
+    step: str
+    reason: Optional[str] = None
+    state: Optional[SwapPageState] = None
+    timings: Dict[str, float] = field(default_factory=dict)
+
+async def run_composite_action(page, from_token=None, to_token=None, select_all=False, timeout_ms=None):
+    """执行一次组合动作，只有一次Playwright往返"""
+    args = {
+        "fromToken": from_token,
+        "toToken": to_token,
+        "selectAll": select_all,
+        "timeoutMs": timeout_ms or COMPOSITE_STEP_TIMEOUT_MS
+    }
     try:
-        # 备选方案：查找屏幕上可能的成本数字
-        cost_elements = await page.locator("text=/Cost.+\\$\\d+\\.\\d+/").all()
-        for element in cost_elements:
-            content = await element.text_content()
-            cost_match = re.search(r"\$(\d+\.\d+)", content)
-            if cost_match:
-                return float(cost_match.group(1))
+        data = await page.evaluate(COMPOSITE_ACTION_JS, args)
     except Exception as e:
-        print(f"从屏幕提取成本失败: {e}")
+        return CompositeResult(ok=False, step="evaluate", reason=str(e))
+    state = SwapPageState.from_dict(data["state"]) if data.get("state") else None
+    timings = data.get("timings") or {}
+    for name, elapsed_ms in timings.items():
+        metrics.observe(f"in_page_{name[:-3]}", elapsed_ms)
+    return CompositeResult(ok=data["ok"], step=data["step"], reason=data.get("reason"), state=state, timings=timings)
+
+async def flip_to(page, from_token, to_token):
+    """切换到from_token->to_token（方向已正确时不点击）"""
+    return await run_composite_action(page, from_token, to_token)
+
+async def select_all_and_quote(page):
+    """点击ALL并等待新报价"""
+    return await run_composite_action(page, select_all=True)
+
+async def flip_select_all_and_quote(page, from_token, to_token):
+    """切换方向、点击ALL并等待新报价"""
+    return await run_composite_action(page, from_token, to_token, select_all=True)
+
+# 网络数据中可能表示交易成本、交易状态的字段名（忽略大小写和下划线）
+_COST_KEYS = {"cost", "costusd", "totalcost", "totalcostusd", "estimatedcost"}
+_TX_STATUS_KEYS = {"status", "state", "txstatus"}
+_TX_HASH_KEYS = {"hash", "txhash", "transactionhash", "txid"}
+_TX_SUCCESS_STATUSES = {"confirmed", "success", "successful", "completed", "mined"}
+_TX_PENDING_STATUSES = {"pending", "submitted", "processing", "sent", "broadcast", "broadcasted", "queued"}
+_TX_FAILED_STATUSES = {"failed", "failure", "reverted", "rejected", "error"}
+_TOKENS = ("USDC", "USDT")
+
+def _normalize_key(key):
+    return str(key).lower().replace("_", "").replace("-", "")
+
+def _to_number(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return float(value.replace(",", "").lstrip("$"))
+        except ValueError:
+            return None
+    return None
+
+def _walk_json(data, depth=0):
+    """遍历JSON中的所有对象（限制深度，避免超大报文拖慢事件循环）"""
+    if depth > 8:
+        return
+    if isinstance(data, dict):
+        yield data
+        for value in data.values():
+            yield from _walk_json(value, depth + 1)
+    elif isinstance(data, list):
+        for item in data[:200]:
+            yield from _walk_json(item, depth + 1)
+
+def parse_quote_cost(data):
+    """从报价报文中找出交易成本（USDT），找不到返回None"""
+    for obj in _walk_json(data):
+        for key, value in obj.items():
+            if _normalize_key(key) in _COST_KEYS:
+                number = _to_number(value)
+                if number is not None and number >= 0:
+                    return number
+    return None
+
+def parse_balances(data):
+    """从余额报文中找出USDC/USDT余额"""
+    balances = {}
+    for obj in _walk_json(data):
+        # 形如 {"USDC": "12.3", "USDT": 4}
+        for token in _TOKENS:
+            number = _to_number(obj.get(token))
+            if number is not None:
+                balances[token] = number
+        # 形如 {"symbol": "USDC", "balance": "12.3"}
+        symbol = obj.get("symbol") or obj.get("token")
+        if isinstance(symbol, str) and symbol.upper() in _TOKENS:
+            for key in ("balance", "amount", "formattedBalance", "uiAmount"):
+                number = _to_number(obj.get(key))
+                if number is not None:
+                    balances[symbol.upper()] = number
+                    break
+    return balances
+
+def parse_tx_status(data):
+    """从交易状态报文中找出 (交易哈希, 状态)，状态可能是pending或最终状态，找不到返回None"""
+    for obj in _walk_json(data):
+        status = None
+        tx_hash = None
+        for key, value in obj.items():
+            normalized = _normalize_key(key)
+            if normalized in _TX_STATUS_KEYS and isinstance(value, str):
+                status = value.lower()
+            elif normalized in _TX_HASH_KEYS and isinstance(value, str):
+                tx_hash = value
+        if status in _TX_SUCCESS_STATUSES or status in _TX_FAILED_STATUSES or status in _TX_PENDING_STATUSES:
+            return tx_hash, status
+    return None
+
+class NetworkState:
+    """
+    从应用自身的HTTP响应和WebSocket消息中增量更新的报价、余额和交易状态
+    交易循环读取时是O(1)，不需要访问页面
+    """
+    def __init__(self):
+        self.quote_cost = None
+        self.quote_at = 0.0
+        self.balances = {}
+        self.balances_at = 0.0
+        self.tx_seq = 0
+        self.pending_txs = {}  # 交易哈希 -> 第一次看到pending状态时的序号
+        self.last_tx = None  # (交易哈希, 状态, 时间, 该交易开始的序号)
+        self.messages = 0
+        self.throttle_seq = 0  # 收到HTTP 429的次数
+        self._tx_waiters = []
+        self._quote_listeners = []
+    
+    def add_quote_listener(self, listener):
+        """每次收到新报价时调用listener(cost)"""
+        self._quote_listeners.append(listener)
+    
+    def attach(self, page):
+        """监听页面的HTTP响应和WebSocket帧"""
+        page.on("response", self._on_response)
+        page.on("websocket", self._on_websocket)
+    
+    async def _on_response(self, response):
+        if response.status == 429:
+            self.throttle_seq += 1
+            return
+        url = response.url
+        kinds = [kind for kind, pattern in _NETWORK_PATTERNS if pattern.search(url)]
+        if not kinds or response.request.resource_type not in ("fetch", "xhr"):
+            return
+        if "json" not in response.headers.get("content-type", ""):
+            return
+        try:
+            data = await response.json()
+        except Exception:
+            return
+        # 非GET请求（提交交易）的响应本身就是新交易，不需要先看到pending状态
+        self._ingest(data, kinds, submission=response.request.method != "GET")
+    
+    def _on_websocket(self, websocket):
+        url_kinds = tuple(kind for kind, pattern in _NETWORK_PATTERNS if pattern.search(websocket.url))
+        websocket.on("framereceived", lambda payload: self._on_frame(payload, url_kinds))
+    
+    def _on_frame(self, payload, url_kinds):
+        if isinstance(payload, bytes):
+            try:
+                payload = payload.decode("utf-8")
+            except UnicodeDecodeError:
+                return
+        if not payload or payload[0] not in "[{":
+            return
+        try:
+            data = json.loads(payload)
+        except ValueError:
+            return
+        # 连接URL不匹配时，按消息的频道字段匹配；都不匹配的消息（订阅确认、心跳等）直接忽略
+        kinds = url_kinds or _frame_kinds(data)
+        if kinds:
+            self._ingest(data, kinds)
+    
+    def _ingest(self, data, kinds, submission=False):
+        self.messages += 1
+        now = time.monotonic()
+        if "quote" in kinds:
+            cost = parse_quote_cost(data)
+            if cost is not None:
+                self.quote_cost = cost
+                self.quote_at = now
+                for listener in self._quote_listeners:
+                    listener(cost)
+        if "balance" in kinds:
+            balances = parse_balances(data)
+            if balances:
+                self.balances.update(balances)
+                self.balances_at = now
+        if "tx" in kinds:
+            tx = parse_tx_status(data)
+            if tx is not None:
+                self._record_tx(tx[0], tx[1], submission, now)
+    
+    def _record_tx(self, tx_hash, status, submission, now):
+        """
+        只接受能对应到新交易的最终状态：同一哈希先出现过pending，或者是提交请求本身的响应
+        没有哈希的状态（订阅确认等）和历史记录中的旧交易都会被忽略
+        """
+        if not tx_hash:
+            return
+        self.tx_seq += 1
+        if status in _TX_PENDING_STATUSES:
+            self.pending_txs.setdefault(tx_hash, self.tx_seq)
+            while len(self.pending_txs) > 100:
+                del self.pending_txs[next(iter(self.pending_txs))]
+            return
+        started = self.pending_txs.pop(tx_hash, None)
+        if started is None and submission:
+            started = self.tx_seq
+        if started is None:
+            return
+        self.last_tx = (tx_hash, status, now, started)
+        for future in self._tx_waiters:
+            if not future.done():
+                future.set_result(self.last_tx)
+    
+    def quote(self, since=None):
+        """返回since（默认为NETWORK_QUOTE_MAX_AGE秒前）之后收到的报价成本，没有则返回None"""
+        if self.quote_cost is None:
+            return None
+        if since is None:
+            since = time.monotonic() - NETWORK_QUOTE_MAX_AGE
+        return self.quote_cost if self.quote_at >= since else None
+    
+    async def wait_for_tx(self, since_seq, timeout):
+        """
+        等待since_seq之后开始的交易到达最终状态，返回 (交易哈希, 状态, 时间)，超时返回None
+        since_seq之前已经pending的交易和旧交易的状态不算
+        """
+        deadline = time.monotonic() + timeout
+        while self.last_tx is None or self.last_tx[3] <= since_seq:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            future = asyncio.get_event_loop().create_future()
+            self._tx_waiters.append(future)
+            try:
+                await asyncio.wait_for(future, remaining)
+            except asyncio.TimeoutError:
+                return None
+            finally:
+                self._tx_waiters.remove(future)
+        return self.last_tx[:3]
+
+# 留空的正则表示不解析该类报文
+_NETWORK_PATTERNS = [
+    (kind, re.compile(pattern, re.IGNORECASE))
+    for kind, pattern in (("quote", NETWORK_QUOTE_PATTERN), ("balance", NETWORK_BALANCE_PATTERN), ("tx", NETWORK_TX_PATTERN))
+    if pattern
+]
+
+# WebSocket消息中表示频道/消息类型的字段
+_FRAME_CHANNEL_KEYS = ("channel", "topic", "type", "event", "stream")
+
+def _frame_kinds(data):
+    """按消息顶层的频道字段匹配报价/余额/交易状态正则"""
+    if not isinstance(data, dict):
+        return ()
+    channels = [data[key] for key in _FRAME_CHANNEL_KEYS if isinstance(data.get(key), str)]
+    return tuple(kind for kind, pattern in _NETWORK_PATTERNS if any(pattern.search(channel) for channel in channels))
+
+network_state = NetworkState()
+
+# 无障碍树不可用时的结构化DOM遍历：按阅读顺序列出文本节点、带aria-label的元素和输入框的值
+A11Y_NODES_JS = """
+() => {
+    const nodes = [];
+    const walker = document.createTreeWalker(
+        document.body,
+        NodeFilter.SHOW_ELEMENT | NodeFilter.SHOW_TEXT,
+        {
+            acceptNode: (node) => {
+                if (node.nodeType === Node.ELEMENT_NODE
+                    && (node.hidden || node.getAttribute('aria-hidden') === 'true'
+                        || ['SCRIPT', 'STYLE', 'NOSCRIPT'].includes(node.tagName))) {
+                    return NodeFilter.FILTER_REJECT;
+                }
+                return NodeFilter.FILTER_ACCEPT;
+            }
+        }
+    );
+    while (walker.nextNode() && nodes.length < 2000) {
+        const node = walker.currentNode;
+        if (node.nodeType === Node.TEXT_NODE) {
+            const text = node.nodeValue.trim();
+            if (text) {
+                nodes.push({role: 'text', name: text});
+            }
+            continue;
+        }
+        const role = node.getAttribute('role') || node.tagName.toLowerCase();
+        const label = node.getAttribute('aria-label');
+        if (node.tagName === 'INPUT' || node.tagName === 'TEXTAREA') {
+            nodes.push({role, name: label || node.placeholder || '', value: node.value});
+        } else if (label) {
+            nodes.push({role, name: label});
+        }
+    }
+    return nodes;
+}
+"""
+
+@dataclass
+class LabelRule:
+    """标签匹配规则：label匹配某个节点后，在该节点和后面window个节点拼接的文本中查找value"""
+    field: str
+    label: re.Pattern
+    value: re.Pattern
+    window: int = 3
+
+# 余额/成本的标签规则；文本被拆成多个节点时（如"Balance:" "12.5" "USDC"）靠窗口拼接匹配，
+# 窗口遇到下一个标签就结束；成本必须紧跟在标签后面并带$，不会取到旁边的价格影响、余额等数字
+A11Y_LABEL_RULES = [
+    LabelRule("balance", re.compile(r"\bBalance\b", re.I), re.compile(r"Balance:?\s*([0-9][0-9.,]*)\s*(USDC|USDT)", re.I)),
+    LabelRule("cost", re.compile(r"^(Total\s+)?Cost\b", re.I), re.compile(r"Cost:?\s*[~≈]?\s*\$\s*([0-9][0-9,]*\.?[0-9]*)", re.I)),
+]
+
+# 看起来像标签的节点（只有字母、空格和少量符号，可以以冒号结尾），代币名除外
+_A11Y_LABEL_LIKE = re.compile(r"^[A-Za-z][A-Za-z\s()/%-]*:?$")
+
+def _is_label_like(text):
+    return text not in _TOKENS and bool(_A11Y_LABEL_LIKE.match(text))
+
+# 代币选择框在无障碍树中的角色
+_A11Y_TOKEN_ROLES = {"button", "combobox", "listbox", "menuitem", "option"}
+
+def flatten_accessibility_tree(node, out=None):
+    """把page.accessibility.snapshot()的树按阅读顺序展开成节点列表"""
+    if out is None:
+        out = []
+    if not node:
+        return out
+    name = (node.get("name") or "").strip()
+    value = node.get("value")
+    if name or value not in (None, ""):
+        out.append({"role": node.get("role", ""), "name": name, "value": value})
+    for child in node.get("children") or []:
+        flatten_accessibility_tree(child, out)
+    return out
+
+def _node_text(node):
+    value = node.get("value")
+    if value in (None, ""):
+        return node.get("name") or ""
+    return f"{node.get('name') or ''} {value}".strip()
+
+def match_accessible_nodes(nodes, rules=A11Y_LABEL_RULES):
+    """
+    在节点列表上运行标签规则，返回只包含代币顺序、余额和成本的SwapPageState
+    代币顺序取前两个不同的、名字恰好是代币名的节点，优先取代币选择按钮
+    """
+    state = SwapPageState()
+    texts = [_node_text(node) for node in nodes]
+    selectors = [text for node, text in zip(nodes, texts) if text in _TOKENS and node.get("role") in _A11Y_TOKEN_ROLES]
+    tokens = list(dict.fromkeys(selectors or [text for text in texts if text in _TOKENS]))
+    if len(tokens) >= 2:
+        state.from_token, state.to_token = tokens[0], tokens[1]
+    for index, text in enumerate(texts):
+        for rule in rules:
+            if not rule.label.search(text):
+                continue
+            window = [text]
+            for following in texts[index + 1:index + rule.window + 1]:
+                if _is_label_like(following):
+                    break
+                window.append(following)
+            match = rule.value.search(" ".join(window))
+            if match is None:
+                continue
+            amount = _to_number(match.group(1))
+            if amount is None:
+                continue
+            if rule.field == "balance":
+                state.balances.setdefault(match.group(2).upper(), amount)
+            elif rule.field == "cost" and state.cost is None:
+                state.cost = amount
+    return state
+
+async def read_accessible_nodes(page):
+    """优先读取无障碍树，Playwright版本不支持或树为空时退回结构化DOM遍历"""
+    accessibility = getattr(page, "accessibility", None)
+    if accessibility is not None:
+        try:
+            nodes = flatten_accessibility_tree(await accessibility.snapshot())
+            if nodes:
+                return nodes
+        except Exception as e:
+            print(f"读取无障碍树失败: {e}")
+    return await page.evaluate(A11Y_NODES_JS)
+
+async def extract_accessible_state(page):
+    """本地提取层：从无障碍树读取代币顺序、余额和成本，失败时返回None"""
+    if not A11Y_EXTRACTION:
+        return None
+    try:
+        with metrics.phase("a11y_extract"):
+            return match_accessible_nodes(await read_accessible_nodes(page))
+    except Exception as e:
+        print(f"无障碍树提取失败: {e}")
+        return None
+
+async def extract_cost_from_page(page, state=None, since=None):
+    """
+    获取交易成本：以页面显示的Cost为准（可传入已读取的状态避免重复读取），
+    页面没有成本时才使用已配置报价接口（NETWORK_QUOTE_PATTERN）中since之后收到的报价
+    """
+    if state is None:
+        state = await read_swap_page_state(page)
+    if state is not None and state.cost is not None:
+        return state.cost
+    cost = network_state.quote(since)
+    if cost is not None:
+        return cost
+    # 页面状态中没有成本时，用无障碍树再找一次
+    accessible = await extract_accessible_state(page)
+    if accessible is not None and accessible.cost is not None:
+        return accessible.cost
+    
+    # 默认值
+    if COST_FALLBACK is None:
+        print("无法找到成本")
+        return 0.0
+    print(f"无法找到成本，返回默认值{COST_FALLBACK}")
+    return COST_FALLBACK
+
+async def get_viewport_dimensions(page):
+    """获取当前页面视图尺寸"""
+    return await page.evaluate('() => { return {width: window.innerWidth, height: window.innerHeight} }')
+
+class SelectorStrategy:
+    """
+    某个UI动作的一种点击方式
+    selector 策略直接点击选择器；fn 策略执行自定义协程 fn(page, timeout_ms) -> bool
+    """
+    def __init__(self, name, label, selector=None, fn=None):
+        self.name = name
+        self.label = label
+        self.selector = selector
+        self.fn = fn
+    
+    async def run(self, page, timeout_ms=None):
+        if self.fn is not None:
+            return bool(await self.fn(page, timeout_ms))
+        await page.locator(self.selector).first.click(timeout=timeout_ms)
+        return True
+
+class SelectorRegistry:
+    """
+    按UI动作记录每个选择器策略的成功率和平均耗时
+    排序时历史最优策略排在最前，连续失败的策略降级到末尾；统计保存到磁盘，下次启动直接沿用
+    """
+    def __init__(self, path):
+        self.path = path
+        self.stats = {}  # 动作 -> 策略名 -> 统计
+        self.dirty = False
+        self.last_saved = 0.0
+    
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.stats = json.load(f)
+            print(f"已加载选择器策略统计: {self.path}")
+        except Exception as e:
+            print(f"加载选择器策略统计失败: {e}")
+            self.stats = {}
+    
+    def save(self, force=False):
+        if not self.path or not self.dirty:
+            return
+        if not force and time.monotonic() - self.last_saved < SELECTOR_STATS_SAVE_INTERVAL:
+            return
+        try:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.stats, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.path)
+            self.dirty = False
+            self.last_saved = time.monotonic()
+        except Exception as e:
+            print(f"保存选择器策略统计失败: {e}")
+    
+    def _entry(self, action, name):
+        return self.stats.setdefault(action, {}).setdefault(name, {
+            "success": 0,
+            "failure": 0,
+            "consecutive_failures": 0,
+            "avg_ms": 0.0
+        })
+    
+    def success_rate(self, action, name):
+        entry = self.stats.get(action, {}).get(name)
+        if not entry:
+            return 0.5
+        # 拉普拉斯平滑，未尝试过的策略为0.5
+        return (entry["success"] + 1) / (entry["success"] + entry["failure"] + 2)
+    
+    def is_proven(self, action, name):
+        entry = self.stats.get(action, {}).get(name)
+        return bool(entry) and entry["success"] > 0 and entry["consecutive_failures"] == 0
+    
+    def order(self, action, strategies):
+        """按 (是否降级, 成功率, 平均耗时, 原始顺序) 排序策略"""
+        def sort_key(item):
+            index, strategy = item
+            entry = self.stats.get(action, {}).get(strategy.name, {})
+            demoted = entry.get("consecutive_failures", 0) >= SELECTOR_DEMOTE_AFTER
+            avg_ms = entry.get("avg_ms") if entry.get("success") else float("inf")
+            return (demoted, -self.success_rate(action, strategy.name), avg_ms, index)
+        return [strategy for _, strategy in sorted(enumerate(strategies), key=sort_key)]
+    
+    def record(self, action, name, ok, elapsed_ms):
+        entry = self._entry(action, name)
+        if ok:
+            entry["success"] += 1
+            entry["consecutive_failures"] = 0
+            # 指数滑动平均，较快反映最近的耗时变化
+            if entry["avg_ms"]:
+                entry["avg_ms"] = entry["avg_ms"] * 0.8 + elapsed_ms * 0.2
+            else:
+                entry["avg_ms"] = elapsed_ms
+        else:
+            entry["failure"] += 1
+            entry["consecutive_failures"] += 1
+        self.dirty = True
+        self.save()
+
+selector_registry = SelectorRegistry(SELECTOR_STATS_FILE)
+
+async def _wait_actionable(page, strategy, timeout_ms):
+    """等待某个选择器策略对应的元素可见且可用，返回该策略"""
+    locator = page.locator(strategy.selector).first
+    deadline = time.perf_counter() + timeout_ms / 1000
+    await locator.wait_for(state="visible", timeout=timeout_ms)
+    while not await locator.is_enabled():
+        if time.perf_counter() >= deadline:
+            raise asyncio.TimeoutError(f"{strategy.selector} 在超时前未变为可用")
+        await asyncio.sleep(0.05)
+    return strategy
+
+async def _race_selector_strategies(page, action, strategies, deadline):
+    """
+    同时等待所有选择器候选，点击第一个变为可操作的元素并取消其余等待
+    被取消的候选（获胜者已点击，或到截止时间仍不可操作）记为未命中，长期落后的过时策略会逐渐降级
+    返回获胜的策略，全部失败或超过截止时间时返回None
+    """
+    started = time.perf_counter()
+    remaining_ms = max((deadline - started) * 1000, 1)
+    pending = {
+        asyncio.ensure_future(_wait_actionable(page, strategy, remaining_ms)): strategy
+        for strategy in strategies
+    }
+    
+    def record_losers():
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        for strategy in pending.values():
+            selector_registry.record(action, strategy.name, False, elapsed_ms)
+    
+    try:
+        while pending:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            done, _ = await asyncio.wait(pending.keys(), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                break
+            for task in done:
+                strategy = pending.pop(task)
+                if task.exception() is not None:
+                    selector_registry.record(action, strategy.name, False, (time.perf_counter() - started) * 1000)
+                    continue
+                try:
+                    click_timeout = max((deadline - time.perf_counter()) * 1000, 1)
+                    await page.locator(strategy.selector).first.click(timeout=click_timeout)
+                except Exception:
+                    selector_registry.record(action, strategy.name, False, (time.perf_counter() - started) * 1000)
+                    continue
+                selector_registry.record(action, strategy.name, True, (time.perf_counter() - started) * 1000)
+                record_losers()
+                return strategy
+        record_losers()
+        return None
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending.keys(), return_exceptions=True)
+
+async def run_ui_action(page, action, action_label, strategies):
+    """
+    执行一个UI动作，最坏耗时不超过 ACTION_DEADLINE_MS
+    1. 历史最优策略先用较短的超时单独尝试
+    2. 其余选择器策略同时等待，第一个可操作的元素获胜
+    3. 最后在剩余时间内依次尝试JavaScript等自定义策略
+    """
+    started = time.perf_counter()
+    deadline = started + ACTION_DEADLINE_MS / 1000
+    ordered = selector_registry.order(action, strategies)
+    
+    def remaining_ms():
+        return max((deadline - time.perf_counter()) * 1000, 0)
+    
+    async def attempt(strategy, timeout_ms):
+        attempt_started = time.perf_counter()
+        try:
+            ok = await asyncio.wait_for(strategy.run(page, timeout_ms), timeout_ms / 1000)
+        except Exception:
+            ok = False
+        selector_registry.record(action, strategy.name, ok, (time.perf_counter() - attempt_started) * 1000)
+        return ok
+    
+    def report(strategy):
+        metrics.count_selector(action, strategy.name)
+        print(f"成功点击{action_label} (通过{strategy.label}, {(time.perf_counter() - started) * 1000:.0f}ms)")
+    
+    candidates = list(ordered)
+    first = ordered[0]
+    if selector_registry.is_proven(action, first.name):
+        if await attempt(first, min(SELECTOR_FAST_TIMEOUT_MS, remaining_ms())):
+            report(first)
+            return True
+        candidates.remove(first)
+    
+    racers = [strategy for strategy in candidates if strategy.selector is not None]
+    if racers and remaining_ms() > 0:
+        winner = await _race_selector_strategies(page, action, racers, deadline)
+        if winner is not None:
+            report(winner)
+            return True
+    
+    for strategy in candidates:
+        if strategy.selector is not None:
+            continue
+        timeout_ms = remaining_ms()
+        if timeout_ms <= 0:
+            break
+        if await attempt(strategy, timeout_ms):
+            report(strategy)
+            return True
+    
+    return False
+
+async def _click_swap_by_js(page, timeout_ms):
+    """直接使用JavaScript执行点击"""
+    return await page.evaluate("""
+        (() => {
+            // 尝试各种选择器
+            const selectors = [
+                'button[data-testid="swap-swap-button"]',
+                '#swap-swap-button',
+                'button.bg-action-primary'
+            ];
+            
+            for (const selector of selectors) {
+                const button = document.querySelector(selector);
+                if (button) {
+                    button.click();
+                    return true;
+                }
+            }
+            
+            // 查找底部的大按钮
+            const buttons = Array.from(document.querySelectorAll('button'));
+            const viewport_height = window.innerHeight;
+            for (const button of buttons) {
+                const rect = button.getBoundingClientRect();
+                if (rect.y > viewport_height * 0.7 && rect.width > 100) {
+                    button.click();
+                    return true;
+                }
+            }
+            
+            return false;
+        })()
+    """)
+
+SWAP_BUTTON_STRATEGIES = [
+    SelectorStrategy("testid", "data-testid", selector='button[data-testid="swap-swap-button"]'),
+    SelectorStrategy("id", "ID", selector='#swap-swap-button'),
+    SelectorStrategy("text", "文本", selector='button:has-text("Swap")'),
+    SelectorStrategy("class_text", "类+文本", selector='button.bg-action-primary:has-text("Swap")'),
+    SelectorStrategy("js", "JavaScript", fn=_click_swap_by_js),
+]
+
+async def click_swap_button(page):
+    """
+    尝试使用多种方法点击Swap按钮
+    按各策略的历史表现排序，优先使用最近成功最多、最快的选择器
+    """
+    if await run_ui_action(page, "swap", "Swap按钮", SWAP_BUTTON_STRATEGIES):
+        return True
+    print("所有点击Swap按钮的尝试均失败")
+    return False
+
+async def _click_reverse_near_center(page, timeout_ms):
+    """精确定位屏幕中央附近的小按钮"""
+    viewport = await get_viewport_dimensions(page)
+    center_x = viewport['width'] / 2
+    top_center_y = viewport['height'] * 0.3  # 大约在屏幕上部 1/3 处
+    
+    # 使用evaluate查找最接近位置的按钮
+    return await page.evaluate('''({centerX, topCenterY}) => {
+        const buttons = Array.from(document.querySelectorAll('button'));
+        
+        // 找到最接近中心的按钮
+        let closestButton = null;
+        let minDistance = Infinity;
+        
+        for (const button of buttons) {
+            const rect = button.getBoundingClientRect();
+            const buttonCenterX = rect.left + rect.width / 2;
+            const buttonCenterY = rect.top + rect.height / 2;
+            
+            // 计算到目标位置的距离
+            const distance = Math.sqrt(
+                Math.pow(buttonCenterX - centerX, 2) + 
+                Math.pow(buttonCenterY - topCenterY, 2)
+            );
+            
+            // 只考虑小按钮（可能是反转按钮）
+            if (rect.width < 60 && rect.height < 60 && distance < minDistance) {
+                minDistance = distance;
+                closestButton = button;
+            }
+        }
+        
+        // 如果找到了按钮，点击它
+        if (closestButton && minDistance < 100) {
+            closestButton.click();
+            return true;
+        }
+        
+        return false;
+    }''', {'centerX': center_x, 'topCenterY': top_center_y})
+
+REVERSE_BUTTON_STRATEGIES = [
+    SelectorStrategy("exact", "提供的精确选择器", selector='button.size-10\\.5.-translate-x-1\\/2.-translate-y-1\\/2:has(.lucide-arrow-up-down)'),
+    SelectorStrategy("lucide", "lucide-arrow-up-down图标", selector='button:has(.lucide-arrow-up-down)'),
+    SelectorStrategy("testid", "data-testid", selector='button[data-testid="swap-switch-tokens-button"]'),
+    SelectorStrategy("position", "位置选择器", selector='button.absolute.left-1\\/2.top-1\\.5'),
+    SelectorStrategy("svg", "SVG选择器", selector='button:has(svg.lucide-arrow-up-down)'),
+    # 各种常见的反转图标文本
+    SelectorStrategy("symbol", "符号文本", selector=", ".join(
+        f'button:has-text("{symbol}")' for symbol in ['↑↓', '⇅', '⇵', '↕', '↓↑', '⇆']
+    )),
+    SelectorStrategy("center", "计算屏幕中央最近的按钮", fn=_click_reverse_near_center),
+]
+
+async def click_reverse_button(page):
+    """
+    尝试使用多种方法点击代币切换/反转按钮，最坏耗时不超过 ACTION_DEADLINE_MS
+    通常这个按钮位于两个代币选择框之间；所有策略都失败时返回False，由调用方决定是否重试
+    """
+    print("尝试点击交易方向反转按钮...")
+    if await run_ui_action(page, "reverse", "反转按钮", REVERSE_BUTTON_STRATEGIES):
+        return True
+    print("所有点击反转按钮的尝试均失败")
+    return False
+
+async def ensure_swap_direction(page, current_from_token, current_to_token, state=None):
+    """
+    确保交易方向正确，如果不正确则调整
+    可传入已读取的页面状态，第一次检查时不再重复读取
+    """
+    for attempt in range(3):  # 最多尝试3次
+        if state is None:
+            state = await read_swap_page_state(page)
+        if state is None or not state.has_direction():
+            state = await extract_accessible_state(page) or state
+        try:
+            if state is not None and state.has_direction():
+                print(f"检测到当前交易方向: {state.from_token} -> {state.to_token}")
+                
+                # 如果方向不匹配预期，点击反转按钮
+                if not state.direction_is(current_from_token, current_to_token):
+                    print(f"交易方向不匹配，需要反转 (当前: {state.from_token}->{state.to_token}, 预期: {current_from_token}->{current_to_token})")
+                    if await click_reverse_button(page):
+                        print("已点击反转按钮调整交易方向")
+                        # 等待UI更新，方向切换后立即继续；用推送的状态再次检查方向是否正确
+                        state = await page_readiness.wait_for_direction(current_from_token, current_to_token, 1)
+                        continue
+                    else:
+                        print(f"尝试 {attempt+1}: 无法调整交易方向")
+                else:
+                    print("交易方向已正确")
+                    return True
+            else:
+                print(f"尝试 {attempt+1}: 无法检测到代币文本")
+        except Exception as e:
+            print(f"尝试 {attempt+1}: 检查交易方向时出错: {e}")
+        
+        state = None
+        await asyncio.sleep(1)
+    
+    print("无法确保交易方向正确")
+    return False
+
+async def confirm_transaction(page):
+    """
+    点击确认并等待交易结果
+    网络报文中的交易状态和页面通知哪个先到就以哪个为准，报文显示失败时返回False
+    """
+    tx_seq = network_state.tx_seq
+    toast_seq = page_readiness.toast_seq
+    state_before = page_readiness.state
+    try:
+        # 等待并点击确认按钮
+        confirm_button = await page.wait_for_selector("button:has-text('Confirm')", timeout=2500)
+        if confirm_button:
+            await confirm_button.click()
+            print("已点击确认按钮")
+    except Exception:
+        print("未找到确认按钮，可能不需要确认")
+    
+    # 等待交易完成：网络交易状态 或 页面通知，哪个先到用哪个
+    tx_task = asyncio.ensure_future(network_state.wait_for_tx(tx_seq, 5))
+    toast_task = asyncio.ensure_future(page_readiness.wait_for_toast(5, toast_seq))
+    pending = {tx_task, toast_task}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            if tx_task in done and tx_task.result() is not None:
+                tx_hash, status, _ = tx_task.result()
+                if status in _TX_FAILED_STATUSES:
+                    print(f"交易失败 (网络状态: {status}, {tx_hash})")
+                    return False
+                print(f"交易已提交/确认 (网络状态: {status}, {tx_hash})")
+                return True
+            if toast_task in done and toast_task.result() is not None:
+                print("交易已提交/确认")
+                return True
+    finally:
+        for task in pending:
+            task.cancel()
+    print("未捕获到交易成功通知")
+    
+    # 没有捕获到通知时，等待Swap卡片离开待处理状态（最多5.5秒）让交易完成；超时与原来固定等待5.5秒相同
+    await page_readiness.wait_for_transaction_settled(state_before, 5.5)
+    return True
+
+async def extract_balances_from_page(page, state=None, llm_sync=True):
+    """
+    从页面提取USDC和USDT余额信息
+    返回包含余额的字典；llm_sync为False时LLM只复用后台已有的分析结果，不同步请求模型
+    """
+    balances = {"USDC": 0.0, "USDT": 0.0}
+    
+    if state is None:
+        state = await read_swap_page_state(page)
+    if state is not None and state.balances:
+        for token, amount in state.balances.items():
+            balances[token] = amount
+            print(f"检测到 {token} 余额: {amount}")
+        return balances
+    
+    print("页面中未找到余额信息")
+    
+    # 其次使用网络报文中的余额
+    if network_state.balances:
+        balances.update(network_state.balances)
+        return balances
+    
+    # 本地提取：无障碍树中的余额标签，毫秒级完成
+    accessible = await extract_accessible_state(page)
+    if accessible is not None and accessible.balances:
+        for token, amount in accessible.balances.items():
+            balances[token] = amount
+            print(f"无障碍树检测到 {token} 余额: {amount}")
+        return balances
+    
+    # 最后手段：优先使用后台最新的LLM分析结果，没有时才同步请求一次
+    try:
+        analysis = analysis_state.fresh()
+        if analysis is None and not llm_sync:
+            pass
+        elif analysis is None and not llm_gateway.available():
+            print("LLM熔断中，跳过截图分析")
+        elif analysis is None:
+            image, mime_type = await capture_swap_screenshot(page, label="balance_check")
+            analysis = await analyze_with_llm(image, "请提取USDC和USDT余额", mime_type)
+            if analysis is not None:
+                analysis_state.publish(analysis)
+        
+        if analysis is not None:
+            for token, amount in analysis["balances"].items():
+                if amount is not None:
+                    balances[token] = amount
+    except Exception as backup_error:
+        print(f"备用余额提取方法也失败: {backup_error}")
+    
+    return balances
+
+class TradeJournal:
+    """
+    只追加的JSONL交易日志
+    每条记录立即写入操作系统缓冲区，按条数/时间批量fsync；
+    每条trade记录都带累计的trade_count和total_cost，重启时只需读取文件末尾即可恢复
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.run_id = datetime.now().strftime("%Y%m%d%H%M%S")
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+    
+    def open(self):
+        if not self.path:
+            return
+        # 上次崩溃可能留下不完整的最后一行，先补换行，避免与新记录粘连
+        needs_newline = False
+        if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            with open(self.path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                needs_newline = f.read(1) != b"\n"
+        self.file = open(self.path, "a", encoding="utf-8")
+        if needs_newline:
+            self.file.write("\n")
+    
+    def record(self, event, **fields):
+        if self.file is None:
+            return
+        entry = {"event": event, "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "run": self.run_id}
+        entry.update(fields)
+        self.file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self.file.flush()
+        self.unsynced += 1
+        if self.unsynced >= JOURNAL_FSYNC_EVERY or time.monotonic() - self.last_sync >= JOURNAL_FSYNC_INTERVAL:
+            self.sync()
+    
+    def sync(self):
+        if self.file is None or not self.unsynced:
+            return
+        try:
+            os.fsync(self.file.fileno())
+        except OSError as e:
+            print(f"交易日志fsync失败: {e}")
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+    
+    def close(self):
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.file = None
+    
+    def _reverse_lines(self, block_size=8192):
+        """从文件末尾向前逐行读取，不需要把整个日志读入内存"""
+        with open(self.path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            position = f.tell()
+            remainder = b""
+            while position > 0:
+                read_size = min(block_size, position)
+                position -= read_size
+                f.seek(position)
+                lines = (f.read(read_size) + remainder).split(b"\n")
+                remainder = lines.pop(0)
+                for line in reversed(lines):
+                    if line.strip():
+                        yield line
+            if remainder.strip():
+                yield remainder
+    
+    def recover(self):
+        """从最后一条trade记录恢复 (trade_count, total_cost)，没有日志时返回 (0, 0)"""
+        if not self.path or not os.path.exists(self.path):
+            return 0, 0
+        for line in self._reverse_lines():
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # 崩溃时可能留下不完整的最后一行
+                continue
+            if entry.get("event") == "trade":
+                return int(entry["trade_count"]), float(entry["total_cost"])
+        return 0, 0
+    
+    def iter_trades(self, run_id=None):
+        """流式读取交易记录，可按运行ID过滤"""
+        if not self.path or not os.path.exists(self.path):
+            return
+        if self.file is not None:
+            self.file.flush()
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry.get("event") == "trade" and (run_id is None or entry.get("run") == run_id):
+                    yield entry
+
+journal = TradeJournal(TRADE_JOURNAL_FILE)
+
+@dataclass(frozen=True)
+class RuntimeConfig:
+    """交易循环运行时可以调整的参数，修改配置文件或发送SIGHUP后在下一次交易前生效"""
+    max_cost_per_trade: float
+    max_total_cost: float
+    wait_between_trades: float
+    max_trades: int
+    llm_model: str
+    
+    # 字段 -> (环境变量名, 类型)
+    FIELDS = {
+        "max_cost_per_trade": ("MAX_COST_PER_TRADE", float),
+        "max_total_cost": ("MAX_TOTAL_COST", float),
+        "wait_between_trades": ("WAIT_BETWEEN_TRADES", float),
+        "max_trades": ("MAX_TRADES", int),
+        "llm_model": ("LLM_MODEL", str)
+    }
+    
+    @classmethod
+    def from_values(cls, values, base):
+        """用values中出现的变量覆盖base，解析或校验失败时抛出ValueError"""
+        parsed = {}
+        for name, (env_name, kind) in cls.FIELDS.items():
+            raw = values.get(env_name)
+            if raw is None or str(raw).strip() == "":
+                parsed[name] = getattr(base, name)
+                continue
+            try:
+                parsed[name] = kind(str(raw).strip())
+            except ValueError:
+                raise ValueError(f"{env_name}={raw!r} 不是有效的{kind.__name__}")
+        config = cls(**parsed)
+        config.validate()
+        return config
+    
+    def validate(self):
+        if self.max_cost_per_trade <= 0:
+            raise ValueError("MAX_COST_PER_TRADE 必须大于0")
+        if self.max_total_cost <= 0:
+            raise ValueError("MAX_TOTAL_COST 必须大于0")
+        if self.wait_between_trades < 0:
+            raise ValueError("WAIT_BETWEEN_TRADES 不能小于0")
+        if self.max_trades < 0:
+            raise ValueError("MAX_TRADES 不能小于0")
+        if not self.llm_model:
+            raise ValueError("LLM_MODEL 不能为空")
+    
+    def limit_reached(self, trade_count, spent):
+        """已达到最大交易次数或总成本上限"""
+        return trade_count >= self.max_trades or spent >= self.max_total_cost
+    
+    def diff(self, other):
+        """返回与other不同的字段 {字段: (旧值, 新值)}"""
+        return {
+            name: (getattr(other, name), getattr(self, name))
+            for name in self.FIELDS if getattr(self, name) != getattr(other, name)
+        }
+
+class RuntimeConfigReloader:
+    """
+    监视配置文件的修改时间和SIGHUP信号
+    交易循环每次迭代调用refresh()，检测到变化时重新读取并校验，校验失败则继续使用旧配置
+    只应用文件中值发生变化的变量：启动时进程环境变量优先于文件，文件里没改动的变量不会覆盖它们
+    """
+    def __init__(self, path, initial):
+        self.path = path
+        self.current = initial
+        self.mtime = self._mtime()
+        self.file_values = self._read_file()
+        self.reload_requested = False
+    
+    def _read_file(self):
+        try:
+            return dotenv_values(self.path)
+        except OSError:
+            return {}
+    
+    def _mtime(self):
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+    
+    def request_reload(self):
+        self.reload_requested = True
+    
+    def install_signal_handler(self):
+        """收到SIGHUP时重新加载（Windows没有SIGHUP，只检测文件修改）"""
+        if not hasattr(signal, "SIGHUP"):
+            return
+        try:
+            asyncio.get_event_loop().add_signal_handler(signal.SIGHUP, self.request_reload)
+        except (NotImplementedError, RuntimeError):
+            pass
+    
+    def refresh(self):
+        mtime = self._mtime()
+        if not self.reload_requested and mtime == self.mtime:
+            return self.current
+        self.reload_requested = False
+        self.mtime = mtime
+        try:
+            values = dotenv_values(self.path)
+            changed = {name: value for name, value in values.items() if self.file_values.get(name) != value}
+            config = RuntimeConfig.from_values(changed, self.current)
+        except (OSError, ValueError) as e:
+            print(f"配置重新加载失败，继续使用当前配置: {e}")
+            return self.current
+        self.file_values = values
+        changes = config.diff(self.current)
+        if changes:
+            for name, (old, new) in changes.items():
+                print(f"配置已更新: {RuntimeConfig.FIELDS[name][0]} {old} -> {new}")
+            journal.record("config", **{name: new for name, (old, new) in changes.items()})
+            self.current = config
+        return self.current
+
+runtime_config = RuntimeConfigReloader(CONFIG_FILE, RuntimeConfig(
+    max_cost_per_trade=MAX_COST_PER_TRADE,
+    max_total_cost=MAX_TOTAL_COST,
+    wait_between_trades=WAIT_BETWEEN_TRADES,
+    max_trades=MAX_TRADES,
+    llm_model=LLM_MODEL
+))
+
+class PacingScheduler:
+    """
+    交易节奏控制
+    记录每笔交易的确认耗时和页面重新就绪耗时，adaptive模式下上一笔交易结算完成就立即开始下一笔，
+    只有页面出现错误/限流提示或接口返回429时才指数退避；fixed模式保持固定的WAIT_BETWEEN_TRADES
+    """
+    def __init__(self, mode, window):
+        self.mode = mode
+        self.confirm_ms = deque(maxlen=window)
+        self.ready_ms = deque(maxlen=window)
+        self.backoff = 0.0
+        self.throttle_seq = 0
+        self.error_seq = 0
+        self.troubles = 0
+    
+    def record_trade(self, confirm_ms, ready_ms):
+        """一笔交易顺利结算，退避时间减半"""
+        self.confirm_ms.append(confirm_ms)
+        if ready_ms is not None:
+            self.ready_ms.append(ready_ms)
+        self.backoff = self.backoff / 2 if self.backoff >= 1 else 0.0
+    
+    def note_trouble(self, reason, base):
+        """出现错误或限流，退避时间从base（至少1秒）开始翻倍，上限PACING_MAX_BACKOFF"""
+        self.troubles += 1
+        if self.mode == "fixed":
+            print(f"检测到{reason}")
+            return
+        self.backoff = min(max(self.backoff * 2, base, 1.0), PACING_MAX_BACKOFF)
+        print(f"检测到{reason}，下一次交易前等待 {self.backoff:g} 秒")
+    
+    def _detect_trouble(self):
+        if network_state.throttle_seq > self.throttle_seq:
+            self.throttle_seq = network_state.throttle_seq
+            return "接口限流(HTTP 429)"
+        # 只算上一笔交易之后新出现的错误提示，页面上一直留着的旧提示不会让每笔交易都退避
+        if page_readiness.error_seq > self.error_seq:
+            self.error_seq = page_readiness.error_seq
+            state = page_readiness.state
+            if state is not None and state.error:
+                return f"页面错误提示: {state.error}"
+        return None
+    
+    def settle_timeout(self):
+        """等待结算的超时：有足够样本后取最近就绪耗时p95的3倍，不超过PAGE_READY_TIMEOUT"""
+        if len(self.ready_ms) < 5:
+            return PAGE_READY_TIMEOUT
+        p95 = TradeMetrics._quantile(sorted(self.ready_ms), 0.95) / 1000
+        return min(PAGE_READY_TIMEOUT, max(2.0, p95 * 3))
+    
+    async def wait(self, config):
+        """两笔交易之间的等待"""
+        if self.mode == "fixed":
+            await asyncio.sleep(config.wait_between_trades)
+            return
+        reason = self._detect_trouble()
+        if reason is not None:
+            self.note_trouble(reason, config.wait_between_trades)
+        delay = max(PACING_MIN_WAIT, self.backoff)
+        if delay > 0:
+            await asyncio.sleep(delay)
+    
+    def stats(self):
+        confirm = sorted(self.confirm_ms)
+        ready = sorted(self.ready_ms)
+        return {
+            "confirm_p50_ms": round(TradeMetrics._quantile(confirm, 0.5), 1),
+            "confirm_p95_ms": round(TradeMetrics._quantile(confirm, 0.95), 1),
+            "ready_p50_ms": round(TradeMetrics._quantile(ready, 0.5), 1),
+            "ready_p95_ms": round(TradeMetrics._quantile(ready, 0.95), 1),
+            "backoff_s": self.backoff,
+            "troubles": self.troubles
+        }
+
+pacing = PacingScheduler(PACING_MODE, PACING_WINDOW)
+
+class MemoryWatchdog:
+    """
+    浏览器内存看门狗
+    每MEMORY_CHECK_EVERY笔交易通过CDP Performance.getMetrics读取JS堆、DOM节点和事件监听器数量，
+    超过阈值时先触发一次垃圾回收，仍然超限就在两笔交易之间重新加载或替换页面
+    """
+    # CDP指标名 -> 导出的指标名
+    METRIC_NAMES = {
+        "JSHeapUsedSize": "js_heap_bytes",
+        "Nodes": "dom_nodes",
+        "JSEventListeners": "js_event_listeners",
+        "Documents": "documents"
+    }
+    
+    def __init__(self, every, max_heap_mb, max_nodes, max_listeners):
+        self.every = every
+        self.limits = {
+            "js_heap_bytes": max_heap_mb * 1024 * 1024,
+            "dom_nodes": max_nodes,
+            "js_event_listeners": max_listeners
+        }
+        self.cdp = None
+        self.last = None
+        self.recycles = 0
+    
+    async def attach(self, page):
+        """为页面建立CDP会话；非Chromium浏览器不支持时关闭看门狗"""
+        if self.every <= 0:
+            return
+        if self.cdp is not None:
+            try:
+                await self.cdp.detach()
+            except Exception:
+                pass
+            self.cdp = None
+        try:
+            cdp = await page.context.new_cdp_session(page)
+            await cdp.send("Performance.enable")
+            self.cdp = cdp
+        except Exception as e:
+            print(f"无法启用内存看门狗: {e}")
+    
+    async def sample(self):
+        result = await self.cdp.send("Performance.getMetrics")
+        values = {item["name"]: item["value"] for item in result.get("metrics", [])}
+        sample = {label: values.get(name, 0) for name, label in self.METRIC_NAMES.items()}
+        for label, value in sample.items():
+            metrics.set_gauge(f"browser_{label}", value)
+        self.last = sample
+        return sample
+    
+    def _over_limits(self, sample):
+        return [
+            f"{label} {sample[label]:.0f} > {limit:.0f}"
+            for label, limit in self.limits.items() if limit > 0 and sample[label] > limit
+        ]
+    
+    async def needs_recycle(self, trade_count):
+        """在安全点（一笔交易结算后）检查，返回需要回收页面的原因，不需要时返回None"""
+        if self.cdp is None or trade_count % self.every != 0:
+            return None
+        try:
+            reasons = self._over_limits(await self.sample())
+            if reasons:
+                # 先尝试垃圾回收，回收后仍超限才回收页面
+                await self.cdp.send("HeapProfiler.collectGarbage")
+                reasons = self._over_limits(await self.sample())
+        except Exception as e:
+            print(f"读取浏览器内存指标失败: {e}")
+            return None
+        return ", ".join(reasons) or None
+
+memory_watchdog = MemoryWatchdog(MEMORY_CHECK_EVERY, MEMORY_MAX_HEAP_MB, MEMORY_MAX_DOM_NODES, MEMORY_MAX_LISTENERS)
+
+async def prepare_trade_page(page):
+    """为页面安装状态推送和网络监听"""
+    await page_readiness.install(page)
+    network_state.attach(page)
+
+async def goto_trade_page(page):
+    """打开/trade并等待Swap卡片就绪"""
+    await page.goto(f"{DEFI_APP_URL}/trade", wait_until="domcontentloaded")
+    if await page_readiness.wait_for_swap_ready(PAGE_READY_TIMEOUT) is None:
+        raise TradeStateError("交易页面的Swap卡片未就绪")
+
+async def reload_trade_page(page):
+    """原地重新加载交易页面；观察脚本和绑定会自动重新注入"""
+    await page.reload(wait_until="domcontentloaded")
+    if await page_readiness.wait_for_swap_ready(PAGE_READY_TIMEOUT) is None:
+        raise TradeStateError("重新加载后Swap卡片未就绪")
+
+async def replace_trade_page(old_page):
+    """在同一个浏览器上下文中打开新页面代替旧页面，释放旧页面的全部内存"""
+    page = await old_page.context.new_page()
+    await prepare_trade_page(page)
+    # 先关闭旧页面，避免它继续推送过期的页面状态
+    await old_page.close()
+    page_readiness.state = None
+    await goto_trade_page(page)
+    return page
+
+class QuoteWatcher:
+    """
+    报价监视
+    订阅页面状态推送和网络报价，保存最近QUOTE_WATCH_WINDOW个报价；
+    成本高于上限时不立即放弃，持续监视，页面Cost一旦回落到上限以下且Swap可点击就立即返回；
+    网络报价只用于统计和提前唤醒，以页面显示的成本为准
+    """
+    def __init__(self, window):
+        self.quotes = deque(maxlen=window)  # (时间, 成本, 来源)
+        self.seq = 0
+        self._event = None
+    
+    def attach(self):
+        page_readiness.add_listener(lambda state: self.observe(state.cost, "page"))
+        network_state.add_quote_listener(lambda cost: self.observe(cost, "network"))
+    
+    def observe(self, cost, source):
+        # 页面每次推送都唤醒监视（成本不变时Swap按钮也可能变为可用）
+        if self._event is not None:
+            self._event.set()
+        if cost is None or cost <= 0:
+            return
+        # 页面每次DOM变化都会推送，成本不变时不重复记录
+        if source == "page" and self.quotes and self.quotes[-1][1] == cost and self.quotes[-1][2] == "page":
+            return
+        self.quotes.append((time.monotonic(), cost, source))
+        self.seq += 1
+    
+    def summary(self, since):
+        costs = [cost for at, cost, source in self.quotes if at >= since]
+        if not costs:
+            return "没有收到新报价"
+        return f"{len(costs)} 个报价, 最低 {min(costs)}, 最高 {max(costs)}, 最新 {costs[-1]}"
+    
+    async def wait_for_cheap_quote(self, page, cap, timeout):
+        """
+        监视报价直到页面显示的成本不超过cap且Swap按钮可用，返回当时的页面状态；超时返回None
+        网络报价低于上限但页面仍显示旧成本时继续等待，没有页面状态时视为未就绪
+        """
+        started = time.monotonic()
+        deadline = started + timeout
+        refresh_interval = QUOTE_WATCH_REFRESH_MS / 1000
+        last_seq = -1
+        last_quote_at = started
+        self._event = asyncio.Event()
+        try:
+            while True:
+                if self.seq != last_seq:
+                    last_seq = self.seq
+                    at = self.quotes[-1][0] if self.quotes else 0.0
+                    if at >= started:
+                        last_quote_at = at
+                state = page_readiness.state
+                if state is not None and state.cost is not None and 0 < state.cost <= cap and not state.swap_blocked():
+                    print(f"报价回落到 {state.cost} USDT，立即交易；{self.summary(started)}")
+                    return state
+                now = time.monotonic()
+                if now >= deadline:
+                    print(f"监视报价超时 ({timeout:g}秒)；{self.summary(started)}")
+                    return None
+                # 长时间没有新报价时重新点击ALL，让应用重新请求报价
+                if refresh_interval > 0 and now - last_quote_at >= refresh_interval:
+                    last_quote_at = now
+                    await run_ui_action(page, "all", "ALL按钮", ALL_BUTTON_STRATEGIES)
+                    continue
+                self._event.clear()
+                wait = deadline - now
+                if refresh_interval > 0:
+                    wait = min(wait, refresh_interval - (now - last_quote_at))
+                try:
+                    await asyncio.wait_for(self._event.wait(), max(wait, 0.01))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._event = None
+
+quote_watcher = QuoteWatcher(QUOTE_WATCH_WINDOW)
+
+@dataclass
+class StateBudget:
+    """交易状态的时限和重试次数；重试用完后转到recover_to"""
+    deadline: float
+    retries: int
+    recover_to: str
+
+class TradeStateError(Exception):
+    """状态处理失败，消耗该状态的一次重试"""
+    pass
+
+def _default_state_budgets():
+    align_deadline = 12.0
+    settle_deadline = PAGE_READY_TIMEOUT + 15.0
+    if LLM_ANALYSIS_MODE == "inline":
+        # 同步分析时对齐阶段包含一次LLM请求，结算阶段读取余额时可能也需要一次
+        align_deadline += LLM_CONNECT_TIMEOUT + LLM_READ_TIMEOUT
+        settle_deadline += LLM_CONNECT_TIMEOUT + LLM_READ_TIMEOUT
+    action_s = ACTION_DEADLINE_MS / 1000
+    select_all_deadline = 3 * (action_s + 2.0) + action_s + 1.0 + 2.0
+    if COMPOSITE_ACTIONS:
+        select_all_deadline += 2 * COMPOSITE_STEP_TIMEOUT_MS / 1000
+    budgets = {
+        "probe": StateBudget(45.0, 1, "stop"),
+        "align": StateBudget(align_deadline, 1, "select_all"),
+        # 组合动作（切换方向+报价，各一步超时）失败后退回逐步操作：最多3次（反转按钮+等待1秒+间隔1秒）再点击ALL
+        "select_all": StateBudget(select_all_deadline, 1, "align"),
+        "quote": StateBudget(QUOTE_WATCH_TIMEOUT + 10.0, 0, "align"),  # 含等待慢报价的5秒
+        "swap": StateBudget(ACTION_DEADLINE_MS / 1000 + 3.0, 1, "align"),
+        "confirm": StateBudget(20.0, 0, "align"),  # 重试确认可能重复提交交易
+        "settle": StateBudget(settle_deadline, 0, "align"),
+        "recycle": StateBudget(PAGE_READY_TIMEOUT + 15.0, 1, "align"),
+    }
+    # TRADE_STATE_DEADLINES 格式: "confirm=30,settle=20"
+    for item in TRADE_STATE_DEADLINES.split(","):
+        name, _, seconds = item.partition("=")
+        name = name.strip().lower()
+        if name in budgets and seconds.strip():
+            try:
+                budgets[name].deadline = float(seconds)
+            except ValueError:
+                print(f"警告: TRADE_STATE_DEADLINES 中 {item.strip()!r} 不是有效的秒数，{name} 使用默认时限 {budgets[name].deadline:g}秒")
+    return budgets
+
+class TradeStateMachine:
+    """
+    交易循环状态机: probe -> align -> select_all -> quote -> swap -> confirm -> settle -> align ...
+    每个状态在自己的时限内完成，超时或出错时在重试次数内重新执行，用完后转到恢复状态，
+    因此单笔交易的耗时有确定的上限；每次状态转换都会通知监听者（指标、日志、看门狗）
+    """
+    TRADE_STATES = ("align", "select_all", "quote", "swap", "confirm", "settle")
+    
+    def __init__(self, page, trade_count):
+        self.page = page
+        self.budgets = _default_state_budgets()
+        self.trade_count = trade_count
+        self.from_token = "USDC"
+        self.to_token = "USDT"
+        self.config = runtime_config.current
+        self.listeners = []
+        self.stop_reason = None
+        self.cooldown = None  # 进入下一个状态前执行的等待（交易间隔），不计入状态时限
+        self.cooling_down = False  # 正在执行cooldown（看门狗不把这段时间算作停滞）
+        self.cooldown_ended = 0.0
+        self.recycle_reason = None
+        self.yield_reason = None  # 看门狗请求在下一次进入align时停下的原因
+        self.confirm_pending = False  # 已点击Swap/Confirm但结果还没有记录
+        # 当前这笔交易的数据
+        self.trade_started = 0.0
+        self.state = None
+        self.quote_since = 0.0
+        self.prefetched_state = None  # 组合动作在页面内读取的报价后状态
+        self.quote_pending_since = None  # 组合动作已点击ALL但没等到报价时，点击前的quote_seq
+        self.estimated_cost = 0.0
+        self.quote_ms = 0.0
+        self.swap_ms = 0.0
+        self.confirm_ms = 0.0
+    
+    def add_listener(self, listener):
+        """listener(事件字典)，每次状态转换时调用"""
+        self.listeners.append(listener)
+    
+    def request_yield(self, reason):
+        """请求状态机在下一次进入align时停下，不打断进行中的交易"""
+        self.yield_reason = reason
+    
+    def record_unknown_outcome(self, reason):
+        """确认阶段被打断时交易可能已经上链：按已完成计入限额，并在日志中标记结果未知"""
+        global total_cost
+        if not self.confirm_pending:
+            return
+        self.confirm_pending = False
+        total_cost += self.estimated_cost
+        self.trade_count += 1
+        # 与交易日志保持一致：结果未知的交易也计入交易数指标
+        metrics.trade_completed()
+        journal.record("trade", trade_count=self.trade_count, total_cost=total_cost,
+                       **{"from": self.from_token, "to": self.to_token}, cost=self.estimated_cost,
+                       outcome="unknown", reason=reason)
+        print(f"交易 #{self.trade_count} 在确认阶段被打断 ({reason})，结果未知，按已完成计入限额")
+    
+    def trade_deadline(self):
+        """单笔交易（对齐到结算）的最长耗时，不含交易间隔"""
+        return sum(self.budgets[name].deadline * (self.budgets[name].retries + 1) for name in self.TRADE_STATES)
+    
+    def _emit(self, from_state, to_state, elapsed_ms, reason):
+        event = {
+            "from": from_state,
+            "to": to_state,
+            "elapsed_ms": round(elapsed_ms, 1),
+            "reason": reason,
+            "trade": self.trade_count + 1
+        }
+        for listener in self.listeners:
+            try:
+                listener(event)
+            except Exception as e:
+                print(f"状态转换监听出错: {e}")
+    
+    async def run(self, start="probe"):
+        """运行到停止状态，返回停止原因"""
+        current = start
+        attempts = 0
+        while current != "stop":
+            if self.cooldown is not None:
+                cooldown, self.cooldown = self.cooldown, None
+                self.cooling_down = True
+                try:
+                    with metrics.phase("sleep"):
+                        await cooldown()
+                finally:
+                    self.cooling_down = False
+                    self.cooldown_ended = time.monotonic()
+            handler = getattr(self, f"_state_{current}")
+            budget = self.budgets[current]
+            started = time.monotonic()
+            try:
+                next_state = await asyncio.wait_for(handler(), budget.deadline)
+                reason = "ok"
+                attempts = 0
+            except Exception as e:
+                if isinstance(e, asyncio.TimeoutError):
+                    reason = f"超时 ({budget.deadline:g}秒)"
+                else:
+                    reason = str(e) or type(e).__name__
+                self.record_unknown_outcome(f"状态 {current} 失败: {reason}")
+                attempts += 1
+                if attempts <= budget.retries:
+                    print(f"状态 {current} 失败: {reason}，重试 ({attempts}/{budget.retries})")
+                    next_state = current
+                else:
+                    print(f"状态 {current} 失败: {reason}，转到 {budget.recover_to}")
+                    dump_screenshot_ring(f"(状态 {current} 失败)")
+                    attempts = 0
+                    next_state = budget.recover_to
+                    if next_state == "stop":
+                        self.stop_reason = self.stop_reason or f"{current} 失败"
+                    else:
+                        pacing.note_trouble(f"状态 {current} 失败", self.config.wait_between_trades)
+                        self.cooldown = lambda: pacing.wait(self.config)
+            self._emit(current, next_state, (time.monotonic() - started) * 1000, reason)
+            current = next_state
+            if current == "align" and self.yield_reason is not None:
+                print(f"交易循环在对齐前暂停，交给看门狗恢复 ({self.yield_reason})")
+                break
+        return self.stop_reason
+    
+    async def _select_all(self, from_token, to_token, ensure_direction):
+        """
+        切换到指定方向并点击ALL
+        启用组合动作时在页面内一次完成并返回报价后的页面状态；组合动作失败时退回逐步操作，返回None
+        """
+        self.quote_pending_since = None
+        if COMPOSITE_ACTIONS:
+            quote_seq = page_readiness.quote_seq
+            result = await flip_select_all_and_quote(self.page, from_token, to_token)
+            if result.ok:
+                return result.state
+            # 没有等到报价时ALL已经点击，由读取报价的一方继续等待（_await_pending_quote）
+            if result.step == "quote":
+                self.quote_pending_since = quote_seq
+                return result.state
+            print(f"组合动作在 {result.step} 步骤失败: {result.reason}，改为逐步操作")
+            ensure_direction = True
+        if ensure_direction and not await ensure_swap_direction(self.page, from_token, to_token):
+            raise TradeStateError(f"无法切换到 {from_token} -> {to_token} 方向")
+        if not await click_all_button(self.page):
+            raise TradeStateError("无法点击ALL按钮")
+        return None
+    
+    async def _await_pending_quote(self, state):
+        """组合动作点击ALL后报价较慢时，继续等待页面推送的新报价（最多5秒），等到报价后再判断是否可交易"""
+        if self.quote_pending_since is None:
+            return state
+        since, self.quote_pending_since = self.quote_pending_since, None
+        with metrics.phase("quote_wait"):
+            quoted = await page_readiness.wait_for_cost_update(5, since)
+        return quoted or page_readiness.state or state
+    
+    async def _probe_direction(self, from_token, to_token):
+        """设置方向后点击ALL，成本在上限内且Swap可用时认为该方向可交易"""
+        print(f"尝试查看{from_token} -> {to_token}方向是否可交易...")
+        quote_since = time.monotonic()
+        state = await self._await_pending_quote(await self._select_all(from_token, to_token, True))
+        # 一次读取页面状态 - 如果有余额，会显示成本且Swap按钮可用
+        state = state or await read_swap_page_state(self.page)
+        cost = await extract_cost_from_page(self.page, state, quote_since)
+        swap_blocked = state is not None and state.swap_blocked()
+        if cost > 0 and cost <= self.config.max_cost_per_trade and not swap_blocked:
+            print(f"{from_token} -> {to_token} 方向可交易，成本: {cost}")
+            return True
+        print(f"{from_token} -> {to_token} 方向不可交易，成本: {cost}")
+        return False
+    
+    async def _state_probe(self):
+        """依次检查两个方向，选择有余额且成本合适的方向"""
+        for from_token, to_token in (("USDC", "USDT"), ("USDT", "USDC")):
+            try:
+                if await self._probe_direction(from_token, to_token):
+                    self.from_token, self.to_token = from_token, to_token
+                    print(f"使用{from_token} -> {to_token}方向开始交易")
+                    metrics.reset_clock()
+                    return "align"
+            except Exception as e:
+                print(f"测试{from_token}方向时出错: {e}")
+        self.stop_reason = "no_direction"
+        return "stop"
+    
+    async def _state_align(self):
+        """一笔交易的开始：检查限额，确认交易方向，按采样间隔分析截图"""
+        # 每次交易前检查配置是否有修改，新的限额立即生效
+        self.config = runtime_config.refresh()
+        if self.config.limit_reached(self.trade_count, total_cost):
+            self.stop_reason = "limit"
+            return "stop"
+        self.trade_started = time.perf_counter()
+        print(f"\n--- 开始第 {self.trade_count+1} 次交易 ---")
+        print(f"当前交易方向: {self.from_token} -> {self.to_token}")
+        
+        # 读取一次页面状态，再次确认交易方向是否正确（组合动作会在点击ALL时一起切换方向）
+        if not COMPOSITE_ACTIONS:
+            with metrics.phase("direction"):
+                state = await read_swap_page_state(self.page)
+                direction_correct = await ensure_swap_direction(self.page, self.from_token, self.to_token, state)
+            if not direction_correct:
+                print("无法设置正确的交易方向，尝试继续...")
+        
+        # 按采样间隔分析当前截图（只截取Swap卡片并保存在内存中）
+        # 所有模型都在熔断冷却期时不截图，分析不会有结果
+        if LLM_ANALYSIS_MODE != "off" and self.trade_count % LLM_ANALYSIS_EVERY == 0 and llm_gateway.available():
+            image, mime_type = await capture_swap_screenshot(self.page, label=f"trade_{self.trade_count}")
+            # 状态提示词只包含交易方向，使相邻的相似截图可以命中分析缓存
+            current_status = f"交易方向: {self.from_token} -> {self.to_token}"
+            if LLM_ANALYSIS_MODE == "inline":
+                analysis = await analyze_with_llm(image, current_status, mime_type)
+                if analysis is not None:
+                    analysis_state.publish(analysis, self.trade_count)
+                    print(f"\n--- LLM分析 ---\n{format_llm_analysis(analysis)}\n")
+            else:
+                # 后台分析，结果发布到analysis_state，交易不等待模型
+                analysis_state.schedule(image, current_status, mime_type, self.trade_count)
+        return "select_all"
+    
+    async def _state_select_all(self):
+        """点击ALL按钮以选择最大交易额"""
+        self.quote_since = time.monotonic()
+        with metrics.phase("all_click"):
+            self.prefetched_state = await self._select_all(self.from_token, self.to_token, False)
+        return "quote"
+    
+    async def _state_quote(self):
+        """读取报价；成本过高时监视报价回落，仍不可交易则切换方向"""
+        # 点击ALL时已等待成本更新；组合动作已经返回报价后的状态时不再读取页面
+        with metrics.phase("cost"):
+            self.state = await self._await_pending_quote(self.prefetched_state)
+            self.state = self.state or await read_swap_page_state(self.page)
+            self.prefetched_state = None
+            self.estimated_cost = await extract_cost_from_page(self.page, self.state, self.quote_since)
+        self.quote_ms = (time.monotonic() - self.quote_since) * 1000
+        print(f"选择ALL后预计交易成本: {self.estimated_cost} USDT")
+        journal.record("quote", trade=self.trade_count + 1, direction=f"{self.from_token}->{self.to_token}",
+                       cost=self.estimated_cost, quote_ms=round(self.quote_ms, 1))
+        
+        # 读取最近一次分析结果（不等待），仅作参考提示
+        latest_analysis = analysis_state.fresh()
+        if latest_analysis is not None and latest_analysis["recommendation"] == "skip":
+            print(f"最近的LLM分析不建议交易: {latest_analysis['reason']}")
+        
+        # 检查是否有足够余额进行交易（通过成本和Swap按钮状态判断）
+        cap = self.config.max_cost_per_trade
+        swap_blocked = self.state is not None and self.state.swap_blocked()
+        
+        # 有报价但成本高于上限：持续监视报价，回落到上限以下立即交易，而不是直接切换方向
+        if self.estimated_cost > cap and QUOTE_WATCH_TIMEOUT > 0:
+            print(f"成本 {self.estimated_cost} USDT 高于上限，监视报价最多 {QUOTE_WATCH_TIMEOUT:g} 秒")
+            with metrics.phase("quote_watch"):
+                cheap_state = await quote_watcher.wait_for_cheap_quote(self.page, cap, QUOTE_WATCH_TIMEOUT)
+            if cheap_state is not None:
+                # 记录和累计的成本取自页面状态，而不是触发唤醒的网络报价
+                self.state = cheap_state
+                self.estimated_cost = await extract_cost_from_page(self.page, cheap_state)
+                swap_blocked = cheap_state.swap_blocked()
+                journal.record("quote", trade=self.trade_count + 1, direction=f"{self.from_token}->{self.to_token}",
+                               cost=self.estimated_cost, watched=True)
+        
+        if 0 < self.estimated_cost <= cap and not swap_blocked:
+            # 组合动作失败或超时后方向可能没有切换，确认页面方向与记录的方向一致才交易
+            state = self.state
+            if state is None or not state.has_direction():
+                state = await extract_accessible_state(self.page) or state
+            if state is None or not state.direction_is(self.from_token, self.to_token):
+                current = f"{state.from_token}->{state.to_token}" if state is not None and state.has_direction() else "未知"
+                raise TradeStateError(f"页面交易方向 ({current}) 与预期 {self.from_token}->{self.to_token} 不一致")
+            return "swap"
+        
+        if swap_blocked:
+            print("Swap按钮不可用，可能余额不足，尝试切换方向")
+        else:
+            print(f"交易成本不合适: {self.estimated_cost} USDT，尝试切换方向")
+        # 切换方向，下一次对齐时点击反转按钮
+        self.from_token, self.to_token = self.to_token, self.from_token
+        print(f"新的交易方向: {self.from_token} -> {self.to_token}")
+        self.cooldown = lambda: asyncio.sleep(self.config.wait_between_trades)
+        return "align"
+    
+    async def _state_swap(self):
+        swap_started = time.monotonic()
+        with metrics.phase("swap_click"):
+            swap_clicked = await click_swap_button(self.page)
+        if not swap_clicked:
+            raise TradeStateError("无法点击Swap按钮")
+        print("已点击Swap按钮")
+        self.swap_ms = (time.monotonic() - swap_started) * 1000
+        journal.record("swap", trade=self.trade_count + 1, swap_ms=round(self.swap_ms, 1))
+        return "confirm"
+    
+    async def _state_confirm(self):
+        global total_cost
+        confirm_started = time.monotonic()
+        self.confirm_pending = True
+        with metrics.phase("confirm"):
+            confirmed = await confirm_transaction(self.page)
+        self.confirm_pending = False
+        self.confirm_ms = (time.monotonic() - confirm_started) * 1000
+        journal.record("confirm", trade=self.trade_count + 1, ok=confirmed, confirm_ms=round(self.confirm_ms, 1))
+        if not confirmed:
+            raise TradeStateError("交易未确认")
+        
+        # 记录交易（带累计值，重启时可直接恢复）
+        total_cost += self.estimated_cost
+        self.trade_count += 1
+        metrics.trade_completed()
+        journal.record("trade", trade_count=self.trade_count, total_cost=total_cost,
+                       **{"from": self.from_token, "to": self.to_token}, cost=self.estimated_cost,
+                       timings={"quote_ms": round(self.quote_ms, 1), "swap_ms": round(self.swap_ms, 1),
+                                "confirm_ms": round(self.confirm_ms, 1)})
+        print(f"完成交易 #{self.trade_count}: {self.from_token} -> {self.to_token}")
+        print(f"成本: {self.estimated_cost} USDT, 总消耗: {total_cost} USDT")
+        return "settle"
+    
+    async def _state_settle(self):
+        """等待交易结算，反转方向为下一笔交易做准备"""
+        # Swap卡片可操作且余额已经更新（页面没有显示余额时只等卡片就绪）
+        ready_started = time.monotonic()
+        balances_before = self.state.balances if self.state is not None else {}
+        with metrics.phase("settle"):
+            settled = await page_readiness.wait_for(
+                lambda s: s.swap_button.present and s.all_button.present
+                and (not balances_before or s.balances != balances_before),
+                pacing.settle_timeout(),
+                "交易结算"
+            )
+        
+        # 记录结算后的余额：页面 -> 网络报文 -> 无障碍树，LLM只在inline模式下同步请求
+        with metrics.phase("balances"):
+            balances = await extract_balances_from_page(self.page, settled, llm_sync=LLM_ANALYSIS_MODE == "inline")
+        journal.record("balances", trade=self.trade_count, **balances)
+        
+        # 交易完成后交换From和To代币（先交换变量，再点击反转按钮）
+        old_from, old_to = self.from_token, self.to_token
+        self.from_token, self.to_token = self.to_token, self.from_token
+        print(f"正在将交易方向从 {old_from}->{old_to} 反转为 {self.from_token}->{self.to_token}")
+        if COMPOSITE_ACTIONS:
+            # 下一次点击ALL的组合动作会在页面内切换方向，这里不再单独点击
+            reversed_ok = True
+        else:
+            with metrics.phase("reverse"):
+                reversed_ok = await click_reverse_button(self.page)
+                if reversed_ok:
+                    await page_readiness.wait_for_direction(self.from_token, self.to_token, 1)
+        if not reversed_ok:
+            # 对齐状态会重新确认方向
+            print("警告: 无法点击反转按钮，将在下一次交易前重新确认方向")
+        
+        metrics.observe("trade_total", (time.perf_counter() - self.trade_started) * 1000)
+        ready_ms = (time.monotonic() - ready_started) * 1000 if settled is not None else None
+        pacing.record_trade(self.confirm_ms, ready_ms)
+        # 结算完成即可开始下一笔；出现错误或限流时退避
+        self.cooldown = lambda: pacing.wait(self.config)
+        
+        # 两笔交易之间是回收页面的安全点
+        self.recycle_reason = await memory_watchdog.needs_recycle(self.trade_count)
+        if self.recycle_reason is not None:
+            return "recycle"
+        return "align"
     
-    # 默认值
-    print("无法找到成本，返回默认值0.2")
-    return 0.2
+    async def _state_recycle(self):
+        """浏览器内存超限：重新加载或替换页面，交易计数、方向等循环状态保持不变"""
+        before = memory_watchdog.last or {}
+        print(f"浏览器内存超限 ({self.recycle_reason})，{'替换页面' if MEMORY_RECYCLE_MODE == 'new_page' else '重新加载页面'}")
+        if MEMORY_RECYCLE_MODE == "new_page":
+            self.page = await replace_trade_page(self.page)
+        else:
+            await reload_trade_page(self.page)
+        await memory_watchdog.attach(self.page)
+        memory_watchdog.recycles += 1
+        after = await memory_watchdog.sample() if memory_watchdog.cdp is not None else {}
+        print(f"页面回收完成: JS堆 {before.get('js_heap_bytes', 0) / 1048576:.0f}MB -> {after.get('js_heap_bytes', 0) / 1048576:.0f}MB, "
+              f"DOM节点 {before.get('dom_nodes', 0):.0f} -> {after.get('dom_nodes', 0):.0f}")
+        journal.record("recycle", trade_count=self.trade_count, reason=self.recycle_reason, mode=MEMORY_RECYCLE_MODE,
+                       before=before, after=after)
+        return "align"
 
-async def get_viewport_dimensions(page):
-    """获取当前页面视图尺寸"""
-    return await page.evaluate('() => { return {width: window.innerWidth, height: window.innerHeight} }')
+def on_state_transition(event):
+    """状态转换计数；非正常转换写入交易日志"""
+    metrics.count_transition(event["from"], event["to"])
+    if event["reason"] != "ok":
+        journal.record("transition", **event)
 
-async def click_swap_button(page):
+class Supervisor:
     """
-    尝试使用多种方法点击Swap按钮
-    优先使用DeFi应用提供的特定选择器
+    交易循环看门狗
+    通过状态转换事件接收心跳：长时间没有任何状态转换（页面卡死）时立即取消当前循环，
+    交易间隔和退避等待（cooldown）期间不算停滞，等待结束时重新计时；
+    连续多次状态失败且没有完成交易时，等状态机下一次进入align再停下，不打断进行中的交易；
+    然后按代价从低到高恢复：重新对齐 -> 重新打开/trade -> 新页面 -> 新浏览器上下文，
+    完成一笔交易后恢复等级归零；所有步骤都失败时退出，由外部重启进程
     """
-    try:
-        # 直接使用提供的Swap按钮选择器
-        swap_button = await page.locator('button[data-testid="swap-swap-button"]').first
-        if swap_button:
-            await swap_button.click()
-            print("成功点击Swap按钮 (通过data-testid)")
-            return True
-    except Exception as e:
-        print(f"使用data-testid查找Swap按钮失败: {e}")
+    def __init__(self, machine, browser_session, stall_seconds, max_failures):
+        self.machine = machine
+        self.browser_session = browser_session
+        self.stall_seconds = stall_seconds
+        self.max_failures = max_failures
+        self.last_beat = time.monotonic()
+        self.failures = 0
+        self.level = 0
+        self.probed = False
+        self.recoveries = 0
+        self.steps = [
+            ("realign", self._realign),
+            ("reload", self._reload),
+            ("new_page", self._new_page),
+            ("new_context", self._new_context),
+        ]
+        machine.add_listener(self.heartbeat)
     
-    try:
-        # 使用ID选择器
-        swap_button = await page.locator('#swap-swap-button').first
-        if swap_button:
-            await swap_button.click()
-            print("成功点击Swap按钮 (通过ID)")
-            return True
-    except Exception as e:
-        print(f"使用ID查找Swap按钮失败: {e}")
+    def heartbeat(self, event):
+        self.last_beat = time.monotonic()
+        if event["from"] == "probe" and event["to"] == "align":
+            self.probed = True
+        if event["reason"] != "ok":
+            self.failures += 1
+        elif event["from"] == "confirm" and event["to"] == "settle":
+            # 完成一笔交易，循环恢复正常
+            self.failures = 0
+            self.level = 0
     
-    try:
-        # 使用文本内容
-        swap_button = await page.locator('button:has-text("Swap")').first
-        if swap_button:
-            await swap_button.click()
-            print("成功点击Swap按钮 (通过文本)")
+    def _idle_reason(self):
+        if self.machine.cooling_down:
+            return None
+        idle = time.monotonic() - max(self.last_beat, self.machine.cooldown_ended)
+        if idle > self.stall_seconds:
+            return f"{idle:.0f}秒没有状态转换"
+        return None
+    
+    async def run(self):
+        """运行状态机直到结束，返回停止原因"""
+        if self.stall_seconds <= 0:
+            return await self.machine.run()
+        start = "probe"
+        while True:
+            self.last_beat = time.monotonic()
+            self.failures = 0
+            self.machine.yield_reason = None
+            task = asyncio.ensure_future(self.machine.run(start))
+            reason = None
+            while reason is None and not task.done():
+                await asyncio.wait({task}, timeout=1)
+                if task.done():
+                    break
+                reason = self._idle_reason()
+                if self.failures >= self.max_failures and self.machine.yield_reason is None:
+                    self.machine.request_yield(f"连续 {self.failures} 次状态失败")
+            if task.done():
+                if self.machine.yield_reason is None:
+                    return task.result()
+                reason = self.machine.yield_reason
+            else:
+                # 页面卡死，只能直接取消；确认阶段被取消时记录结果未知的交易
+                task.cancel()
+                try:
+                    await task
+                except (asyncio.CancelledError, Exception):
+                    pass
+                self.machine.record_unknown_outcome(reason)
+            dump_screenshot_ring(f"(交易循环停滞: {reason})")
+            if not await self.recover(reason):
+                return "unrecoverable"
+            start = "align" if self.probed else "probe"
+    
+    async def recover(self, reason):
+        """从当前等级开始依次尝试恢复步骤，成功返回True"""
+        while self.level < len(self.steps):
+            name, step = self.steps[self.level]
+            self.level += 1
+            print(f"检测到交易循环停滞 ({reason})，恢复步骤: {name}")
+            started = time.monotonic()
+            try:
+                await asyncio.wait_for(step(), SUPERVISOR_STEP_TIMEOUT)
+            except Exception as e:
+                elapsed_ms = (time.monotonic() - started) * 1000
+                print(f"恢复步骤 {name} 失败: {e or type(e).__name__}")
+                journal.record("recovery", step=name, reason=reason, ok=False, ms=round(elapsed_ms, 1))
+                continue
+            elapsed_ms = (time.monotonic() - started) * 1000
+            self.recoveries += 1
+            metrics.observe(f"recovery_{name}", elapsed_ms)
+            journal.record("recovery", step=name, reason=reason, ok=True, ms=round(elapsed_ms, 1))
+            print(f"恢复步骤 {name} 完成，用时 {elapsed_ms / 1000:.1f}秒")
             return True
-    except Exception as e:
-        print(f"使用文本查找Swap按钮失败: {e}")
+        print("所有恢复步骤都失败，退出交易循环")
+        return False
     
-    try:
-        # 使用类选择器和文本的组合
-        await page.click('button.bg-action-primary:has-text("Swap")')
-        print("成功点击Swap按钮 (通过类+文本)")
-        return True
-    except Exception as e:
-        print(f"使用类+文本查找Swap按钮失败: {e}")
+    async def _realign(self):
+        if await page_readiness.wait_for_swap_ready(5) is None:
+            raise TradeStateError("Swap卡片未就绪")
+        if not await ensure_swap_direction(self.machine.page, self.machine.from_token, self.machine.to_token):
+            raise TradeStateError("无法对齐交易方向")
     
-    try:
-        # 最后尝试：直接使用JavaScript执行点击
-        await page.evaluate('''
-            (() => {
-                // 尝试各种选择器
-                const selectors = [
-                    'button[data-testid="swap-swap-button"]',
-                    '#swap-swap-button',
-                    'button.bg-action-primary',
-                    'button:has-text("Swap")'
-                ];
-                
-                for (const selector of selectors) {
-                    const button = document.querySelector(selector);
-                    if (button) {
-                        button.click();
-                        return true;
-                    }
-                }
-                
-                // 查找底部的大按钮
-                const buttons = Array.from(document.querySelectorAll('button'));
-                const viewport_height = window.innerHeight;
-                for (const button of buttons) {
-                    const rect = button.getBoundingClientRect();
-                    if (rect.y > viewport_height * 0.7 && rect.width > 100) {
-                        button.click();
-                        return true;
-                    }
-                }
-                
-                return false;
-            })()
-        ''')
-        print("尝试通过JavaScript点击Swap按钮")
-        return True
-    except Exception as e:
-        print(f"JavaScript点击Swap按钮失败: {e}")
+    async def _reload(self):
+        await goto_trade_page(self.machine.page)
     
-    return False
+    async def _new_page(self):
+        self.machine.page = await replace_trade_page(self.machine.page)
+        await memory_watchdog.attach(self.machine.page)
+    
+    async def _new_context(self):
+        context = await self.browser_session.renew_context()
+        page = context.pages[0] if context.pages else await context.new_page()
+        await prepare_trade_page(page)
+        page_readiness.state = None
+        await goto_trade_page(page)
+        self.machine.page = page
+        await memory_watchdog.attach(page)
 
-async def click_reverse_button(page):
+# 精简模式：关闭动画和过渡，让UI立即进入最终状态
+NO_MOTION_INIT_JS = """
+(() => {
+    const inject = () => {
+        const style = document.createElement('style');
+        style.textContent = `*, *::before, *::after {
+            transition: none !important;
+            animation: none !important;
+            scroll-behavior: auto !important;
+            caret-color: transparent !important;
+        }`;
+        document.documentElement.appendChild(style);
+    };
+    if (document.documentElement) {
+        inject();
+    } else {
+        document.addEventListener('DOMContentLoaded', inject);
+    }
+})()
+"""
+
+# 精简模式额外的Chromium参数
+LEAN_BROWSER_ARGS = [
+    '--disable-extensions',
+    '--disable-background-networking',
+    '--disable-component-update',
+    '--disable-default-apps',
+    '--disable-sync',
+    '--mute-audio',
+    '--no-first-run'
+]
+
+blocked_requests = {"count": 0}
+
+def should_block_request(request):
+    """精简模式下拦截不需要的资源类型和第三方统计/监控域名"""
+    if request.resource_type in LEAN_BLOCK_RESOURCE_TYPES:
+        return True
+    host = urlparse(request.url).hostname or ""
+    return any(host == blocked or host.endswith("." + blocked) for blocked in LEAN_BLOCK_HOSTS)
+
+# 静态资源文件名中的内容哈希（如 main.3f9a1c2b.js），这类文件内容不会变化
+HASHED_ASSET_PATTERN = re.compile(r"[.\-_][0-9a-fA-F]{8,}\.(js|mjs|css|woff2?|ttf)$")
+CACHED_RESOURCE_TYPES = {"script", "stylesheet", "font", "image"}
+# 只有URL像静态资源的请求才经过缓存路由，报价、交易等接口请求不进入Python
+STATIC_ASSET_URL_PATTERN = re.compile(r"\.(js|mjs|css|woff2?|ttf|otf|png|jpe?g|gif|svg|webp|ico)(\?.*)?$", re.IGNORECASE)
+# 响应体已解码，回放时不能再带原始的压缩和长度头
+UNCACHED_HEADERS = {"content-encoding", "content-length", "transfer-encoding", "connection", "set-cookie"}
+
+class StaticAssetCache:
     """
-    尝试使用多种方法点击代币切换/反转按钮
-    通常这个按钮位于两个代币选择框之间
+    应用前端静态资源（脚本、样式、字体、图片）的磁盘缓存
+    拦截请求后浏览器自带的HTTP缓存不再生效，这里按URL保存响应，
+    重启和刷新页面时直接从磁盘返回，不再重新下载前端包；文件读写放在线程池中，不阻塞事件循环
     """
-    print("尝试点击交易方向反转按钮...")
+    def __init__(self, cache_dir, max_age):
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
     
-    # 多次尝试，确保点击成功
-    for attempt in range(3):
-        try:
-            # 使用提供的精确元素选择器
-            await page.click('button.size-10\\.5.-translate-x-1\\/2.-translate-y-1\\/2:has(.lucide-arrow-up-down)')
-            print("成功点击反转按钮 (通过提供的精确选择器)")
-            return True
-        except Exception:
-            print(f"尝试 {attempt+1}: 使用精确选择器失败")
-        
-        try:
-            # 尝试使用lucide-arrow-up-down类选择器
-            await page.click('button:has(.lucide-arrow-up-down)')
-            print("成功点击反转按钮 (通过lucide-arrow-up-down图标)")
-            return True
-        except Exception:
-            print(f"尝试 {attempt+1}: 使用lucide-arrow-up-down选择器失败")
-        
-        try:
-            # 尝试点击带有数据属性的反转按钮
-            await page.click('button[data-testid="swap-switch-tokens-button"]')
-            print("成功点击反转按钮 (通过data-testid)")
-            return True
-        except Exception:
-            print(f"尝试 {attempt+1}: 使用data-testid选择器失败")
-        
+    @property
+    def enabled(self):
+        return bool(self.cache_dir)
+    
+    def cacheable(self, request):
+        return (request.method == "GET" and request.resource_type in CACHED_RESOURCE_TYPES
+                and bool(STATIC_ASSET_URL_PATTERN.search(request.url)))
+    
+    def _paths(self, url):
+        key = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, key + ".json"), os.path.join(self.cache_dir, key + ".body")
+    
+    def _lifetime(self, url, headers):
+        """响应允许缓存的秒数，0表示不缓存"""
+        cache_control = headers.get("cache-control", "").lower()
+        if "no-store" in cache_control or "private" in cache_control:
+            return 0
+        if "immutable" in cache_control or HASHED_ASSET_PATTERN.search(urlparse(url).path):
+            return self.max_age
+        max_age_match = re.search(r"max-age=(\d+)", cache_control)
+        if max_age_match:
+            return min(int(max_age_match.group(1)), self.max_age)
+        return 0
+    
+    def load(self, url):
+        meta_path, body_path = self._paths(url)
         try:
-            # 尝试使用绝对位置定位
-            await page.click('button.absolute.left-1\\/2.top-1\\.5')
-            print("成功点击反转按钮 (通过位置选择器)")
-            return True
-        except Exception:
-            print(f"尝试 {attempt+1}: 使用位置选择器失败")
-        
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta["expires"] < time.time():
+                return None
+            with open(body_path, "rb") as f:
+                return meta, f.read()
+        except (OSError, ValueError, KeyError):
+            return None
+    
+    def store(self, url, status, headers, body):
+        """保存响应，返回是否写入了缓存"""
+        lifetime = self._lifetime(url, headers)
+        if status != 200 or lifetime <= 0:
+            return False
+        meta_path, body_path = self._paths(url)
+        meta = {
+            "url": url,
+            "status": status,
+            "headers": {name: value for name, value in headers.items() if name.lower() not in UNCACHED_HEADERS},
+            "expires": time.time() + lifetime
+        }
         try:
-            # 尝试通过类属性和SVG子元素查找
-            await page.click('button:has(svg.lucide-arrow-up-down)')
-            print("成功点击反转按钮 (通过SVG选择器)")
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # 先写响应体再写元数据，元数据存在即表示条目完整
+            with open(body_path, "wb") as f:
+                f.write(body)
+            tmp_path = meta_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(meta, f)
+            os.replace(tmp_path, meta_path)
             return True
-        except Exception:
-            print(f"尝试 {attempt+1}: 使用SVG选择器失败")
-        
+        except OSError as e:
+            print(f"写入静态资源缓存失败: {e}")
+            return False
+    
+    async def serve(self, route):
+        """命中缓存直接返回，否则请求网络并保存可缓存的响应"""
+        if not self.cacheable(route.request):
+            await route.fallback()
+            return
+        url = route.request.url
+        loop = asyncio.get_event_loop()
+        cached = await loop.run_in_executor(None, self.load, url)
+        if cached is not None:
+            meta, body = cached
+            self.hits += 1
+            await route.fulfill(status=meta["status"], headers=meta["headers"], body=body)
+            return
+        self.misses += 1
         try:
-            # 尝试通过各种常见的反转图标文本查找
-            for symbol in ['↑↓', '⇅', '⇵', '↕', '↓↑', '⇆']:
-                try:
-                    reverse_button = await page.locator(f'button:has-text("{symbol}")').first
-                    if reverse_button:
-                        await reverse_button.click()
-                        print(f"成功点击反转按钮 (通过符号 {symbol})")
-                        return True
-                except Exception:
-                    continue
-            print(f"尝试 {attempt+1}: 使用符号文本失败")
+            response = await route.fetch()
+            body = await response.body()
         except Exception:
-            pass
-        
-        try:
-            # 精确定位屏幕中央附近的按钮
-            # 先获取视口大小
-            viewport = await page.evaluate('''() => {
-                return {
-                    width: window.innerWidth,
-                    height: window.innerHeight
-                }
-            }''')
-            
-            center_x = viewport['width'] / 2
-            top_center_y = viewport['height'] * 0.3  # 大约在屏幕上部 1/3 处
-            
-            # 使用evaluate查找最接近位置的按钮
-            found = await page.evaluate('''({centerX, topCenterY}) => {
-                const buttons = Array.from(document.querySelectorAll('button'));
-                
-                // 找到最接近中心的按钮
-                let closestButton = null;
-                let minDistance = Infinity;
-                
-                for (const button of buttons) {
-                    const rect = button.getBoundingClientRect();
-                    const buttonCenterX = rect.left + rect.width / 2;
-                    const buttonCenterY = rect.top + rect.height / 2;
-                    
-                    // 计算到目标位置的距离
-                    const distance = Math.sqrt(
-                        Math.pow(buttonCenterX - centerX, 2) + 
-                        Math.pow(buttonCenterY - topCenterY, 2)
-                    );
-                    
-                    // 只考虑小按钮（可能是反转按钮）
-                    if (rect.width < 60 && rect.height < 60 && distance < minDistance) {
-                        minDistance = distance;
-                        closestButton = button;
-                    }
-                }
-                
-                // 如果找到了按钮，点击它
-                if (closestButton && minDistance < 100) {
-                    closestButton.click();
-                    return true;
-                }
-                
-                return false;
-            }''', {'centerX': center_x, 'topCenterY': top_center_y})
-            
-            if found:
-                print("成功点击反转按钮 (通过计算屏幕中央最近的按钮)")
-                return True
-            else:
-                print(f"尝试 {attempt+1}: 通过计算中央位置点击失败")
-        except Exception as e:
-            print(f"尝试 {attempt+1}: 计算中央位置时出错: {e}")
-        
-        # 如果所有方法失败，短暂等待后重试
-        await asyncio.sleep(1)
+            await route.continue_()
+            return
+        await route.fulfill(response=response, body=body)
+        if await loop.run_in_executor(None, self.store, url, response.status, response.headers, body):
+            self.stored += 1
+
+static_cache = StaticAssetCache(HTTP_CACHE_DIR, HTTP_CACHE_MAX_AGE)
+
+async def handle_route(route):
+    request = route.request
+    if LEAN_MODE and should_block_request(request):
+        blocked_requests["count"] += 1
+        await route.abort()
+    elif static_cache.enabled and STATIC_ASSET_URL_PATTERN.search(request.url):
+        await static_cache.serve(route)
+    else:
+        # 交给其他路由处理（回放模式下由HAR响应），没有其他路由时正常请求网络
+        await route.fallback()
+
+async def apply_lean_mode(context):
+    """为浏览器上下文安装关闭动画的脚本（资源拦截在handle_route中）"""
+    await context.add_init_script(NO_MOTION_INIT_JS)
+    print(f"已启用精简模式: 拦截资源类型 {','.join(sorted(LEAN_BLOCK_RESOURCE_TYPES))} 和 {len(LEAN_BLOCK_HOSTS)} 个第三方域名")
+
+class SessionRecorder:
+    """
+    录制/回放真实交易会话
+    record: 把整个会话的网络请求保存为HAR，并在每次状态转换时保存页面DOM快照；
+    replay: 通过route_from_har用录制的HAR响应页面请求，离线、可重复地运行完整交易循环
+    看门狗换新上下文时每个上下文录制到单独的HAR（session.har、session_1.har ...），回放时按顺序使用
+    DOM快照可以用 benchmark.py --profile-selectors 离线统计各选择器策略的命中率和耗时
+    """
+    def __init__(self, mode, directory, max_snapshots):
+        self.mode = mode if mode in ("record", "replay") else ""
+        self.directory = directory
+        self.har_path = os.path.join(directory, "session.har")
+        self.har_files = []  # 已打开的上下文对应的HAR文件
+        self.dom_dir = os.path.join(directory, "dom")
+        self.max_snapshots = max_snapshots
+        self.snapshots = []
+        self.tasks = set()
     
-    # 最后的尝试：直接使用页面坐标点击反转按钮的位置
-    try:
-        # 假设按钮在页面中央偏上的位置
-        viewport = await page.evaluate('() => { return {width: window.innerWidth, height: window.innerHeight} }')
-        center_x = viewport['width'] / 2
-        center_y = viewport['height'] * 0.3
-        
-        # 点击该位置
-        await page.mouse.click(center_x, center_y)
-        print("尝试使用绝对坐标点击反转按钮位置")
-        return True
-    except Exception as e:
-        print(f"使用绝对坐标点击失败: {e}")
+    @property
+    def active(self):
+        return bool(self.mode)
     
-    print("所有点击反转按钮的尝试均失败")
-    return False
-
-async def ensure_swap_direction(page, current_from_token, current_to_token):
-    """确保交易方向正确，如果不正确则调整"""
-    for attempt in range(3):  # 最多尝试3次
+    def _har_file(self, index):
+        return self.har_path if index == 0 else os.path.join(self.directory, f"session_{index}.har")
+    
+    def context_options(self):
+        """每个新上下文调用一次；录制时返回该上下文自己的HAR路径，换上下文时不会覆盖之前的录制"""
+        if self.mode != "record":
+            return {}
+        os.makedirs(self.dom_dir, exist_ok=True)
+        har_file = self._har_file(len(self.har_files))
+        self.har_files.append(har_file)
+        return {"record_har_path": har_file, "record_har_mode": "full"}
+    
+    async def prepare(self, context):
+        """回放模式下用HAR响应请求，HAR中没有的请求直接失败，保证不访问线上应用"""
+        if self.mode == "record":
+            print(f"录制模式: 会话保存到 {self.directory}")
+        elif self.mode == "replay":
+            # 按上下文顺序使用对应的HAR，录制时没有换过上下文的会话一直使用session.har
+            har_file = self._har_file(len(self.har_files))
+            if not os.path.exists(har_file):
+                har_file = self.har_files[-1] if self.har_files else self.har_path
+            if not os.path.exists(har_file):
+                raise FileNotFoundError(f"找不到录制的会话: {har_file}")
+            self.har_files.append(har_file)
+            await context.route_from_har(har_file, not_found="abort")
+            print(f"回放模式: 使用 {har_file}")
+    
+    def attach(self, machine):
+        if self.mode == "record":
+            # 页面可能被内存看门狗替换，快照总是取状态机当前的页面
+            machine.add_listener(lambda event: self._schedule_snapshot(machine.page, event))
+    
+    def _schedule_snapshot(self, page, event):
+        if len(self.snapshots) + len(self.tasks) >= self.max_snapshots:
+            return
+        task = asyncio.ensure_future(self._snapshot(page, event, len(self.snapshots) + len(self.tasks)))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+    
+    async def _snapshot(self, page, event, index):
         try:
-            # 获取当前显示的代币顺序
-            token_elements = await page.locator("text=/USDC|USDT/").all()
-            if len(token_elements) >= 2:
-                from_token_text = await token_elements[0].text_content()
-                to_token_text = await token_elements[1].text_content()
-                
-                detected_from = "USDC" if "USDC" in from_token_text else "USDT"
-                detected_to = "USDT" if "USDT" in to_token_text else "USDC"
-                
-                print(f"检测到当前交易方向: {detected_from} -> {detected_to}")
-                
-                # 如果方向不匹配预期，点击反转按钮
-                if detected_from != current_from_token or detected_to != current_to_token:
-                    print(f"交易方向不匹配，需要反转 (当前: {detected_from}->{detected_to}, 预期: {current_from_token}->{current_to_token})")
-                    if await click_reverse_button(page):
-                        print("已点击反转按钮调整交易方向")
-                        await asyncio.sleep(1)  # 等待UI更新
-                        
-                        # 再次检查方向是否正确
-                        continue
-                    else:
-                        print(f"尝试 {attempt+1}: 无法调整交易方向")
-                else:
-                    print("交易方向已正确")
-                    return True
-            else:
-                print(f"尝试 {attempt+1}: 无法检测到代币文本")
+            html = await page.content()
         except Exception as e:
-            print(f"尝试 {attempt+1}: 检查交易方向时出错: {e}")
-        
-        await asyncio.sleep(1)
+            print(f"保存DOM快照失败: {e}")
+            return
+        filename = f"{index:04d}_{event['to']}.html"
+        with open(os.path.join(self.dom_dir, filename), "w", encoding="utf-8") as f:
+            f.write(html)
+        self.snapshots.append({"file": filename, "url": page.url, "time": datetime.now().isoformat(), **event})
     
-    print("无法确保交易方向正确")
-    return False
+    async def finish(self):
+        """等待未完成的快照并写入索引；HAR在关闭浏览器上下文时写入"""
+        if self.mode != "record":
+            return
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.snapshots.sort(key=lambda snapshot: snapshot["file"])
+        with open(os.path.join(self.directory, "session.json"), "w", encoding="utf-8") as f:
+            json.dump({
+                "app_url": DEFI_APP_URL,
+                "recorded_at": datetime.now().isoformat(),
+                "har_files": [os.path.basename(har_file) for har_file in self.har_files],
+                "snapshots": self.snapshots
+            }, f, ensure_ascii=False, indent=2)
+        print(f"已录制会话: {len(self.snapshots)} 个DOM快照, HAR: {', '.join(self.har_files)}")
 
-async def confirm_transaction(page):
-    try:
-        # 等待并点击确认按钮
-        confirm_button = await page.wait_for_selector("button:has-text('Confirm')", timeout=2500)
-        if confirm_button:
-            await confirm_button.click()
-            print("已点击确认按钮")
-    except Exception:
-        print("未找到确认按钮，可能不需要确认")
-    
-    try:
-        # 等待交易完成的通知
-        success = await page.wait_for_selector("text=/Transaction (Submitted|Confirmed)/", timeout=5000)
-        if success:
-            print("交易已提交/确认")
-            return True
-    except Exception:
-        print("未捕获到交易成功通知")
-    
-    # 无论如何等待一段时间让交易完成
-    await asyncio.sleep(5.5)
-    return True
+session_recorder = SessionRecorder(SESSION_MODE, SESSION_DIR, SESSION_MAX_SNAPSHOTS)
+
+def browser_session_reused():
+    """是否有上一次运行留下的浏览器配置或登录状态"""
+    if BROWSER_PROFILE_DIR:
+        return os.path.isdir(BROWSER_PROFILE_DIR) and bool(os.listdir(BROWSER_PROFILE_DIR))
+    return bool(BROWSER_STORAGE_STATE) and os.path.exists(BROWSER_STORAGE_STATE)
 
-async def extract_balances_from_page(page):
+async def open_browser_context(p, browser_args, context_options):
     """
-    从页面提取USDC和USDT余额信息
-    返回包含余额的字典
+    打开浏览器上下文，返回 (browser, context)
+    设置了BROWSER_PROFILE_DIR时使用持久化上下文（browser为None），钱包扩展和登录状态都保存在该目录；
+    否则启动普通浏览器，存在BROWSER_STORAGE_STATE文件时从中恢复Cookie和localStorage
     """
-    balances = {"USDC": 0.0, "USDT": 0.0}
-    
+    if BROWSER_PROFILE_DIR:
+        os.makedirs(BROWSER_PROFILE_DIR, exist_ok=True)
+        context = await p.chromium.launch_persistent_context(
+            BROWSER_PROFILE_DIR, headless=BROWSER_HEADLESS, args=browser_args, **context_options
+        )
+        return None, context
+    browser = await p.chromium.launch(headless=BROWSER_HEADLESS, args=browser_args)
+    if BROWSER_STORAGE_STATE and os.path.exists(BROWSER_STORAGE_STATE):
+        context_options = dict(context_options, storage_state=BROWSER_STORAGE_STATE)
+    context = await browser.new_context(**context_options)
+    return browser, context
+
+async def save_browser_session(context):
+    """钱包连接后保存登录状态，下次启动直接复用"""
+    if BROWSER_PROFILE_DIR or not BROWSER_STORAGE_STATE:
+        return
     try:
-        # 尝试从页面提取余额信息
-        balance_elements = await page.locator("text=/Balance: [0-9.]+ (USDC|USDT)/").all()
-        for element in balance_elements:
-            balance_text = await element.text_content()
-            match = re.search(r"Balance: ([0-9.]+) (USDC|USDT)", balance_text)
-            if match:
-                amount = float(match.group(1))
-                token = match.group(2)
-                balances[token] = amount
-                print(f"检测到 {token} 余额: {amount}")
+        await context.storage_state(path=BROWSER_STORAGE_STATE)
     except Exception as e:
-        print(f"提取余额时出错: {e}")
-        
-        # 备用方法：尝试使用LLM分析结果中的余额信息
-        try:
-            screenshot_path = "balance_check.png"
-            await page.screenshot(path=screenshot_path)
-            analysis = await analyze_with_llm(screenshot_path, "请提取USDC和USDT余额")
-            
-            # 从分析结果中提取余额
-            usdc_match = re.search(r"USDC[:\s]+([0-9.]+)", analysis)
-            usdt_match = re.search(r"USDT[:\s]+([0-9.]+)", analysis)
-            
-            if usdc_match:
-                balances["USDC"] = float(usdc_match.group(1))
-            if usdt_match:
-                balances["USDT"] = float(usdt_match.group(1))
-        except Exception as backup_error:
-            print(f"备用余额提取方法也失败: {backup_error}")
+        print(f"保存浏览器登录状态失败: {e}")
+
+async def close_browser_context(browser, context):
+    """持久化上下文只需关闭上下文，配置会写回磁盘"""
+    await context.close()
+    if browser is not None:
+        await browser.close()
+
+class BrowserSession:
+    """
+    浏览器和当前上下文
+    集中处理上下文的初始化（录制/回放、精简模式、请求拦截），看门狗可以在进程内换一个新的上下文
+    """
+    def __init__(self, playwright, browser_args, context_options):
+        # 录制选项（每个上下文一个HAR文件）在每次打开上下文时单独加入
+        self.playwright = playwright
+        self.browser_args = browser_args
+        self.context_options = context_options
+        self.browser = None
+        self.context = None
     
-    return balances
+    def _context_options(self):
+        return dict(self.context_options, **session_recorder.context_options())
+    
+    async def open(self):
+        self.browser, self.context = await open_browser_context(self.playwright, self.browser_args, self._context_options())
+        await self._prepare(self.context)
+        return self.context
+    
+    async def _prepare(self, context):
+        await session_recorder.prepare(context)
+        if LEAN_MODE:
+            await apply_lean_mode(context)
+        if LEAN_MODE:
+            # 精简模式需要按资源类型和域名拦截，所有请求都要经过路由
+            await context.route("**/*", handle_route)
+        elif static_cache.enabled:
+            await context.route(STATIC_ASSET_URL_PATTERN, static_cache.serve)
+    
+    async def renew_context(self):
+        """关闭当前上下文并打开新的上下文，保留Cookie和localStorage（钱包连接状态）"""
+        old_context = self.context
+        if self.browser is None:
+            # 持久化上下文：同一个配置目录只能打开一个上下文，先关闭再重新打开
+            await old_context.close()
+            _, self.context = await open_browser_context(self.playwright, self.browser_args, self._context_options())
+        else:
+            try:
+                storage_state = await old_context.storage_state()
+            except Exception:
+                storage_state = None
+            options = self._context_options()
+            if storage_state:
+                options["storage_state"] = storage_state
+            self.context = await self.browser.new_context(**options)
+            await old_context.close()
+        await self._prepare(self.context)
+        return self.context
+    
+    async def close(self):
+        await close_browser_context(self.browser, self.context)
 
 async def main():
     """
@@ -440,13 +3676,41 @@ async def main():
     
     流程：
     1. 打开浏览器并访问DeFi应用
-    2. 等待用户手动连接钱包
+    2. 等待钱包连接（复用上次的浏览器配置时通常已经连接）
     3. 循环执行交易直到达到最大次数或成本上限
     4. 在每次交易后反转代币方向
     5. 记录交易历史并输出摘要
     """
     global total_cost
     
+    # 加载上一次运行的选择器策略统计
+    selector_registry.load()
+    
+    # 从交易日志恢复累计交易次数和成本，重启后继续计算成本上限
+    resumed_trades, total_cost = journal.recover()
+    # 已经达到限额时不启动浏览器，避免容器自动重启后反复操作页面
+    if runtime_config.current.limit_reached(resumed_trades, total_cost):
+        print(f"交易日志显示已达到限额 (已完成 {resumed_trades} 次交易, 总消耗 {total_cost} USDT)，"
+              f"不再启动浏览器；如需继续交易请提高 MAX_TRADES / MAX_TOTAL_COST 或更换 TRADE_JOURNAL_FILE")
+        return
+    journal.open()
+    metrics_handles = []
+    try:
+        if resumed_trades:
+            print(f"从交易日志恢复: 已完成 {resumed_trades} 次交易, 总消耗 {total_cost} USDT")
+        journal.record("start", trade_count=resumed_trades, total_cost=total_cost)
+        metrics_handles = await metrics.start_exporters()
+        await run_trade_session(resumed_trades)
+    finally:
+        # 出现异常时也保存选择器统计、刷新交易日志，关闭指标端口和LLM连接池
+        selector_registry.save(force=True)
+        journal.close()
+        await stop_metrics_exporters(metrics_handles)
+        analysis_state.cancel()
+        await close_llm_session()
+
+async def run_trade_session(resumed_trades):
+    """启动浏览器，连接钱包后运行交易循环直到停止；浏览器和录制的会话总是在这里关闭"""
     # 检测是否在Docker环境中运行
     in_docker = os.path.exists('/.dockerenv')
     print(f"运行环境: {'Docker 容器' if in_docker else '本地系统'}")
@@ -465,305 +3729,141 @@ async def main():
             '--disable-gpu'
         ]
         print("已应用Docker特定浏览器配置")
+    if LEAN_MODE:
+        browser_args += [arg for arg in LEAN_BROWSER_ARGS if arg not in browser_args]
     
     async with async_playwright() as p:
         # 启动浏览器
-        browser = await p.chromium.launch(headless=False, args=browser_args)
-        context = await browser.new_context(viewport={'width': 1280, 'height': 800})
-        page = await context.new_page()
-        
-        # 访问DeFi应用
-        await page.goto("https://app.defi.app/join/v5FvMr")
-        
-        # 等待加载并连接钱包
-        print("请在30秒内完成钱包连接...")
-        await asyncio.sleep(30)
-        
-        # 确保我们在交易页面
-        try:
-            await page.goto("https://app.defi.app/trade")
-            await page.wait_for_load_state("networkidle")
-        except Exception as e:
-            print(f"导航到交易页面失败: {e}")
-            # 如果导航失败，尝试点击Trade按钮
-            try:
-                await page.click("text=Trade")
-                await page.wait_for_load_state("networkidle")
-            except:
-                print("无法进入交易页面，请手动操作")
-        
-        # 等待页面加载完成
-        await asyncio.sleep(2.5)  # 减半：从5秒减到2.5秒
-        
-        # 尝试两种交易方向，先决定哪种方向有足够的余额
-        has_valid_trade = False
-        available_direction = None
-        
-        # 先尝试USDC -> USDT方向
-        print("尝试查看USDC -> USDT方向是否可交易...")
-        current_from_token = "USDC"
-        current_to_token = "USDT"
-        
-        # 确保方向正确
-        await ensure_swap_direction(page, current_from_token, current_to_token)
-        await asyncio.sleep(1)
-        
-        # 尝试点击ALL看是否有余额
+        context_options = {'viewport': {'width': 1280, 'height': 800}}
+        if LEAN_MODE:
+            # 减少动画；阻止Service Worker，保证所有请求都经过拦截规则
+            context_options.update(reduced_motion="reduce", service_workers="block")
+        if session_recorder.active:
+            # 录制和回放时不使用静态资源缓存，所有响应都来自网络或HAR
+            static_cache.cache_dir = ""
+        session_reused = browser_session_reused()
+        browser_session = BrowserSession(p, browser_args, context_options)
+        context = await browser_session.open()
         try:
-            # 点击ALL按钮
-            all_clicked = await click_all_button(page)
-            if all_clicked:
-                await asyncio.sleep(1)
-                
-                # 获取交易成本 - 如果有余额，会显示成本
-                cost = await extract_cost_from_page(page)
-                if cost > 0 and cost <= MAX_COST_PER_TRADE:
-                    print(f"USDC -> USDT 方向可交易，成本: {cost}")
-                    has_valid_trade = True
-                    available_direction = "USDC->USDT"
-                else:
-                    print(f"USDC -> USDT 方向不可交易，成本: {cost}")
-        except Exception as e:
-            print(f"测试USDC方向时出错: {e}")
-        
-        # 如果USDC方向不可交易，尝试USDT -> USDC
-        if not has_valid_trade:
-            print("尝试查看USDT -> USDC方向是否可交易...")
-            current_from_token = "USDT"
-            current_to_token = "USDC"
+            page = context.pages[0] if context.pages else await context.new_page()
+            await prepare_trade_page(page)
+            quote_watcher.attach()
+            await memory_watchdog.attach(page)
+            
+            # 访问DeFi应用；复用上次的会话时直接打开交易页面
+            start_path = "/trade" if session_reused else DEFI_JOIN_PATH
+            await page.goto(f"{DEFI_APP_URL}{start_path}", wait_until="domcontentloaded")
             
-            # 确保方向正确
-            await ensure_swap_direction(page, current_from_token, current_to_token)
-            await asyncio.sleep(1)
+            # 等待钱包连接，检测到已连接立即继续
+            if session_reused:
+                print("复用上次的浏览器会话，检查钱包连接状态...")
+            else:
+                print(f"请在{WALLET_CONNECT_WAIT:g}秒内完成钱包连接...")
+            if await page_readiness.wait_for_wallet(WALLET_CONNECT_WAIT):
+                print("钱包已连接")
+                await save_browser_session(context)
+            else:
+                print("未检测到钱包连接，继续尝试交易")
             
-            # 尝试点击ALL看是否有余额
+            # 确保我们在交易页面；页面就绪以Swap卡片出现为准，不等待networkidle（轮询和WebSocket会让它一直不触发）
             try:
-                # 点击ALL按钮
-                all_clicked = await click_all_button(page)
-                if all_clicked:
-                    await asyncio.sleep(1)
-                    
-                    # 获取交易成本 - 如果有余额，会显示成本
-                    cost = await extract_cost_from_page(page)
-                    if cost > 0 and cost <= MAX_COST_PER_TRADE:
-                        print(f"USDT -> USDC 方向可交易，成本: {cost}")
-                        has_valid_trade = True
-                        available_direction = "USDT->USDC"
-                    else:
-                        print(f"USDT -> USDC 方向不可交易，成本: {cost}")
+                if urlparse(page.url).path.rstrip("/") != "/trade":
+                    await page.goto(f"{DEFI_APP_URL}/trade", wait_until="domcontentloaded")
             except Exception as e:
-                print(f"测试USDT方向时出错: {e}")
-        
-        # 如果两个方向都不可交易，退出程序
-        if not has_valid_trade:
-            print("两个交易方向都不可交易，可能没有足够余额，程序退出")
-            await browser.close()
-            return
-        
-        # 使用可交易的方向
-        if available_direction == "USDC->USDT":
-            current_from_token = "USDC"
-            current_to_token = "USDT"
-            print("使用USDC -> USDT方向开始交易")
-        else:
-            current_from_token = "USDT"
-            current_to_token = "USDC"
-            print("使用USDT -> USDC方向开始交易")
-        
-        # 确保初始代币方向正确
-        await ensure_swap_direction(page, current_from_token, current_to_token)
-        
-        trade_count = 0
-        last_direction_change_time = time.time()
-        max_retry_same_direction = 3
-        same_direction_retry = 0
-        
-        while trade_count < MAX_TRADES and total_cost < MAX_TOTAL_COST:
-            try:
-                print(f"\n--- 开始第 {trade_count+1} 次交易 ---")
-                print(f"当前交易方向: {current_from_token} -> {current_to_token}")
-                
-                # 再次确认交易方向是否正确
-                direction_correct = await ensure_swap_direction(page, current_from_token, current_to_token)
-                if not direction_correct:
-                    print("无法设置正确的交易方向，尝试继续...")
-                
-                # 截图当前状态
-                screenshot_path = f"trade_status_{trade_count}.png"
-                await page.screenshot(path=screenshot_path)
-                
-                # 先检查余额 - 分析当前截图
-                current_status = f"交易次数: {trade_count}, 已消耗: {total_cost} USDT"
-                analysis = await analyze_with_llm(screenshot_path, current_status)
-                print(f"\n--- LLM分析 ---\n{analysis}\n")
-                
-                # 强制点击ALL按钮以选择最大交易额
-                all_clicked = await click_all_button(page)
-                
-                if not all_clicked:
-                    print("无法点击ALL按钮，尝试继续交易，但可能使用默认金额")
-                
-                # 重新获取交易成本（点击ALL后可能会改变）
-                await asyncio.sleep(0.5)
-                estimated_cost = await extract_cost_from_page(page)
-                print(f"选择ALL后预计交易成本: {estimated_cost} USDT")
-                
-                # 检查是否有足够余额进行交易（通过成本判断）
-                if estimated_cost <= 0 or estimated_cost > MAX_COST_PER_TRADE:
-                    print(f"交易成本不合适: {estimated_cost} USDT，尝试切换方向")
-                    
-                    # 如果短时间内多次切换方向且仍无法交易，增加等待时间
-                    current_time = time.time()
-                    if current_time - last_direction_change_time < 10:
-                        same_direction_retry += 1
-                    else:
-                        same_direction_retry = 0
-                    
-                    if same_direction_retry >= max_retry_same_direction:
-                        print(f"多次尝试切换方向仍无法交易，等待15秒后重试")
-                        await asyncio.sleep(15)
-                        same_direction_retry = 0
-                    
-                    # 切换到另一个方向尝试
-                    current_from_token, current_to_token = current_to_token, current_from_token
-                    print(f"新的交易方向: {current_from_token} -> {current_to_token}")
-                    last_direction_change_time = current_time
-                    
-                    # 确保UI反转已执行
-                    if await click_reverse_button(page):
-                        print(f"成功切换交易方向UI")
-                        await asyncio.sleep(1)
-                    else:
-                        print("无法切换交易方向UI，将在下次循环中重试")
-                    
-                    await asyncio.sleep(WAIT_BETWEEN_TRADES)
-                    continue
-                
-                # 重置切换方向尝试次数
-                same_direction_retry = 0
-                
-                # 点击Swap按钮
-                if await click_swap_button(page):
-                    print("已点击Swap按钮")
-                else:
-                    print("无法点击Swap按钮，跳过此次交易")
-                    await asyncio.sleep(WAIT_BETWEEN_TRADES)
-                    continue
-                
-                # 确认交易
-                if await confirm_transaction(page):
-                    # 记录交易
-                    transaction_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    transactions.append({
-                        "time": transaction_time,
-                        "from": current_from_token,
-                        "to": current_to_token,
-                        "cost": estimated_cost
-                    })
-                    
-                    total_cost += estimated_cost
-                    trade_count += 1
-                    
-                    print(f"完成交易 #{trade_count}: {current_from_token} -> {current_to_token}")
-                    print(f"成本: {estimated_cost} USDT, 总消耗: {total_cost} USDT")
-                    
-                    # 等待交易完成，确保页面更新
-                    await page.wait_for_load_state("networkidle", timeout=30000)
-                    await asyncio.sleep(2.5)
-                    
-                    # 交易完成后交换From和To代币（为下一次交易做准备）
-                    # 注意：先交换变量，再点击反转按钮
-                    old_from = current_from_token
-                    old_to = current_to_token
-                    current_from_token, current_to_token = current_to_token, current_from_token
-                    print(f"交易完成，切换交易方向为: {current_from_token} -> {current_to_token}")
-                    
-                    # 交易完成后一定要点击反转按钮，这是关键步骤，多次尝试确保成功
-                    print(f"正在将交易方向从 {old_from}->{old_to} 反转为 {current_from_token}->{current_to_token}")
-                    
-                    # 强制点击反转按钮，多次尝试确保成功
-                    reverse_success = False
-                    for retry in range(5):  # 最多尝试5次
-                        if await click_reverse_button(page):
-                            print(f"第{retry+1}次尝试: 已点击反转按钮准备下一次交易")
-                            reverse_success = True
-                            await asyncio.sleep(1)
-                            break
-                        else:
-                            print(f"第{retry+1}次尝试: 点击反转按钮失败，等待后重试")
-                            await asyncio.sleep(1)
-                    
-                    if not reverse_success:
-                        print("警告: 无法点击反转按钮，将在下一次交易前重新确认方向")
-                    
-                    # 休息一段时间，避免操作过快
-                    await asyncio.sleep(WAIT_BETWEEN_TRADES)
-                else:
-                    print("交易可能未成功完成，等待后重试")
-                    await asyncio.sleep(WAIT_BETWEEN_TRADES)
+                print(f"导航到交易页面失败: {e}")
+                # 如果导航失败，尝试点击Trade按钮
+                try:
+                    await page.click("text=Trade")
+                except:
+                    print("无法进入交易页面，请手动操作")
             
-            except Exception as e:
-                print(f"交易过程中出现错误: {e}")
-                await asyncio.sleep(2.5)
-        
-        # 交易结束，打印摘要
-        print("\n--- 交易摘要 ---")
-        print(f"总交易次数: {trade_count}")
-        print(f"总消耗USDT: {total_cost}")
-        print("交易记录:")
-        for tx in transactions:
-            print(f"{tx['time']}: {tx['from']} -> {tx['to']}, 成本: {tx['cost']} USDT")
-        
-        # 关闭浏览器
-        await browser.close()
+            # 等待Swap卡片加载完成
+            await page_readiness.wait_for_swap_ready(PAGE_READY_TIMEOUT)
+            
+            # 交易状态机：先检查两个方向选择可交易的方向，然后循环执行交易直到达到限额
+            machine = TradeStateMachine(page, resumed_trades)
+            machine.add_listener(on_state_transition)
+            session_recorder.attach(machine)
+            runtime_config.install_signal_handler()
+            print(f"单笔交易最长耗时上限: {machine.trade_deadline():g}秒（不含交易间隔）")
+            # 看门狗在循环卡住时进程内恢复，不需要重启容器
+            supervisor = Supervisor(machine, browser_session, SUPERVISOR_STALL_SECONDS, SUPERVISOR_MAX_FAILURES)
+            stop_reason = await supervisor.run()
+            trade_count = machine.trade_count
+            
+            # 交易结束，打印摘要
+            if stop_reason == "no_direction":
+                # 两个方向都不可交易，直接退出
+                print("两个交易方向都不可交易，可能没有足够余额，程序退出")
+            else:
+                if stop_reason == "unrecoverable":
+                    print("交易循环无法在进程内恢复，程序退出")
+                print_trade_summary(trade_count)
+        finally:
+            # 录制的会话（HAR在关闭上下文时写入）和浏览器在出现异常时也要保存、关闭
+            await session_recorder.finish()
+            await browser_session.close()
+
+def print_trade_summary(trade_count):
+    print("\n--- 交易摘要 ---")
+    print(f"总交易次数: {trade_count}")
+    print(f"总消耗USDT: {total_cost}")
+    cache_stats = llm_cache.stats()
+    if LEAN_MODE:
+        print(f"精简模式拦截请求: {blocked_requests['count']} 个")
+    if static_cache.enabled:
+        print(f"静态资源缓存: 命中 {static_cache.hits} 次, 未命中 {static_cache.misses} 次, 新保存 {static_cache.stored} 个")
+    pacing_stats = pacing.stats()
+    print(f"交易节奏({pacing.mode}): 确认耗时 p50 {pacing_stats['confirm_p50_ms']}ms / p95 {pacing_stats['confirm_p95_ms']}ms, "
+          f"就绪耗时 p50 {pacing_stats['ready_p50_ms']}ms / p95 {pacing_stats['ready_p95_ms']}ms, 退避 {pacing_stats['troubles']} 次")
+    if memory_watchdog.last is not None:
+        print(f"浏览器内存: JS堆 {memory_watchdog.last['js_heap_bytes'] / 1048576:.0f}MB, "
+              f"DOM节点 {memory_watchdog.last['dom_nodes']:.0f}, 页面回收 {memory_watchdog.recycles} 次")
+    print(f"LLM后台分析因上一轮未完成而跳过: {analysis_state.skipped} 次")
+    for line in llm_gateway.summary():
+        print(f"LLM模型 {line}")
+    print(f"LLM分析缓存: 命中 {cache_stats['hits']} 次, 未命中 {cache_stats['misses']} 次, 命中率 {cache_stats['hit_rate']:.1%}")
+    stats = metrics.snapshot()
+    print(f"最近一分钟交易数: {stats['trades_per_minute']}, 平均每分钟: {stats['trades_per_minute_overall']}")
+    for name, phase in stats["phases"].items():
+        print(f"阶段 {name}: 次数 {phase['count']}, p50 {phase['p50_ms']}ms, p95 {phase['p95_ms']}ms, p99 {phase['p99_ms']}ms")
+    print(f"状态转换: {', '.join(f'{key} {count}次' for key, count in stats['transitions'].items())}")
+    print("交易记录:")
+    for tx in journal.iter_trades(journal.run_id):
+        print(f"{tx['time']}: {tx['from']} -> {tx['to']}, 成本: {tx['cost']} USDT")
+
+async def _click_all_by_js(page, timeout_ms):
+    """使用JavaScript查找文本为ALL/MAX的按钮并点击"""
+    return await page.evaluate("""
+        (() => {
+            const buttons = document.querySelectorAll('button, span');
+            for (const button of buttons) {
+                const text = button.textContent.trim();
+                if (text === 'ALL' || text === 'MAX') {
+                    button.click();
+                    return true;
+                }
+            }
+            
+            return false;
+        })()
+    """)
+
+ALL_BUTTON_STRATEGIES = [
+    SelectorStrategy("text", "button:has-text(\"ALL\")", selector='button:has-text("ALL")'),
+    SelectorStrategy("border_span", "边框按钮内的ALL文本", selector='button.border.border-border-secondary:has(span:text("ALL"))'),
+    SelectorStrategy("span", "ALL文本", selector='button:has(span:text("ALL"))'),
+    SelectorStrategy("max", "MAX文本", selector='button:has-text("MAX")'),  # 有些界面可能使用MAX而不是ALL
+    SelectorStrategy("js", "JavaScript", fn=_click_all_by_js),
+]
 
 async def click_all_button(page):
     """尝试点击ALL按钮选择最大交易额"""
     try:
-        # 尝试多种方式点击ALL按钮
-        selectors = [
-            'button:has-text("ALL")',
-            'button.border.border-border-secondary:has(span:text("ALL"))',
-            'button:has(span:text("ALL"))',
-            'button:has-text("MAX")',  # 有些界面可能使用MAX而不是ALL
-        ]
-        
-        for selector in selectors:
-            try:
-                await page.click(selector)
-                print(f"使用选择器 '{selector}' 成功点击ALL按钮")
-                await page.wait_for_timeout(1000)
-                return True
-            except Exception:
-                continue
-        
-        # 使用JavaScript尝试点击
-        all_clicked = await page.evaluate('''
-            (() => {
-                // 尝试各种可能的选择器
-                const selectors = [
-                    'button:has-text("ALL")',
-                    'button.border',
-                    'span:has-text("ALL")',
-                    'button:has-text("MAX")'
-                ];
-                
-                for (const selector of selectors) {
-                    const buttons = document.querySelectorAll(selector);
-                    for (const button of buttons) {
-                        if (button.textContent.includes('ALL') || button.textContent.includes('MAX')) {
-                            button.click();
-                            return true;
-                        }
-                    }
-                }
-                
-                return false;
-            })()
-        ''')
-        if all_clicked:
-            print("使用JavaScript成功点击ALL按钮")
-            await page.wait_for_timeout(1000)
+        quote_seq = page_readiness.quote_seq
+        if await run_ui_action(page, "all", "ALL按钮", ALL_BUTTON_STRATEGIES):
+            # 等待金额和成本更新，最多1秒
+            await page_readiness.wait_for_cost_update(1, quote_seq)
             return True
         
         print("无法点击ALL按钮")
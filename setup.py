@@ -7,7 +7,8 @@ setup(
     install_requires=[
         "playwright>=1.39.0",
         "python-dotenv>=1.0.0",
-        "requests>=2.31.0",
+        "aiohttp>=3.8.0",
+        "Pillow>=9.0.0",
     ],
     entry_points={
         "console_scripts": [
@@ -0,0 +1,109 @@
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import pytest
+
+import defi
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(defi.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_opens_after_consecutive_failures(clock):
+    breaker = defi.CircuitBreaker(failure_threshold=3, cooldown=30)
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert breaker.is_open()
+    assert not breaker.allow()
+    assert breaker.retry_in() == 30
+
+
+def test_success_resets_failure_count(clock):
+    breaker = defi.CircuitBreaker(failure_threshold=2, cooldown=30)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+
+
+def test_half_open_allows_single_probe(clock):
+    breaker = defi.CircuitBreaker(failure_threshold=1, cooldown=30)
+    breaker.record_failure()
+    clock[0] += 30
+    assert breaker.allow()
+    assert breaker.state == "half_open"
+    # 试探请求还没有结果时不再放行
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.allow()
+    assert breaker.allow()
+
+
+def test_failed_probe_reopens_with_doubled_cooldown(clock):
+    breaker = defi.CircuitBreaker(failure_threshold=1, cooldown=10)
+    breaker.record_failure()
+    cooldowns = []
+    for _ in range(5):
+        clock[0] += breaker.retry_in()
+        assert breaker.allow()
+        breaker.record_failure()
+        cooldowns.append(breaker.retry_in())
+    # 冷却时间加倍，最多8倍
+    assert cooldowns == [20, 40, 80, 80, 80]
+
+
+def test_released_probe_frees_the_slot(clock):
+    breaker = defi.CircuitBreaker(failure_threshold=1, cooldown=10)
+    breaker.record_failure()
+    clock[0] += 10
+    assert breaker.allow()
+    breaker.release()
+    assert breaker.state == "half_open"
+    assert breaker.allow()
+
+
+def test_retry_after_opens_immediately(clock):
+    breaker = defi.CircuitBreaker(failure_threshold=5, cooldown=10)
+    breaker.record_failure(retry_after=60)
+    assert breaker.state == "open"
+    assert breaker.retry_in() == 60
+    # Retry-After比冷却时间短时按冷却时间
+    short = defi.CircuitBreaker(failure_threshold=5, cooldown=10)
+    short.record_failure(retry_after=2)
+    assert short.retry_in() == 10
+
+
+def test_zero_threshold_only_opens_on_retry_after(clock):
+    breaker = defi.CircuitBreaker(failure_threshold=0, cooldown=10)
+    for _ in range(10):
+        breaker.record_failure()
+    assert breaker.state == "closed"
+
+
+@pytest.mark.parametrize("value, expected", [
+    (None, None),
+    ("", None),
+    ("120", 120.0),
+    ("1.5", 1.5),
+    ("-3", 0.0),
+    ("soon", None),
+])
+def test_parse_retry_after_seconds(value, expected):
+    assert defi.parse_retry_after(value) == expected
+
+
+def test_parse_retry_after_http_date():
+    when = datetime.now(timezone.utc) + timedelta(seconds=90)
+    seconds = defi.parse_retry_after(format_datetime(when, usegmt=True))
+    assert 80 <= seconds <= 90
+    past = datetime.now(timezone.utc) - timedelta(hours=1)
+    assert defi.parse_retry_after(format_datetime(past, usegmt=True)) == 0.0
@@ -0,0 +1,123 @@
+import asyncio
+import os
+import signal
+
+import pytest
+
+import defi
+
+BASE = defi.RuntimeConfig(
+    max_cost_per_trade=0.3,
+    max_total_cost=5.0,
+    wait_between_trades=0.0,
+    max_trades=5,
+    llm_model="model-a"
+)
+
+
+def write_config(path, text):
+    path.write_text(text, encoding="utf-8")
+
+
+def test_from_values_parses_and_keeps_missing_fields():
+    config = defi.RuntimeConfig.from_values({"MAX_TRADES": " 12 ", "MAX_TOTAL_COST": ""}, BASE)
+    assert config.max_trades == 12
+    assert config.max_total_cost == BASE.max_total_cost
+    assert config.diff(BASE) == {"max_trades": (5, 12)}
+
+
+@pytest.mark.parametrize("values", [
+    {"MAX_TRADES": "ten"},
+    {"MAX_COST_PER_TRADE": "0"},
+    {"WAIT_BETWEEN_TRADES": "-1"},
+    {"MAX_TRADES": "-1"},
+])
+def test_from_values_rejects_invalid(values):
+    with pytest.raises(ValueError):
+        defi.RuntimeConfig.from_values(values, BASE)
+
+
+def test_limit_reached():
+    assert not BASE.limit_reached(4, 4.9)
+    assert BASE.limit_reached(5, 0)
+    assert BASE.limit_reached(0, 5.0)
+
+
+def test_reload_applies_only_changed_file_values(tmp_path):
+    path = tmp_path / ".env"
+    # 文件中MAX_TRADES=20，但启动时环境变量设置了5（BASE），未改动的文件值不覆盖它
+    write_config(path, "MAX_TRADES=20\nMAX_COST_PER_TRADE=0.3\n")
+    reloader = defi.RuntimeConfigReloader(str(path), BASE)
+
+    write_config(path, "MAX_TRADES=20\nMAX_COST_PER_TRADE=0.25\n")
+    reloader.request_reload()
+    config = reloader.refresh()
+    assert config.max_cost_per_trade == 0.25
+    assert config.max_trades == 5
+
+    write_config(path, "MAX_TRADES=30\nMAX_COST_PER_TRADE=0.25\n")
+    reloader.request_reload()
+    assert reloader.refresh().max_trades == 30
+
+
+def test_reload_keeps_current_config_on_invalid_value(tmp_path):
+    path = tmp_path / ".env"
+    write_config(path, "MAX_TRADES=5\n")
+    reloader = defi.RuntimeConfigReloader(str(path), BASE)
+
+    write_config(path, "MAX_TRADES=lots\n")
+    reloader.request_reload()
+    assert reloader.refresh() is BASE
+
+    write_config(path, "MAX_TRADES=8\n")
+    reloader.request_reload()
+    assert reloader.refresh().max_trades == 8
+
+
+def test_refresh_without_change_returns_current(tmp_path):
+    path = tmp_path / ".env"
+    write_config(path, "MAX_TRADES=5\n")
+    reloader = defi.RuntimeConfigReloader(str(path), BASE)
+    assert reloader.refresh() is BASE
+
+
+def test_reload_when_file_is_missing(tmp_path):
+    reloader = defi.RuntimeConfigReloader(str(tmp_path / "missing.env"), BASE)
+    reloader.request_reload()
+    assert reloader.refresh() is BASE
+
+
+def test_mtime_change_triggers_reload(tmp_path):
+    path = tmp_path / ".env"
+    write_config(path, "MAX_TRADES=5\n")
+    reloader = defi.RuntimeConfigReloader(str(path), BASE)
+    write_config(path, "MAX_TRADES=9\n")
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+    assert reloader.refresh().max_trades == 9
+
+
+@pytest.mark.skipif(not hasattr(signal, "SIGHUP"), reason="没有SIGHUP")
+def test_sighup_requests_reload(tmp_path):
+    path = tmp_path / ".env"
+    write_config(path, "MAX_TRADES=5\n")
+    reloader = defi.RuntimeConfigReloader(str(path), BASE)
+
+    async def send_sighup():
+        reloader.install_signal_handler()
+        try:
+            # 修改文件但保持修改时间不变，只有信号能触发重新加载
+            stat = os.stat(path)
+            write_config(path, "MAX_TRADES=7\n")
+            os.utime(path, (stat.st_atime, stat.st_mtime))
+            assert reloader.refresh() is BASE
+            os.kill(os.getpid(), signal.SIGHUP)
+            for _ in range(100):
+                if reloader.reload_requested:
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            asyncio.get_event_loop().remove_signal_handler(signal.SIGHUP)
+
+    asyncio.run(send_sighup())
+    assert reloader.refresh().max_trades == 7
@@ -0,0 +1,102 @@
+import json
+
+import defi
+
+
+def write_trades(path, count, cost=0.1):
+    journal = defi.TradeJournal(str(path))
+    journal.open()
+    total = 0.0
+    for trade_count in range(1, count + 1):
+        total += cost
+        journal.record("quote", trade=trade_count, cost=cost)
+        journal.record("trade", trade_count=trade_count, total_cost=total, cost=cost)
+    journal.close()
+    return total
+
+
+def test_recover_without_journal(tmp_path):
+    assert defi.TradeJournal(str(tmp_path / "missing.jsonl")).recover() == (0, 0)
+    assert defi.TradeJournal("").recover() == (0, 0)
+
+
+def test_recover_returns_last_cumulative_trade(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    total = write_trades(path, 3)
+    # trade之后的其他记录不影响恢复
+    journal = defi.TradeJournal(str(path))
+    journal.open()
+    journal.record("confirm", trade=4, ok=False)
+    journal.close()
+
+    trade_count, total_cost = defi.TradeJournal(str(path)).recover()
+    assert trade_count == 3
+    assert total_cost == total
+
+
+def test_recover_counts_unknown_outcome_trades(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    write_trades(path, 2)
+    journal = defi.TradeJournal(str(path))
+    journal.open()
+    journal.record("trade", trade_count=3, total_cost=0.5, cost=0.3, outcome="unknown")
+    journal.close()
+
+    assert defi.TradeJournal(str(path)).recover() == (3, 0.5)
+
+
+def test_recover_skips_torn_last_line(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    total = write_trades(path, 2)
+    # 崩溃时写了一半的最后一行
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"event": "trade", "trade_count": 3, "total_co')
+
+    assert defi.TradeJournal(str(path)).recover() == (2, total)
+
+
+def test_append_after_torn_line(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    write_trades(path, 2)
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"event": "trade", "trade_count": 3, "total_co')
+
+    journal = defi.TradeJournal(str(path))
+    trade_count, total_cost = journal.recover()
+    journal.open()
+    journal.record("trade", trade_count=trade_count + 1, total_cost=total_cost + 0.2, cost=0.2)
+    journal.close()
+
+    # 新记录单独成行，不会与不完整的行粘连
+    lines = path.read_text(encoding="utf-8").splitlines()
+    assert lines[-2] == '{"event": "trade", "trade_count": 3, "total_co'
+    assert json.loads(lines[-1])["trade_count"] == 3
+    assert defi.TradeJournal(str(path)).recover() == (3, total_cost + 0.2)
+    assert [entry["trade_count"] for entry in defi.TradeJournal(str(path)).iter_trades()] == [1, 2, 3]
+
+
+def test_recover_reads_across_blocks(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    total = write_trades(path, 300)
+    journal = defi.TradeJournal(str(path))
+
+    expected = [line.encode("utf-8") for line in path.read_text(encoding="utf-8").splitlines()]
+    assert list(journal._reverse_lines(block_size=64)) == expected[::-1]
+    assert journal.recover() == (300, total)
+
+
+def test_iter_trades_filters_by_run(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    first = defi.TradeJournal(str(path))
+    first.run_id = "first"
+    first.open()
+    first.record("trade", trade_count=1, total_cost=0.1)
+    first.close()
+    second = defi.TradeJournal(str(path))
+    second.run_id = "second"
+    second.open()
+    second.record("trade", trade_count=2, total_cost=0.2)
+    second.close()
+
+    assert [entry["trade_count"] for entry in second.iter_trades("second")] == [2]
+    assert len(list(second.iter_trades())) == 2